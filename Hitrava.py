@@ -6,39 +6,70 @@
 # Released under the Non-Profit Open Software License version 3.0
 
 
+import abc
 import argparse
+import array
+import bisect
 import collections
-import csv
+import collections.abc
+import concurrent.futures
+import contextlib
 import datetime
+import gzip
+import hashlib
+import hmac
+import io
 import json
 import logging
 import math
+import mmap
 import operator
 import os
 import platform
 import re
+import struct
 import subprocess
 import sys
 import tarfile
-import tempfile
+import time
+import types
 import zipfile
+import zlib
 
 import urllib.request as url_req
-import xml.etree.cElementTree as xml_et
 from datetime import datetime as dts
 from datetime import timedelta as dts_delta
 from datetime import timezone as tz
 from zipfile import ZipFile
 
 # External libraries that require installation
-from typing import Optional
+from typing import IO, BinaryIO, Callable, Iterator, Optional
 
 try:
-    import xmlschema  # (only) needed to validate the generated TCX XML.
+    # (only) used to validate the generated TCX XML much faster. xmlschema is used when not available.
+    from lxml import etree as lxml_etree
 except ModuleNotFoundError:
-    sys.stderr.write('\nInfo - External library xmlschema could not be imported.\n' +
-                     'It is required when using the --validate_xml argument.\n' +
-                     'It can be installed using: pip install xmlschema\n')
+    lxml_etree = None
+
+try:
+    import xmlschema  # (only) needed to validate the generated TCX XML when lxml is not available.
+except ModuleNotFoundError:
+    if not lxml_etree:
+        sys.stderr.write('\nInfo - External library xmlschema could not be imported.\n' +
+                         'It (or library lxml) is required when using the --validate_xml argument.\n' +
+                         'It can be installed using: pip install xmlschema\n')
+
+try:
+    import numpy  # (only) used to speed up the distance calculations. Pure Python is used when not available.
+except ModuleNotFoundError:
+    numpy = None
+
+try:
+    # (only) used to decrypt WinZip AES encrypted ZIP files in-process. 7-Zip is used when not available.
+    from Crypto.Cipher import AES
+    from Crypto.Util import Counter
+except ModuleNotFoundError:
+    AES = None
 
 if sys.version_info < (3, 12, 1):
     sys.stderr.write(f'\nWarning - Hitrava was developed and tested on Python 3.12.1 or later.\n'
@@ -55,8 +86,337 @@ PROGRAM_MAJOR_BUILD = '2607'
 PROGRAM_MINOR_BUILD = '0101'
 
 OUTPUT_DIR = './output'
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', PROGRAM_NAME)
 GPS_TIMEOUT = dts_delta(seconds=10)
 
+# Distance calculation methods between two locations
+DISTANCE_VINCENTY = 'vincenty'  # Vincenty inverse formula on the WGS 84 ellipsoid (reference method, default)
+DISTANCE_ANDOYER_LAMBERT = 'andoyer_lambert'  # First order ellipsoidal correction of the spherical distance
+DISTANCE_HAVERSINE = 'haversine'  # Great circle distance on a sphere with the WGS 84 mean radius
+DISTANCE_METHODS = (DISTANCE_VINCENTY, DISTANCE_ANDOYER_LAMBERT, DISTANCE_HAVERSINE)
+
+# Output file formats
+OUTPUT_FORMAT_TCX = 'tcx'  # Garmin Training Center XML (default)
+OUTPUT_FORMAT_FIT = 'fit'  # Garmin binary Flexible and Interoperable Data Transfer activity file
+OUTPUT_FORMAT_GPX = 'gpx'  # GPS Exchange Format 1.1 track
+OUTPUT_FORMAT_CSV = 'csv'  # Table with all detail data, one row per timestamp
+OUTPUT_FORMATS = (OUTPUT_FORMAT_TCX, OUTPUT_FORMAT_FIT, OUTPUT_FORMAT_GPX, OUTPUT_FORMAT_CSV)
+
+# WGS 84
+_WGS84_A = 6378137
+_WGS84_F = 1 / 298.257223563
+_WGS84_B = 6356752.314245
+_WGS84_MEAN_RADIUS = 6371008.8
+
+# All timestamps in a HiActivity are integer microseconds since the epoch (UTC). Datetimes are only created for output.
+_EPOCH = dts(1970, 1, 1, tzinfo=tz.utc)
+_ONE_MICROSECOND = dts_delta(microseconds=1)
+_MICROSECONDS_PER_SECOND = 1000000
+_GPS_TIMEOUT_MICROSECONDS = GPS_TIMEOUT // _ONE_MICROSECOND
+
+# Garmin TrainingCenterDatabase version 2 XSD to validate the generated TCX XML against
+_TCX_XSD_URL = 'https://www8.garmin.com/xmlschemas/TrainingCenterDatabasev2.xsd'
+_TCX_XSD_FILE = 'TrainingCenterDatabasev2.xsd'
+
+# Version of the parsing of the activities. Bump with every change of the parsing of the HiTrack or JSON data or of the
+# calculations on the parsed data (e.g. segments and distances), so parsed activities in the cache (see --cache_dir)
+# from another version are not used.
+_PARSER_VERSION = 1
+
+
+class HiColumnarDataDict(collections.abc.MutableMapping):
+    """ Columnar (array-backed) alternative for the detail data dictionary of a HiActivity.
+    Instead of a dictionary per timestamp, all data records share one timestamp axis and every data channel (lat, lon,
+    hr, ...) is stored in a typed array with a mask per channel that tells whether the record has a value for it.
+    The class behaves like the dictionary it replaces: key = timestamp, value = (view on the) record with the data of
+    the timestamp. Record views are created on access and write through to the arrays.
+    """
+
+    # Data channels and their array type codes. Channels with type code 'd' can hold both float and int values.
+    _CHANNELS = {'lat': 'd', 'lon': 'd', 'alti': 'd', 'distance': 'd', 'rs': 'd',
+                 'hr': 'i', 'cad': 'i', 's-r': 'i', 'swf': 'i', 'p-f': 'i'}
+
+    # Mask values
+    _ABSENT = 0
+    _PRESENT = 1
+    _PRESENT_INT = 2  # Int value in a float ('d') channel. Retains the original value type for output.
+
+    def __init__(self):
+        # Timestamps (microseconds since epoch)
+        self._t = array.array('q')
+        self._channels = {channel: array.array(type_code) for channel, type_code in self._CHANNELS.items()}
+        self._masks = {channel: bytearray() for channel in self._CHANNELS}
+        # Data without a channel (not expected in HiTrack data). key = record index, value = dict
+        self._extra = {}
+        # Record index lookup by timestamp. Only used while the records are not sorted, bisection is used otherwise.
+        self._index = {}
+        self._sorted = True
+
+    def _find(self, timestamp: int) -> int:
+        """ Returns the index of the record with the timestamp or -1 if there is no such record """
+        if not self._sorted:
+            return self._index.get(timestamp, -1)
+        i = bisect.bisect_left(self._t, timestamp)
+        if i < len(self._t) and self._t[i] == timestamp:
+            return i
+        return -1
+
+    def _get_value(self, i: int, channel: str):
+        if channel == 't':
+            return self._t[i]
+        if channel in self._channels:
+            mask = self._masks[channel][i]
+            if mask == self._ABSENT:
+                raise KeyError(channel)
+            value = self._channels[channel][i]
+            return int(value) if mask == self._PRESENT_INT else value
+        return self._extra[i][channel]
+
+    def _set_value(self, i: int, channel: str, value):
+        if channel == 't':
+            if value != self._t[i]:
+                raise KeyError('Timestamp of a record can not be changed')
+        elif channel in self._channels:
+            self._channels[channel][i] = value
+            if self._CHANNELS[channel] == 'd' and isinstance(value, int):
+                self._masks[channel][i] = self._PRESENT_INT
+            else:
+                self._masks[channel][i] = self._PRESENT
+        else:
+            self._extra.setdefault(i, {})[channel] = value
+
+    def _del_value(self, i: int, channel: str):
+        if channel in self._channels and self._masks[channel][i] != self._ABSENT:
+            self._masks[channel][i] = self._ABSENT
+        elif i in self._extra and channel in self._extra[i]:
+            del self._extra[i][channel]
+        else:
+            raise KeyError(channel)
+
+    def _has_value(self, i: int, channel: str) -> bool:
+        if channel == 't':
+            return True
+        if channel in self._channels:
+            return self._masks[channel][i] != self._ABSENT
+        return i in self._extra and channel in self._extra[i]
+
+    def _channels_of(self, i: int):
+        yield 't'
+        for channel, mask in self._masks.items():
+            if mask[i] != self._ABSENT:
+                yield channel
+        if i in self._extra:
+            yield from self._extra[i]
+
+    def _append(self, timestamp: int) -> int:
+        i = len(self._t)
+        if self._sorted and i and self._t[-1] > timestamp:
+            # Record out of chronological order. Switch to the index lookup until the next sort.
+            self._sorted = False
+            self._index = {k: n for n, k in enumerate(self._t)}
+        self._t.append(timestamp)
+        for channel, values in self._channels.items():
+            values.append(0)
+            self._masks[channel].append(self._ABSENT)
+        if not self._sorted:
+            self._index[timestamp] = i
+        return i
+
+    def sort(self):
+        """ Sorts the records by timestamp (in place) """
+        if self._sorted:
+            return
+        order = sorted(range(len(self._t)), key=self._t.__getitem__)
+        self._t = array.array('q', (self._t[i] for i in order))
+        for channel, values in self._channels.items():
+            self._channels[channel] = array.array(values.typecode, (values[i] for i in order))
+            mask = self._masks[channel]
+            self._masks[channel] = bytearray(mask[i] for i in order)
+        if self._extra:
+            new_index = {old: new for new, old in enumerate(order)}
+            self._extra = {new_index[i]: extra for i, extra in self._extra.items()}
+        self._index = {}
+        self._sorted = True
+
+    def __getitem__(self, timestamp: int):
+        i = self._find(timestamp)
+        if i < 0:
+            raise KeyError(timestamp)
+        return _HiColumnarRecord(self, i)
+
+    def get(self, timestamp: int, default=None):
+        i = self._find(timestamp)
+        return default if i < 0 else _HiColumnarRecord(self, i)
+
+    def __setitem__(self, timestamp: int, data: dict):
+        i = self._find(timestamp)
+        if i < 0:
+            i = self._append(timestamp)
+        for channel, value in data.items():
+            if channel != 't':
+                self._set_value(i, channel, value)
+
+    def __delitem__(self, timestamp: int):
+        i = self._find(timestamp)
+        if i < 0:
+            raise KeyError(timestamp)
+        del self._t[i]
+        for channel in self._CHANNELS:
+            del self._channels[channel][i]
+            del self._masks[channel][i]
+        self._extra = {(n if n < i else n - 1): extra for n, extra in self._extra.items() if n != i}
+        if not self._sorted:
+            self._index = {k: n for n, k in enumerate(self._t)}
+
+    def __contains__(self, timestamp) -> bool:
+        return self._find(timestamp) >= 0
+
+    def __iter__(self):
+        return iter(self._t)
+
+    def __len__(self) -> int:
+        return len(self._t)
+
+    def items(self):
+        for i, timestamp in enumerate(self._t):
+            yield timestamp, _HiColumnarRecord(self, i)
+
+    def values(self):
+        for i in range(len(self._t)):
+            yield _HiColumnarRecord(self, i)
+
+    def timestamps(self) -> collections.abc.Sequence:
+        """ Returns a sequence view on the timestamps in the current record order """
+        return _HiColumnarSequence(self, lambda i: self._t[i])
+
+    def records(self) -> collections.abc.Sequence:
+        """ Returns a sequence view on the records in the current record order """
+        return _HiColumnarSequence(self, lambda i: _HiColumnarRecord(self, i))
+
+
+class _HiColumnarSequence(collections.abc.Sequence):
+    """ Sequence view on the timestamps or records of a HiColumnarDataDict """
+    __slots__ = ('_data', '_get')
+
+    def __init__(self, data: HiColumnarDataDict, get):
+        self._data = data
+        self._get = get
+
+    def __getitem__(self, i: int):
+        if i < 0:
+            i += len(self._data)
+        if not 0 <= i < len(self._data):
+            raise IndexError(i)
+        return self._get(i)
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+class _HiSegmentData(collections.abc.Sequence):
+    """ Read-only sequence view on a range of records in the timestamp sorted detail data of a HiActivity.
+    The records are not copied. """
+    __slots__ = ('_records', '_first', '_last')
+
+    def __init__(self, records: collections.abc.Sequence, first: int, last: int):
+        self._records = records
+        self._first = first
+        self._last = max(first, last)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[n] for n in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        return self._records[self._first + i]
+
+    def __iter__(self):
+        records = self._records
+        for i in range(self._first, self._last):
+            yield records[i]
+
+    def __len__(self) -> int:
+        return self._last - self._first
+
+
+class _HiColumnarRecord(collections.abc.MutableMapping):
+    """ Dictionary-like view on a single record (timestamp) in a HiColumnarDataDict """
+    __slots__ = ('_data', '_i')
+
+    def __init__(self, data: HiColumnarDataDict, i: int):
+        self._data = data
+        self._i = i
+
+    def __getitem__(self, channel: str):
+        return self._data._get_value(self._i, channel)
+
+    def __setitem__(self, channel: str, value):
+        self._data._set_value(self._i, channel, value)
+
+    def __delitem__(self, channel: str):
+        self._data._del_value(self._i, channel)
+
+    def __contains__(self, channel) -> bool:
+        return self._data._has_value(self._i, channel)
+
+    def __iter__(self):
+        return self._data._channels_of(self._i)
+
+    def __len__(self) -> int:
+        return sum(1 for _ in self._data._channels_of(self._i))
+
+    def __repr__(self):
+        return repr(dict(self))
+
+
+class _HiTrackTimestampConverter:
+    """ Converts the different timestamp formats appearing in HiTrack files to microseconds since epoch.
+
+    Known formats are
+    - seconds (e.g. 1516273200 or 1.5162732E9)
+    - milliseconds (e.g. 1516273200000 or 1.5162732E12)
+    - seconds since start of day (e.g. 43200) relative to day of activity start (timestamp reference)
+
+    The format is detected on the first timestamp and reused for all following timestamps that are within the value
+    range of the format. Only a timestamp outside this range (e.g. in another format) is detected again.
+    """
+
+    def __init__(self, timestamp_ref: dts|None = None):
+        # Timestamp reference in microseconds since epoch. A naive timestamp reference is in local time.
+        self._timestamp_ref = None if timestamp_ref is None \
+            else round(timestamp_ref.timestamp() * _MICROSECONDS_PER_SECOND)
+        # Value range [low, high) and divisor (to convert to seconds) of the detected format. Divisor 0 = relative.
+        self._low = 0.0
+        self._high = 0.0
+        self._divisor = None
+
+    def _detect_format(self, hitrack_timestamp: float):
+        timestamp_digits = int(math.log10(hitrack_timestamp))
+        if self._timestamp_ref is not None and hitrack_timestamp < 604800:  # Assume activity not longer than a week.
+            # Relative seconds from timestamp reference. Low is the smallest positive float (log10 fails for 0).
+            self._low, self._high, self._divisor = math.ulp(0.0), 604800, 0
+            return
+        self._low, self._high = 10.0 ** timestamp_digits, 10.0 ** (timestamp_digits + 1)
+        if self._timestamp_ref is not None and self._low < 604800:
+            self._low = 604800
+        if timestamp_digits == 9:
+            # Absolute epoch timestamp
+            self._divisor = 1
+        else:
+            self._divisor = 10 ** (timestamp_digits - 9) if timestamp_digits > 9 else 0.1 ** (9 - timestamp_digits)
+
+    def convert(self, hitrack_timestamp: float) -> int:
+        """ Returns the timestamp in microseconds since epoch """
+        if not self._low <= hitrack_timestamp < self._high:
+            self._detect_format(hitrack_timestamp)
+        if self._divisor == 0:
+            return self._timestamp_ref + round(hitrack_timestamp * _MICROSECONDS_PER_SECOND)
+        elif self._divisor == 1:
+            return int(hitrack_timestamp) * _MICROSECONDS_PER_SECOND
+        return int(hitrack_timestamp / self._divisor) * _MICROSECONDS_PER_SECOND
+
 
 class HiActivity:
     """ This class represents all the data contained in a HiTrack file."""
@@ -72,7 +432,7 @@ class HiActivity:
     TYPE_INDOOR_CYCLE = 'Indoor_Cycle'
     TYPE_CROSS_TRAINER = 'Cross_Trainer'
     TYPE_OTHER = 'Other'
-    TYPE_CROSSFIT = 'CrossFit',
+    TYPE_CROSSFIT = 'CrossFit'
     TYPE_CROSS_COUNTRY_RUN = 'Cross_Country_Run'
     TYPE_UNKNOWN = '?'
 
@@ -80,7 +440,8 @@ class HiActivity:
                            TYPE_MOUNTAIN_HIKE, TYPE_INDOOR_RUN, TYPE_INDOOR_CYCLE, TYPE_CROSS_TRAINER, TYPE_OTHER,
                            TYPE_CROSSFIT, TYPE_CROSS_COUNTRY_RUN)
 
-    def __init__(self, activity_id: str, activity_type: str = TYPE_UNKNOWN, timestamp_ref: dts|None = None, start_timestamp_ref: dts|None = None):
+    def __init__(self, activity_id: str, activity_type: str = TYPE_UNKNOWN, timestamp_ref: dts|None = None, start_timestamp_ref: dts|None = None,
+                 columnar_store: bool = False, distance_method: str = DISTANCE_VINCENTY):
         logging.getLogger(PROGRAM_NAME).debug('New HiTrack activity to process <%s>', activity_id)
         self.activity_id = activity_id
 
@@ -94,10 +455,10 @@ class HiActivity:
 
         self.pool_length = -1
 
-        # All date and timestamp variables are stored as time zone unaware because there is no time zone information
-        # available in the raw HiTrack files. However, time zone information is available from the JSON data and can be
-        # stored as an attribute of the HiActivity (see below). Please take care to properly format any display/output
-        # dates and times using this time zone information.
+        # All date and timestamp variables are stored as timestamps in microseconds since epoch (UTC) because there is
+        # no time zone information available in the raw HiTrack files. However, time zone information is available from
+        # the JSON data and can be stored as an attribute of the HiActivity (see below). Please take care to properly
+        # format any display/output dates and times using this time zone information (see _get_tz_aware_datetime).
         self.start = None
         self.stop = None
         self.time_zone = None
@@ -111,8 +472,20 @@ class HiActivity:
         self._current_segment = None
         self._segment_list = None
 
+        # Sorted timestamp index on the detail data (see _sort_data_dict). Built once after parsing the data.
+        self._timestamp_index = None
+        self._record_index = None
+
+        # The read-only laps and segments of the finalized activity (see finalize)
+        self._laps = None
+        self._segments = None
+
         # Create an empty detail data dictionary. key = timestamp, value = dict{t, lat, lon, alt, hr}
-        self.data_dict = {}
+        # The columnar store is a drop-in replacement with a much smaller memory footprint for long activities.
+        if columnar_store:
+            self.data_dict = HiColumnarDataDict()
+        else:
+            self.data_dict = {}
 
         # Create an empty list for the (pool) swim data
         self.swim_data = []
@@ -121,10 +494,18 @@ class HiActivity:
         self.last_swolf_data = None
 
         self.timestamp_ref = timestamp_ref
-        self.start_timestamp_ref = start_timestamp_ref
+        self.start_timestamp_ref = None if start_timestamp_ref is None else _to_timestamp(start_timestamp_ref)
+
+        # Timestamp converters per record type. The timestamp format is detected once per record type. Only location
+        # records can have timestamps relative to the timestamp reference.
+        self._location_timestamps = _HiTrackTimestampConverter(timestamp_ref)
+        self._timestamps = {record_type: _HiTrackTimestampConverter() for record_type in ('h-r', 'cad', 'alti', 's-r')}
+
+        # Method to calculate the distance between two locations (see DISTANCE_METHODS)
+        self.distance_method = distance_method
 
     @classmethod
-    def from_json_pool_swim_data(cls, activity_id: str, start: dts, json_pool_swim_dict):
+    def from_json_pool_swim_data(cls, activity_id: str, start: int, json_pool_swim_dict):
         """Create a HiActivity from the swim data in the JSON file.
         Uses the data in the mSwimSegments section of the JSON file (lap distance, duration, swolf)
         """
@@ -143,7 +524,7 @@ class HiActivity:
             # Create lap
             lap_distance = int(swim_segment['mDistance'])
             lap_duration = int(swim_segment['mDuration'])
-            lap_stop = lap_start + dts_delta(seconds=lap_duration)
+            lap_stop = lap_start + lap_duration * _MICROSECONDS_PER_SECOND
             lap_data = {'lap': int(swim_segment['mSegmentIndex']),
                         'start': lap_start,
                         'stop': lap_stop,
@@ -162,10 +543,10 @@ class HiActivity:
         return swim_activity
 
     @classmethod
-    def from_manual_json_pool_swim_data(cls, activity_id: str, start: dts, duration_millis: int, distance: int):
+    def from_manual_json_pool_swim_data(cls, activity_id: str, start: int, duration_millis: int, distance: int):
         swim_activity = cls(activity_id, HiActivity.TYPE_POOL_SWIM)
         swim_activity.start = start
-        swim_activity.stop = start + dts_delta(milliseconds=duration_millis)
+        swim_activity.stop = start + round(duration_millis * 1000)
         swim_activity.calculated_distance = distance
         lap_data = {'lap': 1,
                     'start': swim_activity.start,
@@ -189,6 +570,8 @@ class HiActivity:
             logging.getLogger(PROGRAM_NAME).info('Setting activity type of activity %s to %s',
                                                  self.activity_id, activity_type)
             self._activity_type = activity_type
+            # The laps depend on the activity type, finalize them again.
+            self._laps = None
         else:
             logging.getLogger(PROGRAM_NAME).error('Invalid activity type <%s>', activity_type)
             raise Exception('Invalid activity type <%s>', activity_type)
@@ -196,12 +579,15 @@ class HiActivity:
     def set_pool_length(self, pool_length: int):
         logging.getLogger(PROGRAM_NAME).info('Setting pool length of activity %s to %d', self.activity_id, pool_length)
         self.pool_length = pool_length
-        if not self.get_activity_type() == self.TYPE_POOL_SWIM:
+        if self.get_activity_type() == self.TYPE_POOL_SWIM:
+            # The swim laps are calculated using the pool length, finalize them again.
+            self._laps = None
+        else:
             logging.getLogger(PROGRAM_NAME).warning(
                 'Pool length for activity %s of type %s will not be used. It is not a pool swimming activity',
                 self.activity_id, self._activity_type)
 
-    def _add_segment_start(self, segment_start: dts):
+    def _add_segment_start(self, segment_start: int):
         if self._current_segment:
             logging.getLogger(PROGRAM_NAME).error(
                 'Request to start segment at %s when there is already a current segment active', segment_start)
@@ -219,7 +605,7 @@ class HiActivity:
             # Set activity start
             self.start = segment_start
 
-    def _add_segment_stop(self, segment_stop: dts, segment_distance: int = -1):
+    def _add_segment_stop(self, segment_stop: int, segment_distance: int = -1):
         logging.getLogger(PROGRAM_NAME).debug('Adding segment stop at %s', segment_stop)
         if not self._current_segment:
             logging.getLogger(PROGRAM_NAME).error(
@@ -228,7 +614,8 @@ class HiActivity:
 
         # Set stop of current segment, add it to the segment list and clear the current segment
         self._current_segment['stop'] = segment_stop
-        self._current_segment['duration'] = int((segment_stop - self._current_segment['start']).total_seconds())
+        self._current_segment['duration'] = int((segment_stop - self._current_segment['start']) /
+                                                _MICROSECONDS_PER_SECOND)
         if not segment_distance == -1:
             self._current_segment['distance'] = segment_distance
         else:
@@ -236,8 +623,26 @@ class HiActivity:
 
         self._current_segment = None
 
+    def _decode_record_data(self, data: list, description: str, fields: tuple) -> list:
+        """ Returns the values of the fields (name, value type) from the [name, value] pairs of a HiTrack record """
+        try:
+            record_data = dict(data)
+            return [value_type(record_data[name]) for name, value_type in fields]
+        except Exception as e:
+            logging.getLogger(PROGRAM_NAME).error(
+                'One or more required data fields (%s) missing or invalid in %s data %s\n%s',
+                ', '.join(name for name, _ in fields), description, data, e)
+            raise Exception('One or more required data fields (%s) missing or invalid in %s data %s',
+                            ', '.join(name for name, _ in fields), description, data)
+
     # TODO Verify if something useful can be done with the (optional) altitude data in the tp=lbs records
     def add_location_data(self, data: list):
+        """ Add location data from the [name, value] pairs of a tp=lbs record in a HiTrack file
+        (see _add_location_data) """
+        self._add_location_data(*self._decode_record_data(data, 'location',
+                                                          (('t', float), ('lat', float), ('lon', float))))
+
+    def _add_location_data(self, t: float, lat: float, lon: float):
         """ Add location data from a tp=lbs record in the HiTrack file.
         Information:
         - When tracking an activity with a mobile phone only, the HiTrack files seem to contain altitude
@@ -253,39 +658,25 @@ class HiActivity:
         - Pause and stop records are identified by tp=lbs;lat=90;lon=-80;alt=0;t=<valid epoch time value or zero>
         """
 
-        logging.getLogger(PROGRAM_NAME).debug('Adding location data %s', data)
-
-        try:
-            # Create a dictionary from the key value pairs
-            location_data = dict(data)
-
-            # All raw values are floats (timestamp will be converted later)
-            for keys in location_data:
-                location_data[keys] = float(location_data[keys])
-        except Exception as e:
-            logging.getLogger(PROGRAM_NAME).error(
-                'One or more required data fields (t, lat, lon) missing or invalid in location data %s\n%s', data, e)
-            raise Exception('One or more required data fields (t, lat, lon) missing or invalid in location data %s',
-                            data)
-
-        if location_data['t'] == 0 and location_data['lat'] == 90 and location_data['lon'] == -80:
+        # All raw values are floats (timestamp will be converted later)
+        if t == 0 and lat == 90 and lon == -80:
             # Pause/stop record without a valid epoch timestamp. Set it to the last timestamp recorded
-            location_data['t'] = self.stop
-        elif location_data['t'] == 0 and location_data['lat'] == 0 and location_data['lon'] == 0:
+            t = self.stop
+        elif t == 0 and lat == 0 and lon == 0:
             # Exception (Guess) - this type of record seems to be generated once at the start of the activtiy when no GPS data is available.
             # Set the start timestamp (only possible in case of json or zip conversion).
             logging.getLogger(PROGRAM_NAME).debug('Found zero location record. Setting activity start to reference %s', self.start_timestamp_ref)
             self.start = self.start_timestamp_ref
         else:
             # Regular location record or pause/stop record with valid epoch timestamp or seconds since start of day.
-            # Convert the timestamp to a datetime
-            location_data['t'] = _convert_hitrack_timestamp(location_data['t'], timestamp_ref=self.timestamp_ref)
+            # Convert the timestamp to microseconds since epoch
+            t = self._location_timestamps.convert(t)
 
             self.activity_params['gps'] = True
 
         # Only add location data with a valid timestamp (ignore GPS loss or pause records at start of the location data)
-        if location_data['t']:
-            self._add_data_detail(location_data)
+        if t:
+            self._add_data_detail({'t': t, 'lat': lat, 'lon': lon})
 
     def _get_last_location(self) -> Optional[dict]:
         """ Returns the last location record in the data dictionary """
@@ -373,79 +764,70 @@ class HiActivity:
         return round(s, 6)
 
     def add_heart_rate_data(self, data: list):
+        """ Add heart rate data from the [name, value] pairs of a tp=h-r record in a HiTrack file
+        (see _add_heart_rate_data) """
+        self._add_heart_rate_data(*self._decode_record_data(data, 'heart rate', (('k', float), ('v', int))))
+
+    def _add_heart_rate_data(self, k: float, v: int):
         """Add heart rate data from a tp=h-r record in the HiTrack file
         """
-        # Create a dictionary from the key value pairs
-        logging.getLogger(PROGRAM_NAME).debug('Adding heart rate data %s', data)
+        # Use unique keys k -> t and v -> hr
+        t = self._timestamps['h-r'].convert(k)
 
-        try:
-            hr_data = dict(data)
-            # Use unique keys. Update keys k -> t and v -> hr
-            hr_data['t'] = _convert_hitrack_timestamp(float(hr_data.pop('k')))
-            hr_data['hr'] = int(hr_data.pop('v'))
-
-            # Ignore invalid heart rate data (for export)
-            if hr_data['hr'] < 1 or hr_data['hr'] > 254:
-                logging.getLogger(PROGRAM_NAME).warning('Invalid heart rate data detected and ignored in data %s', data)
-        except Exception as e:
-            logging.getLogger(PROGRAM_NAME).error(
-                'One or more required data fields (k, v) missing or invalid in heart rate data %s\n%s', data, e)
-            raise Exception('One or more required data fields (k, v) missing or invalid in heart rate data %s\n%s',
-                            data)
+        # Ignore invalid heart rate data (for export)
+        if v < 1 or v > 254:
+            logging.getLogger(PROGRAM_NAME).warning('Invalid heart rate data detected and ignored in data k=%s v=%s',
+                                                    k, v)
 
         # Add heart rate data
-        self._add_data_detail(hr_data)
+        self._add_data_detail({'t': t, 'hr': v})
 
     def add_cadence_data(self, data: list):
+        """ Add cadence data from the [name, value] pairs of a tp=cad record in a HiTrack file
+        (see _add_cadence_data) """
+        self._add_cadence_data(*self._decode_record_data(data, 'cadence', (('k', float), ('v', int))))
+
+    def _add_cadence_data(self, k: float, v: int):
         """Add cadence data from a tp=cad record in the HiTrack file"""
-        logging.getLogger(PROGRAM_NAME).debug('Adding cadence data %s', data)
+        # Use unique keys k -> t and v -> cad
+        t = self._timestamps['cad'].convert(k)
 
-        try:
-            cad_data = dict(data)
-            # Use unique keys. Update keys k -> t and v -> cad
-            cad_data['t'] = _convert_hitrack_timestamp(float(cad_data.pop('k')))
-            cad_data['cad'] = int(cad_data.pop('v'))
-
-            # Ignore invalid cadence data (for export)
-            if cad_data['cad'] < 0 or cad_data['cad'] > 254:
-                logging.getLogger(PROGRAM_NAME).warning('Invalid cadence data detected and ignored in data %s', data)
-                return
-        except Exception as e:
-            logging.getLogger(PROGRAM_NAME).error(
-                'One or more required data fields (k, v) missing or invalid in cadence data %s\n%s', data, e)
-            raise Exception('One or more required data fields (k, v) missing or invalid in cadence data %s\n%s',
-                            data)
+        # Ignore invalid cadence data (for export)
+        if v < 0 or v > 254:
+            logging.getLogger(PROGRAM_NAME).warning('Invalid cadence data detected and ignored in data k=%s v=%s',
+                                                    k, v)
+            return
 
         # Add cadence data
-        self._add_data_detail(cad_data)
+        self._add_data_detail({'t': t, 'cad': v})
 
     def add_altitude_data(self, data: list):
-        """Add altitude data from a tp=alt or tp=alti record in a HiTrack file"""
-        # Create a dictionary from the key value pairs
-        logging.getLogger(PROGRAM_NAME).debug('Adding altitude data %s', data)
+        """ Add altitude data from the [name, value] pairs of a tp=alt or tp=alti record in a HiTrack file
+        (see _add_altitude_data) """
+        self._add_altitude_data(*self._decode_record_data(data, 'altitude', (('k', float), ('v', float))))
 
-        try:
-            alti_data = dict(data)
-            # Use unique keys. Update keys k -> t and v -> hr
-            alti_data['t'] = _convert_hitrack_timestamp(float(alti_data.pop('k')))
-            alti_data['alti'] = float(alti_data.pop('v'))
-
-            # Ignore invalid altitude data
-            if alti_data['alti'] < -1000 or alti_data['alti'] > 10000:
-                logging.getLogger(PROGRAM_NAME).warning('Invalid altitude data detected and ignored in data %s', data)
-                return
+    def _add_altitude_data(self, k: float, v: float):
+        """Add altitude data from a tp=alt or tp=alti record in a HiTrack file"""
+        # Use unique keys k -> t and v -> alti
+        t = self._timestamps['alti'].convert(k)
 
-        except Exception as e:
-            logging.getLogger(PROGRAM_NAME).error(
-                'One or more required data fields (k, v) missing or invalid in altitude data %s\n%s', data, e)
-            raise Exception('One or more required data fields (k, v) missing or invalid in altitude data %s\n%s', data)
+        # Ignore invalid altitude data
+        if v < -1000 or v > 10000:
+            logging.getLogger(PROGRAM_NAME).warning('Invalid altitude data detected and ignored in data k=%s v=%s',
+                                                    k, v)
+            return
 
         # Add altitude data
-        self._add_data_detail(alti_data)
+        self._add_data_detail({'t': t, 'alti': v})
 
     # TODO Further verification of assumptions and testing required related to auto activity type detection
     # TODO For activities that were tracked using a phone only without a fitness device, there are no s-r records. Hence, in these cases auto detection should use a 'fallback mode' e.g. by using the p-m records (and assume that swimming activities with phone only won't occur)
     def add_step_frequency_data(self, data: list):
+        """ Add step frequency data from the [name, value] pairs of a tp=s-r record in a HiTrack file
+        (see _add_step_frequency_data) """
+        self._add_step_frequency_data(*self._decode_record_data(data, 'step frequency', (('k', float), ('v', int))))
+
+    def _add_step_frequency_data(self, k: float, v: int):
         """Add step frequency data from a tp=s-r record in a HiTrack file.
         The unit of measure of the step frequency is steps/minute.
          Assumptions:
@@ -455,186 +837,365 @@ class HiActivity:
            the start of a new segments for swimming.
          """
 
-        logging.getLogger(PROGRAM_NAME).debug(
-            'Adding step frequency data or detecting cycling or swimming activities %s',
-            data)
-
-        try:
-            # Create a dictionary from the key value pairs
-            step_freq_data = dict(data)
-            # Use unique keys. Update keys k -> t and v -> s_r
-            step_freq_data['t'] = _convert_hitrack_timestamp(float(step_freq_data.pop('k')))
-            step_freq_data['s-r'] = int(step_freq_data.pop('v'))
-        except Exception as e:
-            logging.getLogger(PROGRAM_NAME).error(
-                'One or more required data fields (k, v) missing or invalid in step frequency data %s\n%s', data, e)
-            raise Exception('One or more required data fields (k, v) missing or invalid in step frequency data %s\n%s',
-                            data)
+        # Use unique keys k -> t and v -> s-r
+        t = self._timestamps['s-r'].convert(k)
 
         # Keep track of minimum, maximum and average step frequency data for activity type auto-detection.
         # Ignore negative values since these belong to swimming activities and are not important to recognize the
         # swimming activity.
-        if step_freq_data['s-r'] >= 0:
+        if v >= 0:
             if 'step frequency min' not in self.activity_params:
-                self.activity_params['step frequency min'] = step_freq_data['s-r']
-                self.activity_params['step frequency max'] = step_freq_data['s-r']
+                self.activity_params['step frequency min'] = v
+                self.activity_params['step frequency max'] = v
                 self.activity_params['step frequency data'] = []
-            elif step_freq_data['s-r'] < self.activity_params['step frequency min']:
-                self.activity_params['step frequency min'] = step_freq_data['s-r']
-            elif step_freq_data['s-r'] > self.activity_params['step frequency max']:
-                self.activity_params['step frequency max'] = step_freq_data['s-r']
+            elif v < self.activity_params['step frequency min']:
+                self.activity_params['step frequency min'] = v
+            elif v > self.activity_params['step frequency max']:
+                self.activity_params['step frequency max'] = v
 
             # Add step frequency data detail to activity parameters for later average step frequency calculation.
-            self.activity_params['step frequency data'].append(step_freq_data['s-r'])
+            self.activity_params['step frequency data'].append(v)
 
         # Add step frequency data.
-        self._add_data_detail(step_freq_data)
+        self._add_data_detail({'t': t, 's-r': v})
 
     def add_swolf_data(self, data: list):
+        """ Add SWOLF data from the [name, value] pairs of a tp=swf record in a HiTrack file (see _add_swolf_data) """
+        self._add_swolf_data(*self._decode_record_data(data, 'SWOLF', (('k', int), ('v', int))))
+
+    def _add_swolf_data(self, k: int, v: int):
         """ Add SWOLF (swimming) data from a tp=swf record in a HiTrack file
         SWOLF value = time to swim one pool length + number of strokes
         """
 
-        logging.getLogger(PROGRAM_NAME).debug('Adding SWOLF swim data %s', data)
+        # Ignore records (with relative timestamp) before at least 1 record with an absolute timestamp is processed.
+        if not self.start:
+            logging.getLogger(PROGRAM_NAME).warning('Ignored SWOLF record at relative time <%s> before first ' +
+                                                    'record with absolute time.', k)
+            return
 
-        try:
-            # Create a dictionary from the key value pairs
-            swolf_data = dict(data)
+        # Use unique keys k -> t and v -> swf
+        # Time of SWOLF swimming data is relative to activity start.
+        # The first record with k=0 is the value registered after 5 seconds of activity.
+        swolf_data = {'t': self.start + (k + 5) * _MICROSECONDS_PER_SECOND, 'swf': v}
 
-            # Ignore records (with relative timestamp) before at least 1 record with an absolute timestamp is processed.
-            if not self.start:
-                logging.getLogger(PROGRAM_NAME).warning('Ignored SWOLF record at relative time <%s> before first ' +
-                                                        'record with absolute time.', swolf_data.pop('k'))
-                return
+        self.activity_params['swim'] = True
 
-            # Use unique keys. Update keys k -> t and v -> swf
-            # Time of SWOLF swimming data is relative to activity start.
-            # The first record with k=0 is the value registered after 5 seconds of activity.
-            swolf_data['t'] = self.start + dts_delta(seconds=int(swolf_data.pop('k')) + 5)
-            swolf_data['swf'] = int(swolf_data.pop('v'))
-
-            self.activity_params['swim'] = True
-
-            # If there is no last swf record or the last added swf record had a different swf value, then this record
-            # belongs to a new lap (segment)
-            # TODO There is a chance that checking on SWOLF only might miss a lap in case two consecutive laps have the same SWOLF (but then again, chances are that stroke and speed data are also identical)
-            # TODO Since SWOLF value contains both time and strokes, add extra check to not process consecutive same time laps beyond the SWOLF value.
-            if not self._current_segment:
-                # First record of first lap. Start new segment (lap)
-                self._add_segment_start(swolf_data['t'] - dts_delta(seconds=5))
-            else:
-                if self.last_swolf_data['swf'] != swolf_data['swf']:
-                    # New lap detected.
-                    # Close segment of previous lap. Since the current lap starts at the exact same time
-                    self._current_segment['stop'] = self.last_swolf_data['t']
-                    self._current_segment = None
-                    # Open new segment for this lap. End of previous lap is start of current lap.
-                    # Add 1 microsecond to split the lap data correctly.
-                    self._add_segment_start(swolf_data['t'] + dts_delta(microseconds=1))
-
-            # Remember this SWOLF data as last parsed SWOLF data.
-            self.last_swolf_data = swolf_data
-        except Exception as e:
-            logging.getLogger(PROGRAM_NAME).error(
-                'One or more required data fields (k, v) missing or invalid in SWOLF data %s\n%s', data, e)
-            raise Exception('One or more required data fields (k, v) missing or invalid in SWOLF data %s\n%s', data)
+        # If there is no last swf record or the last added swf record had a different swf value, then this record
+        # belongs to a new lap (segment)
+        # TODO There is a chance that checking on SWOLF only might miss a lap in case two consecutive laps have the same SWOLF (but then again, chances are that stroke and speed data are also identical)
+        # TODO Since SWOLF value contains both time and strokes, add extra check to not process consecutive same time laps beyond the SWOLF value.
+        if not self._current_segment:
+            # First record of first lap. Start new segment (lap)
+            self._add_segment_start(swolf_data['t'] - 5 * _MICROSECONDS_PER_SECOND)
+        else:
+            if self.last_swolf_data['swf'] != swolf_data['swf']:
+                # New lap detected.
+                # Close segment of previous lap. Since the current lap starts at the exact same time
+                self._current_segment['stop'] = self.last_swolf_data['t']
+                self._current_segment = None
+                # Open new segment for this lap. End of previous lap is start of current lap.
+                # Add 1 microsecond to split the lap data correctly.
+                self._add_segment_start(swolf_data['t'] + 1)
+
+        # Remember this SWOLF data as last parsed SWOLF data.
+        self.last_swolf_data = swolf_data
 
         # Add SWOLF data
         self._add_data_detail(swolf_data)
 
     def add_stroke_frequency_data(self, data: list):
-        """ Add stroke frequency (swimming) data (in strokes/minute) from a tp=p-f record in a HiTrack file """
+        """ Add stroke frequency data from the [name, value] pairs of a tp=p-f record in a HiTrack file
+        (see _add_stroke_frequency_data) """
+        self._add_stroke_frequency_data(*self._decode_record_data(data, 'stroke frequency', (('k', int), ('v', int))))
 
-        logging.getLogger(PROGRAM_NAME).debug('Adding stroke frequency swim data %s', data)
+    def _add_stroke_frequency_data(self, k: int, v: int):
+        """ Add stroke frequency (swimming) data (in strokes/minute) from a tp=p-f record in a HiTrack file """
 
-        try:
-            # Create a dictionary from the key value pairs
-            stroke_freq_data = dict(data)
-
-            # Ignore records (with relative timestamp) before at least 1 record with an absolute timestamp is processed.
-            if not self.start:
-                logging.getLogger(PROGRAM_NAME).warning('Ignored stroke frequency record at relative time <%s> ' +
-                                                        'before first record with absolute time.',
-                                                        stroke_freq_data.pop('k'))
-                return
+        # Ignore records (with relative timestamp) before at least 1 record with an absolute timestamp is processed.
+        if not self.start:
+            logging.getLogger(PROGRAM_NAME).warning('Ignored stroke frequency record at relative time <%s> ' +
+                                                    'before first record with absolute time.', k)
+            return
 
-            # Use unique keys. Update keys k -> t and v -> p-f
-            # Time of stroke frequency swimming data is relative to activity start.
-            # The first record with k=0 is the value registered after 5 seconds of activity.
-            stroke_freq_data['t'] = self.start + dts_delta(seconds=int(stroke_freq_data.pop('k')) + 5)
-            stroke_freq_data['p-f'] = int(stroke_freq_data.pop('v'))
-        except Exception as e:
-            logging.getLogger(PROGRAM_NAME).error(
-                'One or more required data fields (k, v) missing or invalid in stroke frequency data %s\n%s', data, e)
-            raise Exception(
-                'One or more required data fields (k, v) missing or invalid in stroke frequency data %s\n%s', data)
+        # Use unique keys k -> t and v -> p-f
+        # Time of stroke frequency swimming data is relative to activity start.
+        # The first record with k=0 is the value registered after 5 seconds of activity.
+        stroke_freq_data = {'t': self.start + (k + 5) * _MICROSECONDS_PER_SECOND, 'p-f': v}
 
         # Add stroke frequency data
         self._add_data_detail(stroke_freq_data)
 
     def add_speed_data(self, data: list):
-        """ Add speed data (in decimeter/second) from a tp=rs record in a HiTrack file """
+        """ Add speed data from the [name, value] pairs of a tp=rs record in a HiTrack file (see _add_speed_data) """
+        self._add_speed_data(*self._decode_record_data(data, 'speed', (('k', int), ('v', float))))
 
-        logging.getLogger(PROGRAM_NAME).debug('Adding speed data %s', data)
-
-        try:
-            # Create a dictionary from the key value pairs
-            speed_data = dict(data)
+    def _add_speed_data(self, k: int, v: float):
+        """ Add speed data (in decimeter/second) from a tp=rs record in a HiTrack file """
 
-            # Ignore records (with relative timestamp) before at least 1 record with an absolute timestamp is processed.
-            if not self.start:
-                logging.getLogger(PROGRAM_NAME).warning('Ignored speed record at relative time <%s> before ' +
-                                                        'first record with absolute time.', speed_data.pop('k'))
-                return
+        # Ignore records (with relative timestamp) before at least 1 record with an absolute timestamp is processed.
+        if not self.start:
+            logging.getLogger(PROGRAM_NAME).warning('Ignored speed record at relative time <%s> before ' +
+                                                    'first record with absolute time.', k)
+            return
 
-            # Use unique keys. Update keys k -> t and v -> p-f
-            # Time of speed data is relative to activity start.
-            # The first record with k=0 is the value registered after 5 seconds of activity.
-            speed_data['t'] = self.start + dts_delta(seconds=int(speed_data.pop('k')) + 5)
-            speed_data['rs'] = float(speed_data.pop('v'))
+        # Use unique keys k -> t and v -> rs
+        # Time of speed data is relative to activity start.
+        # The first record with k=0 is the value registered after 5 seconds of activity.
+        speed_data = {'t': self.start + (k + 5) * _MICROSECONDS_PER_SECOND, 'rs': v}
 
-            # Ignore invalid speed data records (negative speed value, e.g. for indoor (cycling) activities)
-            if speed_data['rs'] < 0:
-                return
-        except Exception as e:
-            logging.getLogger(PROGRAM_NAME).error(
-                'One or more required data fields (k, v) missing or invalid in speed data %s\n%s', data, e)
-            raise Exception('One or more required data fields (k, v) missing or invalid in speed data %s\n%s', data)
+        # Ignore invalid speed data records (negative speed value, e.g. for indoor (cycling) activities)
+        if speed_data['rs'] < 0:
+            return
 
         # Add speed data
         self._add_data_detail(speed_data)
 
     def _add_data_detail(self, data: dict):
+        if self._laps is not None:
+            logging.getLogger(PROGRAM_NAME).error('Request to add data at %s to activity %s after it was finalized',
+                                                  data['t'], self.activity_id)
+            raise Exception('Request to add data at %s to activity %s after it was finalized', data['t'],
+                            self.activity_id)
+
+        # Invalidate the timestamp index
+        self._timestamp_index = None
+
         # Add the data to the data dictionary.
-        if data['t'] not in self.data_dict:
+        t = data['t']
+        record = self.data_dict.get(t)
+        if record is None:
             # No data for timestamp. Create a new record for it.
-            self.data_dict[data['t']] = data
+            self.data_dict[t] = data
         else:
             # Existing data for timestamp. Add the new data to the existing record.
-            self.data_dict[data['t']].update(data)
+            record.update(data)
 
         # Records are NOT necessarily in chronological order.
         # Update start of the activity when a record with an earlier timestamp is added.
-        if not self.start or self.start > data['t']:
-            self.start = data['t']
+        if not self.start or self.start > t:
+            self.start = t
         # Update stop of the activity when a record with a later timestamp is added.
-        if not self.stop or self.stop < data['t']:
-            self.stop = data['t']
+        if not self.stop or self.stop < t:
+            self.stop = t
+
+    def _sort_data_dict(self):
+        """ Sorts the data dictionary by timestamp and builds the timestamp index used to look up segment data by
+        bisection. Only sorts (again) when data was added after the previous sort. """
+        if self._timestamp_index is not None:
+            return
+        if isinstance(self.data_dict, HiColumnarDataDict):
+            self.data_dict.sort()
+            self._timestamp_index = self.data_dict.timestamps()
+            self._record_index = self.data_dict.records()
+        else:
+            self.data_dict = collections.OrderedDict(sorted(self.data_dict.items()))
+            self._timestamp_index = list(self.data_dict.keys())
+            self._record_index = list(self.data_dict.values())
+
+    # Binary encoding of a parsed activity (see encode). Bump the version with every change of the format.
+    _ENCODING_MAGIC = b'HiAc'
+    _ENCODING_VERSION = 1
+    _ENCODING_HEADER = struct.Struct('<4sHI')  # Magic, format version, length of the JSON header
+
+    def encode(self) -> bytes:
+        """ Returns the parsed activity in a compact binary format: a fixed header, a JSON header with the attributes,
+        segments and swim laps of the activity, followed by the detail data as one timestamp array and per data channel
+        a typed value array and a mask (the layout of HiColumnarDataDict). Values without a channel are stored in the
+        JSON header. The parse state (timestamp converters, last SWOLF record) and the timestamp index are not stored.
+        """
+        if isinstance(self.data_dict, HiColumnarDataDict):
+            count = len(self.data_dict._t)
+            timestamps = self.data_dict._t
+            channels = self.data_dict._channels
+            masks = self.data_dict._masks
+            extra = self.data_dict._extra
+            data_sorted = self.data_dict._sorted
+        else:
+            count = len(self.data_dict)
+            timestamps = array.array('q', self.data_dict.keys())
+            channels = {channel: array.array(type_code, bytes(count * array.array(type_code).itemsize))
+                        for channel, type_code in HiColumnarDataDict._CHANNELS.items()}
+            masks = {channel: bytearray(count) for channel in HiColumnarDataDict._CHANNELS}
+            extra = {}
+            data_sorted = False
+            for i, data in enumerate(self.data_dict.values()):
+                for channel, value in data.items():
+                    if channel == 't':
+                        continue
+                    type_code = HiColumnarDataDict._CHANNELS.get(channel)
+                    if type_code == 'd' and type(value) is float:
+                        mask = HiColumnarDataDict._PRESENT
+                    elif type_code == 'd' and type(value) is int and abs(value) < 2 ** 53:
+                        mask = HiColumnarDataDict._PRESENT_INT
+                    elif type_code == 'i' and type(value) is int and -2 ** 31 <= value < 2 ** 31:
+                        mask = HiColumnarDataDict._PRESENT
+                    else:
+                        extra.setdefault(i, {})[channel] = value
+                        continue
+                    channels[channel][i] = value
+                    masks[channel][i] = mask
+
+        # Channels without any value are left out
+        used_channels = [channel for channel in HiColumnarDataDict._CHANNELS if any(masks[channel])]
+        header = {'activity_id': self.activity_id,
+                  'activity_type': self._activity_type,
+                  'activity_params': self.activity_params,
+                  'pool_length': self.pool_length,
+                  'start': self.start,
+                  'stop': self.stop,
+                  'time_zone': None if self.time_zone is None else self.time_zone.utcoffset(None) // _ONE_MICROSECOND,
+                  'distance': self.distance,
+                  'calculated_distance': self.calculated_distance,
+                  'calories': self.calories,
+                  'segments': self._segment_list,
+                  'current_segment': None if self._current_segment is None
+                  else next(n for n, segment in enumerate(self._segment_list) if segment is self._current_segment),
+                  'swim_data': self.swim_data,
+                  'timestamp_ref': None if self.timestamp_ref is None else self.timestamp_ref.isoformat(),
+                  'start_timestamp_ref': self.start_timestamp_ref,
+                  'distance_method': self.distance_method,
+                  'columnar_store': isinstance(self.data_dict, HiColumnarDataDict),
+                  'sorted': data_sorted,
+                  'count': count,
+                  'channels': [[channel, channels[channel].typecode, channels[channel].itemsize]
+                               for channel in used_channels],
+                  'extra': {str(i): values for i, values in extra.items()}}
+        header_bytes = json.dumps(header, separators=(',', ':')).encode('utf-8')
+
+        encoded = bytearray(self._ENCODING_HEADER.pack(self._ENCODING_MAGIC, self._ENCODING_VERSION,
+                                                       len(header_bytes)))
+        encoded += header_bytes
+        for values in [timestamps] + [channels[channel] for channel in used_channels]:
+            if sys.byteorder == 'big':
+                values = array.array(values.typecode, values)
+                values.byteswap()
+            encoded += values.tobytes()
+        for channel in used_channels:
+            encoded += masks[channel]
+        return bytes(encoded)
 
-    def get_segments(self) -> list:
-        """ Returns the segment list.
+    @classmethod
+    def decode(cls, encoded: bytes):
+        """ Returns the parsed activity from its binary format (see encode) """
+        magic, version, header_length = cls._ENCODING_HEADER.unpack_from(encoded)
+        if magic != cls._ENCODING_MAGIC or version != cls._ENCODING_VERSION:
+            raise Exception('Unsupported encoded activity format <%s> version <%d>', magic, version)
+        offset = cls._ENCODING_HEADER.size
+        header = json.loads(encoded[offset:offset + header_length].decode('utf-8'))
+        offset += header_length
+
+        hi_activity = cls(header['activity_id'],
+                          timestamp_ref=None if header['timestamp_ref'] is None
+                          else dts.fromisoformat(header['timestamp_ref']),
+                          columnar_store=header['columnar_store'], distance_method=header['distance_method'])
+        hi_activity._activity_type = header['activity_type']
+        hi_activity.activity_params = header['activity_params']
+        hi_activity.pool_length = header['pool_length']
+        hi_activity.start = header['start']
+        hi_activity.stop = header['stop']
+        hi_activity.time_zone = None if header['time_zone'] is None \
+            else tz(dts_delta(microseconds=header['time_zone']))
+        hi_activity.distance = header['distance']
+        hi_activity.calculated_distance = header['calculated_distance']
+        hi_activity.calories = header['calories']
+        hi_activity._segment_list = header['segments']
+        if header['current_segment'] is not None:
+            hi_activity._current_segment = hi_activity._segment_list[header['current_segment']]
+        hi_activity.swim_data = header['swim_data']
+        hi_activity.start_timestamp_ref = header['start_timestamp_ref']
+
+        count = header['count']
+
+        def read_array(type_code: str, itemsize: int) -> array.array:
+            nonlocal offset
+            values = array.array(type_code)
+            if values.itemsize != itemsize:
+                raise Exception('Unsupported item size <%d> of array type <%s>', itemsize, type_code)
+            values.frombytes(encoded[offset:offset + count * itemsize])
+            if len(values) != count:
+                raise Exception('Truncated encoded activity <%s>', header['activity_id'])
+            if sys.byteorder == 'big':
+                values.byteswap()
+            offset += count * itemsize
+            return values
+
+        timestamps = read_array('q', 8)
+        channels = {channel: read_array(type_code, itemsize) for channel, type_code, itemsize in header['channels']}
+        masks = {}
+        for channel in channels:
+            masks[channel] = bytearray(encoded[offset:offset + count])
+            offset += count
+        if len(encoded) != offset:
+            raise Exception('Invalid length of encoded activity <%s>', header['activity_id'])
+        extra = {int(i): values for i, values in header['extra'].items()}
+
+        if header['columnar_store']:
+            data_dict = hi_activity.data_dict
+            data_dict._t = timestamps
+            for channel, type_code in HiColumnarDataDict._CHANNELS.items():
+                if channel in channels:
+                    data_dict._channels[channel] = channels[channel]
+                    data_dict._masks[channel] = masks[channel]
+                else:
+                    data_dict._channels[channel] = array.array(type_code, bytes(count * array.array(type_code).itemsize))
+                    data_dict._masks[channel] = bytearray(count)
+            data_dict._extra = extra
+            data_dict._sorted = header['sorted']
+            if not data_dict._sorted:
+                data_dict._index = {k: n for n, k in enumerate(timestamps)}
+        else:
+            for i, t in enumerate(timestamps):
+                data = {'t': t}
+                for channel, values in channels.items():
+                    mask = masks[channel][i]
+                    if mask != HiColumnarDataDict._ABSENT:
+                        data[channel] = int(values[i]) if mask == HiColumnarDataDict._PRESENT_INT else values[i]
+                if i in extra:
+                    data.update(extra[i])
+                hi_activity.data_dict[t] = data
+        return hi_activity
+
+    def get_segments(self) -> tuple:
+        """ Returns the read-only segments of the finalized activity.
             - For pool swimming activities, the segments were identified during parsing of the SWOLF data.
             - For walking, running and cycling activities, the segments must be calculated once based on the parsed
               location data. Because the location data is not (always) in chronological order (e.g. loops in the track),
               for these activities
         """
         # Make sure calculation of segments is done.
-        self._calc_segments_and_distances()
-        return self._segment_list
+        self.finalize()
+        return self._segments
+
+    def finalize(self) -> tuple:
+        """ Finalizes the activity after all data has been parsed and returns the laps of the activity: the swim laps
+        for swimming activities, the segments for all other activities. The data is sorted by timestamp once, after which
+        the segments, distances and totals are calculated in a single pass over the sorted data. The laps are returned
+        as read-only views and are kept for later calls (and for get_segments and get_swim_data) until the activity type
+        or pool length is changed. Adding data to a finalized activity raises an exception. """
+        if self._laps is not None:
+            return self._laps
+
+        self._sort_data_dict()
+        activity_type = self.get_activity_type()
+        if activity_type == self.TYPE_POOL_SWIM:
+            laps = self.swim_data if self.swim_data else self._calc_pool_swim_data()
+            # Only calculated when the segments were not identified during parsing
+            self._calc_segments_and_distances()
+        elif activity_type == self.TYPE_OPEN_WATER_SWIM:
+            laps = self._get_open_water_swim_data()
+        else:
+            self._calc_segments_and_distances()
+            laps = self._segment_list
+
+        self._laps = tuple(types.MappingProxyType(lap) for lap in laps)
+        self._segments = tuple(types.MappingProxyType(segment) for segment in self._segment_list or ())
+        return self._laps
 
     def _reset_segments(self):
         self._segment_list = None
         self._current_segment = None
+        self._laps = None
 
     def _detect_activity_type(self) -> str:
         """ Auto-detection of the activity type. Only valid when called after all data has been parsed."""
@@ -715,13 +1276,16 @@ class HiActivity:
         logging.getLogger(PROGRAM_NAME).debug('Calculating segment and distance data for activity %s', self.activity_id)
 
         # Sort the data dictionary by timestamp
-        self.data_dict = collections.OrderedDict(sorted(self.data_dict.items()))
+        self._sort_data_dict()
 
         # Do calculations
         last_location: dict|None = None
         paused = False
         segment_start_distance = 0
 
+        # Calculate the distances between the location records in one batch
+        location_distances = self._calc_location_distances()
+
         # Start first segment at earliest data found while adding the data
         self._add_segment_start(self.start)
 
@@ -757,9 +1321,8 @@ class HiActivity:
                         if paused:
                             logging.getLogger(PROGRAM_NAME).debug('Stop pause at %s in %s', data['t'], self.activity_id)
                             paused = False
-                        # Calculate and set the accumulative distance of the location record
-                        data['distance'] = self._vincenty((last_location['lat'], last_location['lon']),
-                                                          (data['lat'], data['lon'])) + last_location['distance']
+                        # Set the accumulative distance of the location record
+                        data['distance'] = location_distances[key] + last_location['distance']
                         last_location = data
                 else:
                     # First location. Set distance 0
@@ -770,7 +1333,7 @@ class HiActivity:
             elif 'rs' in data and self._activity_type != HiActivity.TYPE_OPEN_WATER_SWIM:
                 if last_location:
                     time_delta = data['t'] - last_location['t']
-                    if not paused and ('lat' not in last_location or time_delta > GPS_TIMEOUT):
+                    if not paused and ('lat' not in last_location or time_delta > _GPS_TIMEOUT_MICROSECONDS):
                         # GPS signal lost for more than the GPS timeout period. Calculate distance based on speed records
                         logging.getLogger(PROGRAM_NAME).debug(
                             'No GPS signal between %s and %s in %s. Calculating distance using speed data (%s dm/s)',
@@ -779,7 +1342,8 @@ class HiActivity:
                         if not self._current_segment:
                             self._add_segment_start(data['t'])
                             segment_start_distance = last_location['distance']
-                        data['distance'] = last_location['distance'] + (data['rs'] * time_delta.seconds / 10)
+                        data['distance'] = last_location['distance'] + \
+                                           (data['rs'] * (time_delta // _MICROSECONDS_PER_SECOND) / 10)
                         last_location = data
                 else:
                     # No location records processed and speed record available = start without GPS or no GPS at all.
@@ -818,25 +1382,59 @@ class HiActivity:
                 self.calculated_distance = 0
             self.distance = self.calculated_distance
 
-    def get_segment_data(self, segment: dict) -> list:
-        """" Returns a filtered and sorted data set containing all raw parsed data from the requested segment """
-        # Filter data
+    def _calc_location_distances(self) -> dict:
+        """ Calculates the distances between consecutive location records in one batch. Pause and stop records are
+        skipped, except when it is the first location record (as in _calc_segments_and_distances).
+        Only valid when called on the data dictionary sorted by timestamp.
+
+        :return:
+        A dictionary with key = timestamp of the location record, value = the distance from the previous location record
+        """
+        timestamps = []
+        points = []
+        for key, data in self.data_dict.items():
+            if 'lat' in data and (not points or not (data['lat'] == 90 and data['lon'] == -80)):
+                timestamps.append(key)
+                points.append((data['lat'], data['lon']))
+
+        distances = _calc_distances(points[:-1], points[1:], self.distance_method)
+        return dict(zip(timestamps[1:], distances))
+
+    def get_segment_data(self, segment: dict) -> collections.abc.Sequence:
+        """" Returns a sorted view (no copy) on all raw parsed data from the requested segment """
+        # Make sure the data is sorted and the timestamp index is available
+        self._sort_data_dict()
+
+        first = bisect.bisect_left(self._timestamp_index, segment['start'])
         if segment['stop']:
-            segment_data_dict = {k: v for k, v in self.data_dict.items()
-                                 if segment['start'] <= k <= segment['stop']}
+            last = bisect.bisect_right(self._timestamp_index, segment['stop'])
         else:
             # E.g. for swimming activities, the last segment is not closed due to no stop record nor valid record that
             # indicates the end of the activity. Return all remaining data starting from the start timestamp
-            segment_data_dict = {k: v for k, v in self.data_dict.items()
-                                 if segment['start'] <= k}
+            last = len(self._timestamp_index)
+
+        return _HiSegmentData(self._record_index, first, last)
 
-        # Sort data by timestamp (sort on key in data dictionary)
-        segment_data = [value for (key, value) in sorted(segment_data_dict.items())]
-        return segment_data
+    def get_segment_calories(self, segment: dict) -> int:
+        """ Returns the calories of a segment (or swim lap). Assumes even calorie consumption over all segments and
+        distributes the calories per segment based on the ratio segment distance / calculated total distance. For
+        (indoor) activities without distance information, a duration based ratio is used. """
+        if self.calories > 0:
+            if self.calculated_distance > 0 and segment['distance'] > 0:
+                return round(self.calories * segment['distance'] / self.calculated_distance)
+            total_duration = (self.stop - self.start) // _MICROSECONDS_PER_SECOND
+            return round(self.calories * segment['duration'] / total_duration)
+        return 0
 
     def normalize_distances(self):
-        # Make sure segment and distance data is calculated.
-        segments = self.get_segments()
+        # The distances of swimming activities are the distances of the swim laps
+        if self.get_activity_type() in (self.TYPE_POOL_SWIM, self.TYPE_OPEN_WATER_SWIM):
+            return
+
+        # Make sure segment and distance data is calculated. The segments are updated in place, the read-only views
+        # returned by get_segments and finalize reflect the normalized distances.
+        self.finalize()
+        segments = self._segment_list
 
         if self.calculated_distance == 0 or self.distance == 0 or self.calculated_distance == self.distance:
             return
@@ -852,14 +1450,9 @@ class HiActivity:
                     if 'distance' in data:
                         data['distance'] = data['distance'] / normalize_ratio
 
-    def get_swim_data(self) -> list:
-        if self.get_activity_type() == self.TYPE_POOL_SWIM:
-            if self.swim_data:
-                return self.swim_data
-            else:
-                return self._calc_pool_swim_data()
-        elif self.get_activity_type() == self.TYPE_OPEN_WATER_SWIM:
-            return self._get_open_water_swim_data()
+    def get_swim_data(self) -> collections.abc.Sequence:
+        if self.get_activity_type() in (self.TYPE_POOL_SWIM, self.TYPE_OPEN_WATER_SWIM):
+            return self.finalize()
         else:
             return []
 
@@ -871,6 +1464,7 @@ class HiActivity:
         2. Calculate the number of strokes in the lap.
            Number of strokes = stroke frequency x (last - first lqp timestamp) / 60
             3. Calculate the lap time: lap time = SWOLF - number of strokes
+        Only valid when called on the data dictionary sorted by timestamp (see finalize).
 
         :return:
         A list of lap data dictionaries containing the following data:
@@ -889,9 +1483,6 @@ class HiActivity:
 
         swim_data = []
 
-        # Sort the data dictionary by timestamp
-        self.data_dict = collections.OrderedDict(sorted(self.data_dict.items()))
-
         total_distance = 0
 
         for n, segment in enumerate(self._segment_list):
@@ -903,7 +1494,7 @@ class HiActivity:
             last_lap_record = segment_data[-1]
 
             # First record is after 5 s in lap
-            raw_data_duration = (last_lap_record['t'] - first_lap_record['t']).total_seconds() + 5
+            raw_data_duration = (last_lap_record['t'] - first_lap_record['t']) / _MICROSECONDS_PER_SECOND + 5
 
             lap_data = {}
             lap_data['lap'] = n + 1
@@ -928,7 +1519,7 @@ class HiActivity:
                 # Start of this lap is stop of previous lap
                 lap_data['start'] = swim_data[-1]['stop']
             # Stop timestamp of lap
-            lap_data['stop'] = lap_data['start'] + dts_delta(seconds=lap_data['duration'])
+            lap_data['stop'] = lap_data['start'] + round(lap_data['duration'] * _MICROSECONDS_PER_SECOND)
 
             logging.getLogger(PROGRAM_NAME).debug('Calculated swim data for lap %d : %s', n + 1, lap_data)
 
@@ -942,21 +1533,20 @@ class HiActivity:
         return swim_data
 
     def _get_open_water_swim_data(self) -> list:
-        """ Calculates the real swim (lap) data based on the raw parsed open water swim data """
+        """ Calculates the real swim (lap) data based on the raw parsed open water swim data. Only valid when called on
+        the data dictionary sorted by timestamp (see finalize). """
         logging.getLogger(PROGRAM_NAME).info('Calculating swim data for activity %s', self.activity_id)
 
         swim_data = []
 
-        # Sort the data dictionary by timestamp
-        self.data_dict = collections.OrderedDict(sorted(self.data_dict.items()))
-
         # The generated segment list based on the SWOLF data is unusable for open water swim activities.
         # Reset it and recalculate segments and distances based on the GPS location data.
         self._reset_segments()
         self._calc_segments_and_distances()
 
         # Create 1 large lap
-        lap_data = {'lap': 1, 'start': self.start, 'stop': self.stop, 'duration': (self.stop - self.start).seconds,
+        lap_data = {'lap': 1, 'start': self.start, 'stop': self.stop,
+                    'duration': (self.stop - self.start) // _MICROSECONDS_PER_SECOND,
                     'distance': self.distance}
         swim_data.append(lap_data)
 
@@ -967,24 +1557,63 @@ class HiActivity:
         to_string = self.__class__.__name__ + \
                     '\nID       : ' + self.activity_id + \
                     '\nType     : ' + self._activity_type + \
-                    '\nDate     : ' + self.start.date().isoformat() + ' (YYYY-MM-DD)' + \
-                    '\nDuration : ' + str(self.stop - self.start) + ' (H:MM:SS)' \
+                    '\nDate     : ' + _to_datetime(self.start).date().isoformat() + ' (YYYY-MM-DD)' + \
+                    '\nDuration : ' + str(dts_delta(microseconds=self.stop - self.start)) + ' (H:MM:SS)' \
                                                                     '\nDistance : ' + \
                     str(self.calculated_distance) + 'm (Huawei: ' + str(self.distance) + ' m)'
         return to_string
 
 
 class HiTrackFile:
-    """The HiTrackFile class represents a single HiTrack file. It contains all file handling and parsing methods."""
+    """The HiTrackFile class represents a single HiTrack file. It contains all file handling and parsing methods.
+    The HiTrack data is read from the file with the HiTrack filename, unless the HiTrack data is passed in memory
+    (text, bytes or a file object) in the hitrack_data parameter. The filename is then only used as activity ID."""
+
+    # Supported record types (first field of a HiTrack line) with the expected field layout, the fields to decode with
+    # their value type, the HiActivity method to add the decoded values and the description of the data for error
+    # messages. Lines with other record types are counted.
+    _RECORD_TYPES = {
+        # Location line format: tp=lbs;k=_;lat=_;lon=_;alt=_;t=_ (alt not parsed)
+        'tp=lbs': (('k', 'lat', 'lon', 'alt', 't'), (('t', float), ('lat', float), ('lon', float)),
+                   '_add_location_data', 'location'),
+        # Heart rate line format: tp=h-r;k=_;v=_
+        'tp=h-r': (('k', 'v'), (('k', float), ('v', int)), '_add_heart_rate_data', 'heart rate'),
+        # Cadence line format: tp=cad;k=_;v=_
+        'tp=cad': (('k', 'v'), (('k', float), ('v', int)), '_add_cadence_data', 'cadence'),
+        # Altitude line format: tp=alt;k=_;v=_ or tp=alti;k=_;v=_
+        'tp=alt': (('k', 'v'), (('k', float), ('v', float)), '_add_altitude_data', 'altitude'),
+        'tp=alti': (('k', 'v'), (('k', float), ('v', float)), '_add_altitude_data', 'altitude'),
+        # Step frequency (steps/minute) format: tp=s-r;k=_;v=_
+        'tp=s-r': (('k', 'v'), (('k', float), ('v', int)), '_add_step_frequency_data', 'step frequency'),
+        # SWOLF format: tp=swf;k=_;v=_
+        'tp=swf': (('k', 'v'), (('k', int), ('v', int)), '_add_swolf_data', 'SWOLF'),
+        # Stroke frequency (strokes/minute) format: tp=p-f;k=_;v=_
+        'tp=p-f': (('k', 'v'), (('k', int), ('v', int)), '_add_stroke_frequency_data', 'stroke frequency'),
+        # Speed (decimeter/second) format: tp=rs;k=_;v=_
+        'tp=rs': (('k', 'v'), (('k', int), ('v', float)), '_add_speed_data', 'speed'),
+    }
 
     def __init__(self, hitrack_filename: str, activity_type: str = HiActivity.TYPE_UNKNOWN,
-                 timestamp_ref: dts|None = None, start_timestamp_ref: dts|None = None):
+                 timestamp_ref: dts|None = None, start_timestamp_ref: dts|None = None, columnar_store: bool = False,
+                 distance_method: str = DISTANCE_VINCENTY, hitrack_data: str|bytes|IO|None = None):
         # Validate the file parameter and (try to) open the file for reading
         if not hitrack_filename:
             logging.getLogger(PROGRAM_NAME).error('Parameter HiTrack filename is missing')
 
+        self.hitrack_filename = hitrack_filename
+        self.hitrack_file = None
         try:
-            self.hitrack_file = open(hitrack_filename, 'r')
+            if hitrack_data is None:
+                self.hitrack_file = open(hitrack_filename, 'r')
+            elif isinstance(hitrack_data, str):
+                self.hitrack_file = io.StringIO(hitrack_data)
+            elif isinstance(hitrack_data, (bytes, bytearray)):
+                self.hitrack_file = io.StringIO(hitrack_data.decode('utf-8'))
+            elif isinstance(hitrack_data, io.TextIOBase):
+                self.hitrack_file = hitrack_data
+            else:
+                # Binary file object
+                self.hitrack_file = io.TextIOWrapper(hitrack_data, encoding='utf-8')
         except Exception as e:
             logging.getLogger(PROGRAM_NAME).error('Error opening HiTrack file <%s>\n%s', hitrack_filename, e)
             raise Exception('Error opening HiTrack file <%s>', hitrack_filename)
@@ -996,13 +1625,13 @@ class HiTrackFile:
         # Original HiTrack filename is: HiTrack_<12 digit start datetime><12 digit stop datetime><5 digit unknown>
         try:
             # Get start timestamp from file in seconds (10 digits)
-            self.start = _convert_hitrack_timestamp(float(os.path.basename(self.hitrack_file.name)[8:18]))
+            self.start = _convert_hitrack_timestamp(float(os.path.basename(self.hitrack_filename)[8:18]))
         except:
             self.start = None
 
         try:
             # Get stop timestamp from file in seconds (10 digits)
-            self.stop = _convert_hitrack_timestamp(float(os.path.basename(self.hitrack_file.name)[20:30]))
+            self.stop = _convert_hitrack_timestamp(float(os.path.basename(self.hitrack_filename)[20:30]))
         except:
             self.stop = None
 
@@ -1012,6 +1641,12 @@ class HiTrackFile:
         # Start timestamp reference for calculating real start timestamp in case of exception tp=lbs record with all zeros.
         self.start_timestamp_ref = start_timestamp_ref
 
+        self.columnar_store = columnar_store
+        self.distance_method = distance_method
+
+        # Number of lines per record type that is not parsed
+        self.unknown_record_types = collections.Counter()
+
     def parse(self) -> HiActivity:
         """
         Parses the HiTrack file and returns the parsed data in a HiActivity object
@@ -1020,136 +1655,325 @@ class HiTrackFile:
         if self.activity:
             return self.activity  # No need to parse a second time if the file was already parsed
 
-        logging.getLogger(PROGRAM_NAME).info('Parsing file <%s>', self.hitrack_file.name)
+        logging.getLogger(PROGRAM_NAME).info('Parsing file <%s>', self.hitrack_filename)
 
         # Create a new activity object for the file
         self.activity = HiActivity(
-            os.path.basename(self.hitrack_file.name), 
+            os.path.basename(self.hitrack_filename), 
             self.activity_type, 
             self.timestamp_ref, 
-            self.start_timestamp_ref)
+            self.start_timestamp_ref,
+            self.columnar_store,
+            self.distance_method)
 
-        data_list = []
+        decoders = {}
         line_number = 0
-        line = ''
+        fields = []
+        # Checked once per file, since logging each line of large files is expensive even when it is disabled
+        log_lines = logging.getLogger(PROGRAM_NAME).isEnabledFor(logging.DEBUG)
 
         try:
-            csv_reader = csv.reader(self.hitrack_file, delimiter=';')
-            for line_number, line in enumerate(csv_reader, start=1):
-                data_list.clear()
-                if line[0] == 'tp=lbs':  # Location line format: tp=lbs;k=_;lat=_;lon=_;alt=_;t=_
-                    for data_index in [5, 2, 3]:  # Parse parameters t, lat, lon parameters (alt not parsed)
-                        data_list.append(line[data_index].split('='))  # Parse values after the '=' character
-                    self.activity.add_location_data(data_list)
-                elif line[0] == 'tp=h-r':  # Heart rate line format: tp=h-r;k=_;v=_
-                    for data_index in [1, 2]:  # Parse parameters k (timestamp) and v (heart rate)
-                        data_list.append(line[data_index].split('='))  # Parse values after the '=' character
-                    self.activity.add_heart_rate_data(data_list)
-                elif line[0] == 'tp=cad':  # Cadence line format: tp=cad;k=_;v=_
-                    for data_index in [1, 2]:  # Parse parameters k (timestamp) and v (cadence)
-                        data_list.append(line[data_index].split('='))  # Parse values after the '=' character
-                    self.activity.add_cadence_data(data_list)
-                elif line[0] == 'tp=alt' or line[0] == 'tp=alti':  # Altitude line format: tp=alt;k=_;v=_ or tp=alti;k=_;v=_
-                    for data_index in [1, 2]:  # Parse parameters k (timestamp) and v (altitude)
-                        data_list.append(line[data_index].split('='))  # Parse values after the '=' character
-                    self.activity.add_altitude_data(data_list)
-                elif line[0] == 'tp=s-r':  # Step frequency (steps/minute) format: tp=s-r;k=_;v=_
-                    for data_index in [1, 2]:  # Parse parameters k (timestamp) and v (step frequency)
-                        data_list.append(line[data_index].split('='))  # Parse values after the '=' character
-                    self.activity.add_step_frequency_data(data_list)
-                elif line[0] == 'tp=swf':  # SWOLF format: tp=swf;k=_;v=_
-                    for data_index in [1, 2]:  # Parse parameters k (timestamp) and v (SWOLF)
-                        data_list.append(line[data_index].split('='))  # Parse values after the '=' character
-                    self.activity.add_swolf_data(data_list)
-                elif line[0] == 'tp=p-f':  # Stroke frequency (strokes/minute) format: tp=p-f;k=_;v=_
-                    for data_index in [1, 2]:  # Parse parameters k (timestamp) and v (stroke frequency)
-                        data_list.append(line[data_index].split('='))  # Parse values after the '=' character
-                    self.activity.add_stroke_frequency_data(data_list)
-                elif line[0] == 'tp=rs':  # Speed (decimeter/second) format: tp=rs;k=_;v=_
-                    for data_index in [1, 2]:  # Parse parameters k (timestamp) and v (speed)
-                        data_list.append(line[data_index].split('='))  # Parse values after the '=' character
-                    self.activity.add_speed_data(data_list)
+            for line_number, line in enumerate(self.hitrack_file, start=1):
+                fields = line.rstrip('\r\n').split(';')
+                if log_lines:
+                    logging.getLogger(PROGRAM_NAME).debug('Parsing line <%d> data %s', line_number, fields)
+                decode = decoders.get(fields[0])
+                if decode is None:
+                    if fields[0] in self._RECORD_TYPES:
+                        decode = decoders[fields[0]] = self._get_record_decoder(fields)
+                    else:
+                        if fields[0]:
+                            self.unknown_record_types[fields[0]] += 1
+                        continue
+                decode(fields)
         except Exception as e:
-            logging.getLogger(PROGRAM_NAME).error('Error parsing file <%s> at line <%d>\nCSV data: %s\n%s',
-                                                  self.hitrack_file.name, line_number, line, e)
-            raise Exception('Error parsing file <%s> at line <%d>\n%s', self.hitrack_file.name, line_number)
+            if fields and fields[0] in self._RECORD_TYPES:
+                _, decoded_fields, _, description = self._RECORD_TYPES[fields[0]]
+                error = 'One or more required data fields (%s) missing or invalid in %s data %s\n%s' % \
+                        (', '.join(name for name, _ in decoded_fields), description, fields, e)
+            else:
+                error = 'Invalid data %s\n%s' % (fields, e)
+            logging.getLogger(PROGRAM_NAME).error('Error parsing file <%s> at line <%d>\n%s',
+                                                  self.hitrack_filename, line_number, error)
+            raise Exception('Error parsing file <%s> at line <%d>\n%s', self.hitrack_filename, line_number, error)
 
         finally:
             self._close_file()
 
+        if self.unknown_record_types:
+            logging.getLogger(PROGRAM_NAME).info(
+                'Skipped %d line(s) with unsupported record types in file <%s>: %s',
+                sum(self.unknown_record_types.values()), self.hitrack_filename,
+                ', '.join('%s (%d)' % record_type_count for record_type_count in self.unknown_record_types.items()))
+
         return self.activity
 
+    def _get_record_decoder(self, fields: list) -> Callable[[list], None]:
+        """ Returns the decoder for the lines of the record type of the HiTrack line in fields. The decoder parses the
+        values of the line and adds them to the activity. The field layout is validated once, on the first line of the
+        record type in the file. If the layout is as expected, the values are sliced from their fixed positions in the
+        following lines. Otherwise, and for lines with a different number of fields, they are looked up by name. """
+        layout, decoded_fields, add_method_name, _ = self._RECORD_TYPES[fields[0]]
+        add = getattr(self.activity, add_method_name)
+
+        def decode_by_name(fields: list):
+            values = dict(field.split('=', 1) for field in fields[1:] if field)
+            add(*[value_type(values[name]) for name, value_type in decoded_fields])
+
+        if len(fields) != len(layout) + 1 \
+                or not all(field.startswith(name + '=') for field, name in zip(fields[1:], layout)):
+            logging.getLogger(PROGRAM_NAME).debug('Unexpected field layout %s for record type <%s> in file <%s>',
+                                                  fields, fields[0], self.hitrack_filename)
+            return decode_by_name
+
+        field_count = len(fields)
+        # Position in the line and length of the 'name=' prefix of each decoded field
+        positions = [(layout.index(name) + 1, len(name) + 1, value_type) for name, value_type in decoded_fields]
+        if len(positions) == 2:
+            (index_1, start_1, type_1), (index_2, start_2, type_2) = positions
+
+            def decode(fields: list):
+                if len(fields) == field_count:
+                    add(type_1(fields[index_1][start_1:]), type_2(fields[index_2][start_2:]))
+                else:
+                    decode_by_name(fields)
+        else:
+            (index_1, start_1, type_1), (index_2, start_2, type_2), (index_3, start_3, type_3) = positions
+
+            def decode(fields: list):
+                if len(fields) == field_count:
+                    add(type_1(fields[index_1][start_1:]), type_2(fields[index_2][start_2:]),
+                        type_3(fields[index_3][start_3:]))
+                else:
+                    decode_by_name(fields)
+
+        return decode
+
     def _close_file(self):
         try:
             if self.hitrack_file and not self.hitrack_file.closed:
                 self.hitrack_file.close()
-                logging.getLogger(PROGRAM_NAME).debug('HiTrack file <%s> closed', self.hitrack_file.name)
+                logging.getLogger(PROGRAM_NAME).debug('HiTrack file <%s> closed', self.hitrack_filename)
         except Exception as e:
-            logging.getLogger(PROGRAM_NAME).error('Error closing HiTrack file <%s>\n', self.hitrack_file.name, e)
+            logging.getLogger(PROGRAM_NAME).error('Error closing HiTrack file <%s>\n', self.hitrack_filename, e)
 
     def __del__(self):
         self._close_file()
 
 
+class ActivityFilter:
+    """ Selects the activities to convert of the --json, --zip and --tar options on their start date, sport and
+    activity id. The readers of the activities evaluate the filter as early as possible, on the header data of an
+    activity (e.g. the start time and sport type in the JSON data or the timestamp in the HiTrack filename) before
+    the data of the activity is decoded or read and parsed. A sport that is only known after parsing (auto-detected)
+    is filtered after parsing. The number of pruned activities is counted per stage. """
+    STAGE_HEADER = 'header'
+    STAGE_DECODED = 'decoded'
+    STAGE_PARSED = 'parsed'
+
+    _STAGE_DESCRIPTIONS = {STAGE_HEADER: 'on their header data, before decoding or reading their data',
+                           STAGE_DECODED: 'after decoding their JSON data',
+                           STAGE_PARSED: 'after parsing'}
+
+    # HiTrack filename: HiTrack_<start time><stop time><suffix>, the first 10 digits are the start time in seconds
+    _HITRACK_FILENAME_REGEX = re.compile(r'HiTrack_(\d{10})\d{10,}')
+
+    def __init__(self, from_date: datetime.date|None = datetime.date(1970, 1, 1), to_date: datetime.date|None = None,
+                 sport_types: list|None = None, activity_ids: list|None = None):
+        self.from_date = from_date
+        self.to_date = to_date
+        self.sport_types = set(sport_types) if sport_types else None
+        self.activity_ids = {self._normalize_activity_id(activity_id) for activity_id in activity_ids} \
+            if activity_ids else None
+        # The number of pruned activities per stage
+        self.pruned = collections.Counter()
+
+    @property
+    def selective(self) -> bool:
+        """ Whether the filter can prune activities. The default filter (from 1970-01-01) accepts all activities. """
+        return bool((self.from_date and self.from_date > datetime.date(1970, 1, 1)) or self.to_date or
+                    self.sport_types or self.activity_ids)
+
+    def accepts_date(self, activity_date: datetime.date, stage: str) -> bool:
+        if (self.from_date and activity_date < self.from_date) or (self.to_date and activity_date > self.to_date):
+            self.pruned[stage] += 1
+            return False
+        return True
+
+    def accepts_sport(self, activity_type: str, stage: str) -> bool:
+        """ Returns whether the sport is accepted. An unknown sport (to be detected when parsing) is accepted. """
+        if self.sport_types and activity_type != HiActivity.TYPE_UNKNOWN and activity_type not in self.sport_types:
+            self.pruned[stage] += 1
+            return False
+        return True
+
+    @classmethod
+    def _normalize_activity_id(cls, activity_id: str) -> str:
+        """ Returns a HiTrack filename activity id truncated to the start time in seconds, other ids as is """
+        match = cls._HITRACK_FILENAME_REGEX.fullmatch(activity_id)
+        return 'HiTrack_' + match.group(1) if match else activity_id
+
+    @staticmethod
+    def get_activity_ids(start_time: int, time_zone: tz|None = None) -> tuple[str, str]:
+        """ Returns the ids of the activity with the start time (in ms since epoch) to filter on: the HiTrack filename
+        truncated to the start time in seconds and the HiTrack_YYYYMMDD_HHMMSS name of the start time in the time zone
+        (default: the local time zone). """
+        return 'HiTrack_%d' % (start_time // 1000), \
+            dts.fromtimestamp(start_time / 1000, time_zone).strftime('HiTrack_%Y%m%d_%H%M%S')
+
+    @classmethod
+    def get_hitrack_file_activity_ids(cls, hitrack_filename: str) -> tuple:
+        """ Returns the ids of the activity of a HiTrack file to filter on (see get_activity_ids). The HiTrack file has
+        no time zone information, the local time zone is assumed. """
+        match = cls._HITRACK_FILENAME_REGEX.fullmatch(hitrack_filename)
+        return cls.get_activity_ids(int(match.group(1)) * 1000) if match else (hitrack_filename,)
+
+    def accepts_activity_ids(self, activity_ids: tuple, stage: str) -> bool:
+        """ Returns whether the activity with the ids (see get_activity_ids) is accepted. The activity ids to convert
+        can be given in either format. """
+        if self.activity_ids and self.activity_ids.isdisjoint(activity_ids):
+            self.pruned[stage] += 1
+            return False
+        return True
+
+    def accepts_activity(self, hi_activity: HiActivity) -> bool:
+        """ Returns whether the parsed activity is accepted. Only its sport is evaluated, the start date and activity
+        id were evaluated on the header data. """
+        if not self.sport_types or self.accepts_sport(hi_activity.get_activity_type(), self.STAGE_PARSED):
+            return True
+        logging.getLogger(PROGRAM_NAME).info('Skipped converting activity <%s> of sport %s',
+                                             hi_activity.activity_id, hi_activity.get_activity_type())
+        return False
+
+    def log(self):
+        for stage, count in self.pruned.items():
+            logging.getLogger(PROGRAM_NAME).info('Pruned %d activities %s', count, self._STAGE_DESCRIPTIONS[stage])
+
+
 class HiTarBall:
+    """The HiTarBall class represents a (compressed) tarball with HiTrack files, e.g. a phone backup. The tarball is
+    read once, sequentially, and the HiTrack files are parsed straight from the tarball. The HiTrack files are only
+    extracted to the extract directory when exporting the HiTrack data is requested."""
     _TAR_HITRACK_DIR = 'com.huawei.health/files'
     _HITRACK_FILE_START = 'HiTrack_'
 
-    def __init__(self, tarball_filename: str, extract_dir: str = OUTPUT_DIR):
+    def __init__(self, tarball_filename: str, extract_dir: str = OUTPUT_DIR, columnar_store: bool = False,
+                 distance_method: str = DISTANCE_VINCENTY, export_hitrack_data: bool = False):
         # Validate the tarball file parameter
         if not tarball_filename:
             logging.getLogger(PROGRAM_NAME).error('Parameter HiHealth tarball filename is missing')
 
         try:
-            self.tarball = tarfile.open(tarball_filename, 'r')
+            # Open the tarball as a stream, with transparent decompression (gzip, bz2, xz)
+            self.tarball = tarfile.open(tarball_filename, 'r|*')
         except Exception as e:
             logging.getLogger(PROGRAM_NAME).error('Error opening tarball file <%s>\n%s', tarball_filename, e)
             raise Exception('Error opening tarball file <%s>', tarball_filename)
 
+        self.tarball_filename = tarball_filename
         self.extract_dir = extract_dir
+        self.columnar_store = columnar_store
+        self.distance_method = distance_method
+        self.export_hitrack_data = export_hitrack_data
         self.hi_activity_list = []
 
-    def parse(self, from_date: datetime.date = datetime.date(1970, 1, 1)) -> list:
+    def parse(self, from_date: datetime.date = datetime.date(1970, 1, 1),
+              activity_filter: ActivityFilter|None = None) -> list:
+        self.hi_activity_list.extend(self.parse_iter(from_date, activity_filter))
+        return self.hi_activity_list
+
+    def parse_iter(self, from_date: datetime.date = datetime.date(1970, 1, 1),
+                   activity_filter: ActivityFilter|None = None) -> Iterator[HiActivity]:
+        """ Yields the parsed activities of the HiTrack files in the tarball one at a time. Contrary to parse(), the
+        activities are not kept, so an activity is released as soon as the caller is done with it. """
+        for hitrack_file in self.get_hitrack_files(from_date, activity_filter):
+            hi_activity = self.parse_hitrack_file(hitrack_file)
+            if hi_activity and (not activity_filter or activity_filter.accepts_activity(hi_activity)):
+                yield hi_activity
+                # Do not keep the activity alive while the next one is parsed
+                hi_activity = None
+
+    def get_hitrack_files(self, from_date: datetime.date = datetime.date(1970, 1, 1),
+                          activity_filter: ActivityFilter|None = None) -> Iterator[tuple[str, bytes]]:
+        """ Yields the path and the data of the HiTrack files to parse in the tarball. The tarball can only be read
+        once. The members of a tarball read as a stream can not be reopened or seeked, so the data of each HiTrack
+        file is read in bytes (one file at a time) when it is found. The activity filter (default: from_date only) is
+        evaluated on the HiTrack filename, the data of the HiTrack files that are filtered out is not read. """
+        if activity_filter is None:
+            activity_filter = ActivityFilter(from_date)
         try:
             # Look for HiTrack files in directory com.huawei.health/files in tarball
-            for tar_info in self.tarball.getmembers():
-                if tar_info.path.startswith(self._TAR_HITRACK_DIR) \
+            for tar_info in self.tarball:
+                if tar_info.isfile() and tar_info.path.startswith(self._TAR_HITRACK_DIR) \
                         and os.path.basename(tar_info.path).startswith(self._HITRACK_FILE_START):
                     hitrack_filename = os.path.basename(tar_info.path)
                     logging.getLogger(PROGRAM_NAME).info('Found HiTrack file <%s> in tarball <%s>',
                                                          hitrack_filename, self.tarball.name)
-                    if from_date:
-                        # Is file from or later than start date parameter?
+                    activity_ids = ActivityFilter.get_hitrack_file_activity_ids(hitrack_filename)
+                    if not activity_filter.accepts_activity_ids(activity_ids, ActivityFilter.STAGE_HEADER):
+                        logging.getLogger(PROGRAM_NAME).info('Skipped parsing HiTrack file <%s> not being one of the '
+                                                             'activities to convert.', hitrack_filename)
+                        continue
+                    if activity_filter.from_date or activity_filter.to_date:
+                        # Is file in the date range to convert?
                         hitrack_file_date = _convert_hitrack_timestamp(
                             float(hitrack_filename[
                                   len(self._HITRACK_FILE_START):len(self._HITRACK_FILE_START) + 10])).date()
-                        if hitrack_file_date >= from_date:
-                            # Parse Hitrack file from tar ball
-                            self._extract_and_parse_hitrack_file(tar_info)
-                        else:
+                        if not activity_filter.accepts_date(hitrack_file_date, ActivityFilter.STAGE_HEADER):
                             # TODO verify timezone (un)aware display date / time
                             logging.getLogger(PROGRAM_NAME).info(
-                                'Skipped parsing HiTrack file <%s> being an activity from %s before %s (YYYYMMDD).',
-                                hitrack_filename, hitrack_file_date.isoformat(), from_date.isoformat())
-                    else:
-                        # Parse HiTrack file from tar ball
-                        self._extract_and_parse_hitrack_file(tar_info)
-            return self.hi_activity_list
+                                'Skipped parsing HiTrack file <%s> being an activity from %s outside the date range '
+                                'to convert (YYYY-MM-DD).', hitrack_filename, hitrack_file_date.isoformat())
+                            continue
+
+                    hitrack_data = self._read_hitrack_file(tar_info)
+                    if hitrack_data is not None:
+                        yield tar_info.path, hitrack_data
         except Exception as e:
-            logging.getLogger(PROGRAM_NAME).error('Error parsing tarball <%s>\n%s', self.tarball.name, e)
-            raise Exception('Error parsing tarball <%s>', self.tarball.name)
+            logging.getLogger(PROGRAM_NAME).error('Error parsing tarball <%s>\n%s', self.tarball_filename, e)
+            raise Exception('Error parsing tarball <%s>', self.tarball_filename)
 
-    def _extract_and_parse_hitrack_file(self, tar_info):
+    def _read_hitrack_file(self, tar_info: tarfile.TarInfo) -> Optional[bytes]:
         try:
-            # Flatten directory structure in the TarInfo object to extract the file directly in the extraction directory
-            tar_info.name = os.path.basename(tar_info.name)
-            self.tarball.extract(tar_info, self.extract_dir)
-            hitrack_file = HiTrackFile(self.extract_dir + '/' + tar_info.path)
-            hi_activity = hitrack_file.parse()
-            self.hi_activity_list.append(hi_activity)
+            hitrack_data = self.tarball.extractfile(tar_info).read()
+            if not self.export_hitrack_data:
+                return hitrack_data
+
+            # Save a copy of the HiTrack file in the extract directory (flattening the directory structure)
+            if not os.path.exists(self.extract_dir):
+                os.makedirs(self.extract_dir)
+            with open(os.path.join(self.extract_dir, os.path.basename(tar_info.path)), 'wb') as export_file:
+                export_file.write(hitrack_data)
+            return hitrack_data
         except Exception as e:
-            logging.getLogger(PROGRAM_NAME).error('Error parsing HiTrack file <%s> in tarball <%s>',
-                                                  tar_info.path, self.tarball.name, e)
+            logging.getLogger(PROGRAM_NAME).error('Error extracting HiTrack file <%s> from tarball <%s>\n%s',
+                                                  tar_info.path, self.tarball_filename, e)
+            return None
+
+    @staticmethod
+    def get_activity_fingerprint(hitrack_file: tuple[str, bytes]) -> tuple[str, str]:
+        """ Returns the activity key (the HiTrack filename) and the content hash of a HiTrack file read in bytes """
+        hitrack_path, hitrack_data = hitrack_file
+        return os.path.basename(hitrack_path), hashlib.sha256(hitrack_data).hexdigest()
+
+    def parse_hitrack_file(self, hitrack_file: tuple[str, bytes]) -> Optional[HiActivity]:
+        """ Parses a HiTrack file from the tarball """
+        hitrack_path, hitrack_data = hitrack_file
+        try:
+            hitrack_file = HiTrackFile(hitrack_path, columnar_store=self.columnar_store,
+                                       distance_method=self.distance_method, hitrack_data=hitrack_data)
+            return hitrack_file.parse()
+        except Exception as e:
+            logging.getLogger(PROGRAM_NAME).error('Error parsing HiTrack file <%s> in tarball <%s>\n%s',
+                                                  os.path.basename(hitrack_path), self.tarball_filename, e)
+            return None
+
+    def __getstate__(self):
+        # The tarball can not be passed to the worker processes converting the activities in parallel.
+        state = self.__dict__.copy()
+        state['tarball'] = None
+        state['hi_activity_list'] = []
+        return state
 
     def _close_tarball(self):
         try:
@@ -1163,31 +1987,209 @@ class HiTarBall:
         self._close_tarball()
 
 
+class _WinZipAesReader(io.BufferedIOBase):
+    """ Reader for a WinZip AES (AE-1 or AE-2) encrypted member of a ZIP file. The member data is read, authenticated,
+    decrypted and decompressed in chunks, so the plaintext is never written to disk or held in memory as a whole.
+    Requires the pycryptodome library for the AES decryption. """
+    _AES_EXTRA_FIELD_ID = 0x9901
+    _AES_KEY_LENGTHS = {1: 16, 2: 24, 3: 32}
+    _LOCAL_FILE_HEADER = struct.Struct('<4s2B4HL2L2H')
+    _PASSWORD_VERIFIER_LENGTH = 2
+    _AUTHENTICATION_CODE_LENGTH = 10
+    _CHUNK_SIZE = 1024 * 1024
+
+    def __init__(self, zip_filename: str, zip_info: zipfile.ZipInfo, password: bytes):
+        super().__init__()
+        self.name = zip_info.filename
+        vendor_version, key_length, self._compress_type = self.get_aes_parameters(zip_info)
+        if self._compress_type not in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED):
+            logging.getLogger(PROGRAM_NAME).error('Unsupported compression method <%d> of encrypted ZIP member <%s>',
+                                                  self._compress_type, self.name)
+            raise Exception('Unsupported compression method <%d> of encrypted ZIP member <%s>', self._compress_type,
+                            self.name)
+
+        self._zip_file = open(zip_filename, 'rb')
+        try:
+            # Skip the local file header to the encrypted data: salt, password verifier, data, authentication code
+            self._zip_file.seek(zip_info.header_offset)
+            local_file_header = self._LOCAL_FILE_HEADER.unpack(self._zip_file.read(self._LOCAL_FILE_HEADER.size))
+            self._zip_file.seek(local_file_header[-2] + local_file_header[-1], io.SEEK_CUR)
+            salt = self._zip_file.read(key_length // 2)
+            password_verifier = self._zip_file.read(self._PASSWORD_VERIFIER_LENGTH)
+
+            keys = hashlib.pbkdf2_hmac('sha1', password, salt, 1000, 2 * key_length + self._PASSWORD_VERIFIER_LENGTH)
+            if keys[2 * key_length:] != password_verifier:
+                raise RuntimeError('Bad password for file %r' % self.name)
+        except Exception:
+            self._zip_file.close()
+            raise
+
+        self._cipher = AES.new(keys[:key_length], AES.MODE_CTR,
+                               counter=Counter.new(128, initial_value=1, little_endian=True))
+        self._hmac = hmac.new(keys[key_length:2 * key_length], digestmod='sha1')
+        self._decompressor = zlib.decompressobj(-zlib.MAX_WBITS) if self._compress_type == zipfile.ZIP_DEFLATED \
+            else None
+        self._remaining = zip_info.compress_size - len(salt) - self._PASSWORD_VERIFIER_LENGTH \
+            - self._AUTHENTICATION_CODE_LENGTH
+        # AE-2 does not store the CRC of the plaintext, the authentication code replaces it
+        self._expected_crc = zip_info.CRC if vendor_version == 1 else None
+        self._crc = 0
+        self._buffer = b''
+        try:
+            if self._remaining < 0:
+                raise zipfile.BadZipFile('Bad compressed size for file %r' % self.name)
+            if not self._remaining:
+                # Authenticate an empty member at once, since there is no encrypted data to read
+                self._buffer = self._read_chunk()
+        except Exception:
+            self._zip_file.close()
+            raise
+
+    @classmethod
+    def get_aes_parameters(cls, zip_info: zipfile.ZipInfo) -> tuple[int, int, int]:
+        """ Returns the vendor version (1 for AE-1, 2 for AE-2), the AES key length in bytes and the compression method
+        from the AES extra field of a ZIP member """
+        extra = zip_info.extra
+        while len(extra) >= 4:
+            field_id, field_length = struct.unpack('<2H', extra[:4])
+            if field_id == cls._AES_EXTRA_FIELD_ID:
+                vendor_version, vendor_id, key_strength, compress_type = struct.unpack('<H2sBH', extra[4:11])
+                return vendor_version, cls._AES_KEY_LENGTHS[key_strength], compress_type
+            extra = extra[4 + field_length:]
+        raise zipfile.BadZipFile('Missing AES extra field for file %r' % zip_info.filename)
+
+    def _read_chunk(self) -> bytes:
+        encrypted_data = self._zip_file.read(min(self._CHUNK_SIZE, self._remaining))
+        if not encrypted_data and self._remaining:
+            raise EOFError('Unexpected end of encrypted data for file %r' % self.name)
+        self._remaining -= len(encrypted_data)
+        self._hmac.update(encrypted_data)
+        data = self._cipher.decrypt(encrypted_data)
+        if self._decompressor:
+            data = self._decompressor.decompress(data)
+        if not self._remaining:
+            if self._decompressor:
+                data += self._decompressor.flush()
+            if self._hmac.digest()[:self._AUTHENTICATION_CODE_LENGTH] != \
+                    self._zip_file.read(self._AUTHENTICATION_CODE_LENGTH):
+                raise zipfile.BadZipFile('Bad authentication code for file %r' % self.name)
+        if self._expected_crc is not None:
+            self._crc = zlib.crc32(data, self._crc)
+            if not self._remaining and self._crc != self._expected_crc:
+                raise zipfile.BadZipFile('Bad CRC-32 for file %r' % self.name)
+        return data
+
+    def readable(self) -> bool:
+        return True
+
+    def read(self, size: int|None = -1) -> bytes:
+        if size is None or size < 0:
+            chunks = [self._buffer]
+            while self._remaining:
+                chunks.append(self._read_chunk())
+            self._buffer = b''
+            return b''.join(chunks)
+
+        while len(self._buffer) < size and self._remaining:
+            self._buffer += self._read_chunk()
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+    def read1(self, size: int = -1) -> bytes:
+        return self.read(size)
+
+    def close(self):
+        if not self.closed:
+            self._zip_file.close()
+        super().close()
+
+
 class HiZip:
-    @staticmethod
-    def extract_json_list(zip_filename: str, output_dir: str = OUTPUT_DIR, password: str|None = None) -> Optional[list]:
-        _MOTION_PATH_JSON_DIR = 'Motion path detail data & description'
+    _MOTION_PATH_JSON_DIRS = ('Motion path detail data & description/',
+                              'data/Motion path detail data & description/')
+    _WINZIP_AES = 99  # Compression method of WinZip AES encrypted ZIP members
 
+    @classmethod
+    def _get_json_members(cls, zip_file: ZipFile) -> list:
+        """ Returns the ZIP members with the motion path detail data JSON files, in the 2024-12 multiple JSON file
+        format or in the pre 2024-06 single JSON file format. """
+        return [zip_info for zip_info in zip_file.infolist()
+                if zip_info.filename.startswith(cls._MOTION_PATH_JSON_DIRS) and zip_info.filename.endswith('.json')]
+
+    @classmethod
+    def open_json_files(cls, zip_filename: str, password: str|None = None) -> Iterator[tuple[str, BinaryIO]]:
+        """ Returns an iterator over the name and a (decrypted) stream of each motion path detail data JSON file in the
+        ZIP file. The JSON files are read straight from the ZIP file, one at a time. A stream is closed when the next
+        one is requested. ZipCrypto encrypted files are decrypted by the zipfile module, WinZip AES encrypted files by
+        the pycryptodome library. The ZIP file is checked at once: ModuleNotFoundError is raised when the JSON files
+        are WinZip AES encrypted and the pycryptodome library is not installed. """
         if not zipfile.is_zipfile(zip_filename):
             message = f'Invalid ZIP file or ZIP file not found <{zip_filename}>'
             logging.getLogger(PROGRAM_NAME).error(message)
             raise Exception(message)
 
-        if not password:
-            message = f'ZIP file <{zip_filename}> is encrypted but no password is provided'
+        with ZipFile(zip_filename) as zip_file:
+            json_members = cls._get_json_members(zip_file)
+        if not json_members:
+            message = f'Could not find motion path detail data JSON files in ZIP file <{zip_filename}>. ' \
+                      f'Nothing to convert.'
+            logging.getLogger(PROGRAM_NAME).warning(message)
+            raise Exception(message)
+        if AES is None and any(zip_info.compress_type == cls._WINZIP_AES for zip_info in json_members):
+            raise ModuleNotFoundError(f'The pycryptodome library is required to decrypt the WinZip AES encrypted JSON '
+                                      f'files in ZIP file <{zip_filename}>')
+        return cls._iter_json_files(zip_filename, json_members, password)
+
+    @classmethod
+    def _iter_json_files(cls, zip_filename: str, json_members: list,
+                         password: str|None) -> Iterator[tuple[str, BinaryIO]]:
+        with ZipFile(zip_filename) as zip_file:
+            for zip_info in json_members:
+                try:
+                    if zip_info.flag_bits & 0x1 and not password:
+                        raise Exception(f'ZIP file <{zip_filename}> is encrypted but no password is provided')
+                    if zip_info.compress_type == cls._WINZIP_AES:
+                        json_file = _WinZipAesReader(zip_filename, zip_info, password.encode('utf-8'))
+                    else:
+                        json_file = zip_file.open(zip_info, pwd=password.encode('utf-8') if password else None)
+                except Exception as e:
+                    logging.getLogger(PROGRAM_NAME).error('Error reading JSON file <%s> from ZIP file <%s>\n%s',
+                                                          zip_info.filename, zip_filename, e)
+                    raise Exception('Error reading JSON file <%s> from ZIP file <%s>', zip_info.filename,
+                                    zip_filename)
+                logging.getLogger(PROGRAM_NAME).info('Reading JSON file <%s> from ZIP file <%s>', zip_info.filename,
+                                                     zip_filename)
+                with json_file:
+                    yield zip_info.filename, json_file
+
+    @staticmethod
+    def extract_json_list(zip_filename: str, output_dir: str = OUTPUT_DIR, password: str|None = None) -> Optional[list]:
+        _MOTION_PATH_JSON_DIR = 'Motion path detail data & description'
+
+        if not zipfile.is_zipfile(zip_filename):
+            message = f'Invalid ZIP file or ZIP file not found <{zip_filename}>'
             logging.getLogger(PROGRAM_NAME).error(message)
             raise Exception(message)
 
         # New 2024-12 multiple JSON file format
         zip_json_filenames = f'{_MOTION_PATH_JSON_DIR}/*.json'
 
-        huawei_zip = zipfile.ZipFile(zip_filename)
-        huawei_json_filenames = [f'{output_dir}/{f.filename.split('/')[-1]}' for f in huawei_zip.infolist() if f.filename.startswith(_MOTION_PATH_JSON_DIR + '/') and f.filename.endswith('.json')]
+        with zipfile.ZipFile(zip_filename) as huawei_zip:
+            huawei_json_members = [f for f in huawei_zip.infolist() if f.filename.startswith(_MOTION_PATH_JSON_DIR + '/') and f.filename.endswith('.json')]
+        huawei_json_filenames = [f'{output_dir}/{f.filename.split('/')[-1]}' for f in huawei_json_members]
+        if not huawei_json_filenames:
+            # Not in the new format, nothing to extract
+            return huawei_json_filenames
+
+        if not password and any(f.flag_bits & 0x1 for f in huawei_json_members):
+            message = f'ZIP file <{zip_filename}> is encrypted but no password is provided'
+            logging.getLogger(PROGRAM_NAME).error(message)
+            raise Exception(message)
 
         if platform.system() in ['Windows', 'Linux', 'Darwin']:
             unzip_cmd = ('7za', 'e', '-aoa', '-o%s' % output_dir, '-bb0', '-bse0', '-bsp2', '-p%s' % password, '-sccUTF-8', '%s' % zip_filename, '--', '%s' % zip_json_filenames)
         else:
-            message = f'Encrypted ZIP files in Huawei 2025 format not supported on platform {platform.system()}',
+            message = f'Encrypted ZIP files in Huawei 2025 format not supported on platform {platform.system()}'
             logging.getLogger(PROGRAM_NAME).error(message)
             raise NotImplementedError(message)
         completed_process = subprocess.run(unzip_cmd,
@@ -1237,7 +2239,7 @@ class HiZip:
                                 zip_json_filename, zip_filename, completed_process.returncode)
         else:
             # Legacy ZIP file format without password
-            with ZipFile(zip_filename, 'r', True) as hi_zip:
+            with ZipFile(zip_filename, 'r') as hi_zip:
                 if _MOTION_PATH_JSON_FILENAME in hi_zip.namelist():
                     zip_json_filename = _MOTION_PATH_JSON_FILENAME
                 elif _MOTION_PATH_JSON_FILENAME_ALT in hi_zip.namelist():
@@ -1261,6 +2263,148 @@ class HiZip:
         return json_filename
 
 
+class HiJsonArrayReader:
+    """ Incremental reader for the top-level JSON array in a Huawei Health motion path JSON file.
+    The elements (activities) are read and decoded one at a time, so memory usage is bounded by the largest single
+    activity instead of by the size of the file. The invalid formatting in the 'partTimeMap' data of the Huawei JSON
+    data (missing double quotes for the keys) is removed from each element before decoding it.
+    """
+    _CHUNK_SIZE = 1024 * 1024
+
+    _WHITESPACE = b' \t\r\n'
+    _STRUCTURE_REGEX = re.compile(rb'["{}\[\]]')
+    _SCALAR_END_REGEX = re.compile(rb'[,\]\s]')
+    _PART_TIME_MAP_REGEX = re.compile(rb'"partTimeMap":{(.*?)},')
+
+    def __init__(self, json_file: BinaryIO, chunk_size: int = _CHUNK_SIZE):
+        self.json_file = json_file
+        self.chunk_size = chunk_size
+        self._buffer = bytearray()
+        # File offset of the first byte in the buffer
+        self._buffer_offset = 0
+        self._eof = False
+
+    def _read_chunk(self) -> bool:
+        """ Adds the next chunk of the file to the buffer. Returns False at the end of the file. """
+        if self._eof:
+            return False
+        chunk = self.json_file.read(self.chunk_size)
+        if not chunk:
+            self._eof = True
+            return False
+        self._buffer += chunk
+        return True
+
+    def _skip(self, pos: int, characters: bytes) -> int:
+        """ Returns the position of the first byte at or after pos that is not one of the characters """
+        while True:
+            while pos < len(self._buffer) and self._buffer[pos] in characters:
+                pos += 1
+            if pos < len(self._buffer) or not self._read_chunk():
+                return pos
+
+    def _find_string_end(self, start: int) -> int:
+        """ Returns the end position of the JSON string starting at position start in the buffer or -1 if the string
+        is not complete in the buffer.
+        """
+        pos = start + 1
+        while True:
+            end = self._buffer.find(b'"', pos)
+            if end < 0:
+                return -1
+            # The double quote is escaped when it is preceded by an odd number of backslashes
+            backslashes = 0
+            while self._buffer[end - 1 - backslashes] == ord('\\'):
+                backslashes += 1
+            if backslashes % 2 == 0:
+                return end + 1
+            pos = end + 1
+
+    def _scan_element(self, start: int) -> int:
+        """ Returns the end position of the JSON element starting at position start in the buffer """
+        if self._buffer[start] not in b'{["':
+            # Number or literal
+            while True:
+                match = self._SCALAR_END_REGEX.search(self._buffer, start)
+                if match:
+                    return match.start()
+                if not self._read_chunk():
+                    return len(self._buffer)
+
+        depth = 0
+        pos = start
+        while True:
+            match = self._STRUCTURE_REGEX.search(self._buffer, pos)
+            if not match:
+                if not self._read_chunk():
+                    raise ValueError('Unexpected end of JSON data at offset %d' % (self._buffer_offset + pos))
+                continue
+            character = self._buffer[match.start()]
+            if character == ord('"'):
+                string_end = self._find_string_end(match.start())
+                if string_end < 0:
+                    # String continues in the next chunk
+                    pos = match.start()
+                    if not self._read_chunk():
+                        raise ValueError('Unexpected end of JSON data at offset %d' % (self._buffer_offset + pos))
+                    continue
+                pos = string_end
+                if depth == 0:
+                    return pos
+            elif character in b'{[':
+                depth += 1
+                pos = match.end()
+            else:
+                depth -= 1
+                pos = match.end()
+                if depth == 0:
+                    return pos
+
+    def iter_raw(self):
+        """ Yields the raw JSON data of each element in the top-level array as a tuple (file offset, bytes) """
+        # Skip optional UTF-8 byte order mark and whitespace up to the start of the array
+        while len(self._buffer) < 3 and self._read_chunk():
+            pass
+        pos = self._skip(3 if self._buffer.startswith(b'\xef\xbb\xbf') else 0, self._WHITESPACE)
+        if pos >= len(self._buffer) or self._buffer[pos] != ord('['):
+            raise ValueError('JSON data does not contain a top-level array')
+
+        pos += 1
+        while True:
+            pos = self._skip(pos, self._WHITESPACE + b',')
+            if pos >= len(self._buffer):
+                raise ValueError('Unexpected end of JSON data at offset %d' % (self._buffer_offset + pos))
+            if self._buffer[pos] == ord(']'):
+                return
+            end = self._scan_element(pos)
+            yield self._buffer_offset + pos, bytes(self._buffer[pos:end])
+            # Release the data of the element
+            del self._buffer[:end]
+            self._buffer_offset += end
+            pos = 0
+
+    @classmethod
+    def decode(cls, raw_data: bytes):
+        """ Decodes the raw JSON data of a single element """
+        # The JSON file from Huawei contains invalid formatting in the 'partTimeMap' data (missing double quotes
+        # for the keys). For now, remove the invalid parts using a regular expression.
+        return json.loads(cls._PART_TIME_MAP_REGEX.sub(b'', raw_data))
+
+    def __iter__(self):
+        """ Yields the decoded elements of the top-level array """
+        for offset, raw_data in self.iter_raw():
+            yield self.decode(raw_data)
+
+
+class _HiJsonActivityData(dict):
+    """ The decoded JSON data of an activity with the content hash of the raw JSON data it was decoded from. The
+    content hash is kept when the activity data is passed to a worker process. """
+
+    def __init__(self, activity_dict: dict, content_hash: str):
+        super().__init__(activity_dict)
+        self.content_hash = content_hash
+
+
 class HiJson:
     # TODO find the correct values for the unknown/undocumented JSON sport types
     _JSON_SPORT_TYPES = [(5, HiActivity.TYPE_WALK),
@@ -1281,13 +2425,30 @@ class HiJson:
 
     _SPORT_DATA_SOURCE_MANUAL = 2
 
-    def __init__(self, json_filename: str, output_dir: str = OUTPUT_DIR, export_json_data: bool = False):
+    # The header fields of an activity that are found in its raw JSON data to filter the activity before its JSON data
+    # (with the large HiTrack data in the 'attribute' string) is decoded. Quotes in JSON strings are escaped, so the
+    # fields do not match in the 'attribute' string.
+    _HEADER_FIELD_REGEX = re.compile(rb'"(recordDay|startTime|sportType|timeZone)":\s*(-?\d+|"[^"\\]*")')
+
+    # The index of a JSON file is kept next to the JSON file. It holds the byte offset, the length, the header fields
+    # and the content hash of each activity in the JSON file. It is valid as long as the size and modification time of
+    # the JSON file do not change.
+    _INDEX_FILE_SUFFIX = '.Hitrava_index.json'
+    _INDEX_VERSION = 1
+
+    def __init__(self, json_filename: str, output_dir: str = OUTPUT_DIR, export_json_data: bool = False,
+                 columnar_store: bool = False, distance_method: str = DISTANCE_VINCENTY,
+                 export_hitrack_data: bool = False, json_data: BinaryIO|None = None):
         # Validate the JSON file parameter
         if not json_filename:
             logging.getLogger(PROGRAM_NAME).error('Parameter for JSON filename is missing')
 
         try:
-            self.json_file = open(json_filename, 'r')
+            # The JSON data is read from the JSON file, unless a binary stream with the JSON data is passed (e.g. a
+            # JSON file read from a ZIP file).
+            self.json_file = open(json_filename, 'rb') if json_data is None else json_data
+            # Only a JSON file on disk is indexed
+            self.json_filename = json_filename if json_data is None else None
         except Exception as e:
             logging.getLogger(PROGRAM_NAME).error('Error opening JSON file <%s>\n%s', json_filename, e)
             raise Exception('Error opening JSON file <%s>', json_filename)
@@ -1298,20 +2459,42 @@ class HiJson:
             os.makedirs(self.output_dir)
 
         self.export_json_data = export_json_data
+        self.export_hitrack_data = export_hitrack_data
+        self.columnar_store = columnar_store
+        self.distance_method = distance_method
 
         self.hi_activity_list = []
 
-    def parse(self, from_date: datetime.date = datetime.date(1970, 1, 1)) -> list:
-        try:
-            # Look for HiTrack information in JSON file
-
-            # The JSON file from Huawei contains invalid formatting in the 'partTimeMap' data (missing double quotes
-            # for the keys). For now, remove the invalid parts using a regular expression.
-            json_string = self.json_file.read()
+    def parse(self, from_date: datetime.date = datetime.date(1970, 1, 1),
+              activity_filter: ActivityFilter|None = None) -> list:
+        self.hi_activity_list.extend(self.parse_iter(from_date, activity_filter))
+        return self.hi_activity_list
 
-            json_string = re.sub('\"partTimeMap\":{(.*?)},', '', json_string)
-
-            data = json.loads(json_string)
+    def parse_iter(self, from_date: datetime.date = datetime.date(1970, 1, 1),
+                   activity_filter: ActivityFilter|None = None) -> Iterator[HiActivity]:
+        """ Yields the parsed activities in the JSON file one at a time. Contrary to parse(), the activities are not
+        kept, so an activity is released as soon as the caller is done with it. """
+        for activity_dict in self.get_activities(from_date, activity_filter):
+            try:
+                hi_activity = self.parse_activity(activity_dict)
+            except Exception as e:
+                logging.getLogger(PROGRAM_NAME).error('Error parsing JSON file <%s>\n%s', self.json_file.name, e)
+                raise Exception('Error parsing JSON file <%s>', self.json_file.name)
+            if hi_activity and (not activity_filter or activity_filter.accepts_activity(hi_activity)):
+                yield hi_activity
+                # Do not keep the activity (and its JSON data) alive while the next one is parsed
+                hi_activity = activity_dict = None
+
+    def get_activities(self, from_date: datetime.date = datetime.date(1970, 1, 1),
+                       activity_filter: ActivityFilter|None = None) -> Iterator[dict]:
+        """ Yields the JSON data of each activity in the JSON file to parse. The activity filter (default: from_date
+        only) is evaluated on the header fields in the raw JSON data of an activity, so the JSON data of the activities
+        that are filtered out is not decoded. """
+        if activity_filter is None:
+            activity_filter = ActivityFilter(from_date)
+        try:
+            # Look for HiTrack information in JSON file.
+            # Activities are read and decoded one at a time from the JSON file.
 
             # JSON data structure BEFORE 07/2020
             # data {list}
@@ -1333,42 +2516,170 @@ class HiJson:
             #   1 {dict}
             #     sportType {int}
             #     attribute {str} 'HW_EXT_TRACK_DETAIL@is<HiTrack File Data>&&HW_EXT_TRACK_SIMPLIFY@is<Other Data>'
-            n = -1
-            for n, activity_dict in enumerate(data):
-                if 'recordDay' in activity_dict:
-                    activity_date = dts.strptime(str(activity_dict['recordDay']), "%Y%m%d").date()
+            for n, raw_data, content_hash in self._get_raw_activities(activity_filter):
+                activity_dict = _HiJsonActivityData(HiJsonArrayReader.decode(raw_data), content_hash)
+                if not self._filter_activity(n, activity_dict, activity_filter, ActivityFilter.STAGE_DECODED):
+                    continue
+                logging.getLogger(PROGRAM_NAME).info(
+                    'Found one or more activities in JSON at index %d to parse from %s (YYY-MM-DD)',
+                    n, self._get_activity_date(activity_dict).isoformat())
+
+                if 'motionPathData' in activity_dict:
+                    # The date of the activities is the record day of the (outer) activity data
+                    yield from (_HiJsonActivityData(motion_path_data, content_hash)
+                                for motion_path_data in activity_dict['motionPathData']
+                                if self._filter_activity(n, motion_path_data, activity_filter,
+                                                         ActivityFilter.STAGE_DECODED, filter_date=False))
                 else:
-                    activity_date = dts.fromtimestamp(activity_dict['startTime'] / 1000, datetime.UTC).date()
+                    yield activity_dict
+        except Exception as e:
+            logging.getLogger(PROGRAM_NAME).error('Error parsing JSON file <%s>\n%s', self.json_file.name, e)
+            raise Exception('Error parsing JSON file <%s>', self.json_file.name)
 
-                if activity_date >= from_date:
-                    logging.getLogger(PROGRAM_NAME).info(
-                        'Found one or more activities in JSON at index %d to parse from %s (YYY-MM-DD)',
-                        n, activity_date.isoformat())
-
-                    if 'motionPathData' in activity_dict:
-                        for motion_path_dict in activity_dict['motionPathData']:
-                            hi_activity = self._parse_activity(motion_path_dict)
-                            if hi_activity:
-                                self.hi_activity_list.append(hi_activity)
-                    else:
-                        hi_activity = self._parse_activity(activity_dict)
-                        if hi_activity:
-                            self.hi_activity_list.append(hi_activity)
+    def _get_raw_activities(self, activity_filter: ActivityFilter) -> Iterator[tuple[int, bytes, str]]:
+        """ Yields the index in the top-level JSON array, the raw JSON data and the content hash of the raw JSON data
+        of each activity in the JSON file that is accepted by the activity filter on its header fields. With a valid
+        index of the JSON file, the JSON file is memory-mapped and only the data of the accepted activities is read.
+        Otherwise the JSON file is scanned, and the index is built and saved for the next time. """
+        index = self._load_index()
+        if index is not None:
+            with mmap.mmap(self.json_file.fileno(), 0, access=mmap.ACCESS_READ) as json_map:
+                for n, entry in enumerate(index):
+                    if activity_filter.selective and \
+                            not self._filter_activity(n, entry, activity_filter, ActivityFilter.STAGE_HEADER):
+                        continue
+                    yield n, json_map[entry['offset']:entry['offset'] + entry['length']], entry['hash']
+            return
 
-                else:
-                    logging.getLogger(PROGRAM_NAME).info(
-                        'Skipped parsing activity at index %d being an activity from %s before %s (YYYY-MM-DD).',
-                        n, activity_date.isoformat(), from_date.isoformat())
+        json_stat = os.fstat(self.json_file.fileno()) if self.json_filename else None
+        index = [] if json_stat and json_stat.st_size else None
+        n = -1
+        for n, (offset, raw_data) in enumerate(HiJsonArrayReader(self.json_file).iter_raw()):
+            header_fields = None
+            content_hash = hashlib.sha256(raw_data).hexdigest()
+            if index is not None:
+                header_fields = self._get_header_fields(raw_data)
+                index.append(dict(header_fields, offset=offset, length=len(raw_data), hash=content_hash))
+            if activity_filter.selective:
+                if header_fields is None:
+                    header_fields = self._get_header_fields(raw_data)
+                if not self._filter_activity(n, header_fields, activity_filter, ActivityFilter.STAGE_HEADER):
+                    continue
+            yield n, raw_data, content_hash
+
+        if n == -1:
+            logging.getLogger(PROGRAM_NAME).info('No activities found to convert in JSON file <%s>',
+                                                 self.json_file.name)
+        if index is not None:
+            self._save_index(index, json_stat)
+
+    def _load_index(self) -> Optional[list]:
+        """ Returns the index entries of the JSON file or None if there is no valid index of the JSON file """
+        if not self.json_filename:
+            return None
+        index_filename = self.json_filename + self._INDEX_FILE_SUFFIX
+        try:
+            with open(index_filename, 'r') as index_file:
+                index = json.load(index_file)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logging.getLogger(PROGRAM_NAME).warning('Error reading index <%s> of JSON file <%s>. The JSON file will be '
+                                                    'scanned.\n%s', index_filename, self.json_filename, e)
+            return None
+
+        json_stat = os.fstat(self.json_file.fileno())
+        if index.get('version') != self._INDEX_VERSION or index.get('size') != json_stat.st_size \
+                or index.get('mtime_ns') != json_stat.st_mtime_ns:
+            logging.getLogger(PROGRAM_NAME).info('Index <%s> does not match JSON file <%s>. The JSON file will be '
+                                                 'scanned and indexed again.', index_filename, self.json_filename)
+            return None
+        logging.getLogger(PROGRAM_NAME).info('Using index <%s> of JSON file <%s> with %d activities',
+                                             index_filename, self.json_filename, len(index['activities']))
+        return index['activities']
 
-            if n == -1:
-                logging.getLogger(PROGRAM_NAME).info('No activities found to convert in JSON file <%s>',
-                                                     self.json_file.name)
-            return self.hi_activity_list
+    def _save_index(self, index: list, json_stat: os.stat_result):
+        index_filename = self.json_filename + self._INDEX_FILE_SUFFIX
+        try:
+            with open(index_filename + '.tmp', 'w') as index_file:
+                json.dump({'version': self._INDEX_VERSION,
+                           'size': json_stat.st_size,
+                           'mtime_ns': json_stat.st_mtime_ns,
+                           'activities': index}, index_file)
+            os.replace(index_filename + '.tmp', index_filename)
+            logging.getLogger(PROGRAM_NAME).info('Saved index <%s> of JSON file <%s> with %d activities',
+                                                 index_filename, self.json_filename, len(index))
         except Exception as e:
-            logging.getLogger(PROGRAM_NAME).error('Error parsing JSON file <%s>\n%s', self.json_file.name, e)
-            raise Exception('Error parsing JSON file <%s>', self.json_file.name)
+            logging.getLogger(PROGRAM_NAME).warning('Error saving index <%s> of JSON file <%s>\n%s',
+                                                    index_filename, self.json_filename, e)
+
+    @classmethod
+    def _get_header_fields(cls, raw_data: bytes) -> dict:
+        """ Returns the header fields found in the raw JSON data of an activity without decoding it. A field that is
+        found with different values (e.g. the start times of the activities in the pre 07/2020 JSON data structure) is
+        left out. """
+        field_values = collections.defaultdict(set)
+        for field, value in cls._HEADER_FIELD_REGEX.findall(raw_data):
+            field_values[field].add(value)
+        return {field.decode(): json.loads(values.pop()) for field, values in field_values.items() if len(values) == 1}
+
+    @staticmethod
+    def _get_activity_date(activity_dict: dict) -> Optional[datetime.date]:
+        if 'recordDay' in activity_dict:
+            return dts.strptime(str(activity_dict['recordDay']), "%Y%m%d").date()
+        if 'startTime' in activity_dict:
+            return dts.fromtimestamp(activity_dict['startTime'] / 1000, datetime.UTC).date()
+        return None
+
+    @classmethod
+    def _get_sport(cls, sport_type: int) -> str:
+        """ Returns the HiActivity sport type of a JSON sport type (TYPE_UNKNOWN for an undocumented sport type) """
+        for json_sport_type, sport in cls._JSON_SPORT_TYPES:
+            if json_sport_type == sport_type:
+                return sport
+        return HiActivity.TYPE_UNKNOWN
 
-    def _parse_activity(self, activity_dict: dict) -> Optional[HiActivity]:
+    @staticmethod
+    def _get_activity_ids(start_time: int, time_zone_string: str) -> tuple[str, str]:
+        """ Returns the activity ids (see ActivityFilter.get_activity_ids) of the activity with the start time and
+        time zone in the JSON data """
+        time_zone = tz(dts_delta(hours=int(time_zone_string[:3]), minutes=int(time_zone_string[3:])))
+        return ActivityFilter.get_activity_ids(start_time, time_zone)
+
+    def _filter_activity(self, n: int, fields: dict, activity_filter: ActivityFilter, stage: str,
+                         filter_date: bool = True) -> bool:
+        """ Returns whether the activity at index n in the JSON file is accepted by the activity filter. Only the
+        filters on the fields that are available are evaluated. """
+        activity_date = self._get_activity_date(fields) if filter_date else None
+        if activity_date and not activity_filter.accepts_date(activity_date, stage):
+            logging.getLogger(PROGRAM_NAME).info('Skipped parsing activity at index %d being an activity from %s '
+                                                 'outside the date range to convert (YYYY-MM-DD).',
+                                                 n, activity_date.isoformat())
+            return False
+        if 'sportType' in fields and not activity_filter.accepts_sport(self._get_sport(fields['sportType']), stage):
+            logging.getLogger(PROGRAM_NAME).info('Skipped parsing activity at index %d of sport %s', n,
+                                                 self._get_sport(fields['sportType']))
+            return False
+        if 'startTime' in fields and 'timeZone' in fields and \
+                not activity_filter.accepts_activity_ids(
+                    self._get_activity_ids(fields['startTime'], fields['timeZone']), stage):
+            logging.getLogger(PROGRAM_NAME).info('Skipped parsing activity at index %d not being one of the '
+                                                 'activities to convert.', n)
+            return False
+        return True
+
+    @staticmethod
+    def get_activity_fingerprint(activity_dict: dict) -> tuple[str, str]:
+        """ Returns the activity key (the start time) and the content hash of the JSON data of an activity. The
+        content hash is the hash of the raw JSON data the activity was read from (see get_activities), or for other
+        activity data the hash of its JSON encoding. In the pre 07/2020 JSON data structure, the raw JSON data holds all
+        activities of the record day. """
+        content_hash = getattr(activity_dict, 'content_hash', None)
+        if content_hash is None:
+            content_hash = hashlib.sha256(json.dumps(activity_dict, sort_keys=True).encode('utf-8')).hexdigest()
+        return str(activity_dict['startTime']), content_hash
+
+    def parse_activity(self, activity_dict: dict) -> Optional[HiActivity]:
         # Create a HiTrack file from the HiTrack data
         hitrack_data = activity_dict['attribute']
         # Strip prefix and suffix from raw HiTrack data
@@ -1394,7 +2705,7 @@ class HiJson:
         # Save HiTrack data to HiTrack file
         hitrack_filename = "%s/HiTrack_%s" % \
                            (self.output_dir,
-                            _get_tz_aware_datetime(activity_start, time_zone).strftime('%Y%m%d_%H%M%S')
+                            _get_tz_aware_datetime(_to_timestamp(activity_start), time_zone).strftime('%Y%m%d_%H%M%S')
                             )
 
         if self.export_json_data:
@@ -1418,24 +2729,27 @@ class HiJson:
                     logging.getLogger(PROGRAM_NAME).error('Error closing JSON export file <%s>\n%s',
                                                           json_filename, e)
 
-        logging.getLogger(PROGRAM_NAME).info(
-            'Saving activity from %s to HiTrack file %s for parsing', activity_start, hitrack_filename)
+        if self.export_hitrack_data:
+            # Save a copy of the HiTrack data of a single activity. The HiTrack data is parsed in memory, the file is
+            # for debugging only.
+            logging.getLogger(PROGRAM_NAME).info(
+                'Exporting HiTrack data of activity from %s to HiTrack file %s', activity_start, hitrack_filename)
 
-        hitrack_file = None
+            hitrack_file = None
 
-        try:
-            hitrack_file = open(hitrack_filename, 'w+')
-            hitrack_file.write(hitrack_data)
-        except Exception as e:
-            logging.getLogger(PROGRAM_NAME).error(
-                'Error saving activity from %s to HiTrack file for parsing.\n%s', activity_start, e)
-        finally:
             try:
-                if hitrack_file:
-                    hitrack_file.close()
+                hitrack_file = open(hitrack_filename, 'w+')
+                hitrack_file.write(hitrack_data)
             except Exception as e:
-                logging.getLogger(PROGRAM_NAME).error('Error closing HiTrack file <%s>\n%s',
-                                                      hitrack_filename, e)
+                logging.getLogger(PROGRAM_NAME).error(
+                    'Error exporting HiTrack data of activity from %s.\n%s', activity_start, e)
+            finally:
+                try:
+                    if hitrack_file:
+                        hitrack_file.close()
+                except Exception as e:
+                    logging.getLogger(PROGRAM_NAME).error('Error closing HiTrack file <%s>\n%s',
+                                                          hitrack_filename, e)
 
         # Use activity attributes available in JSON data
         # Do NOT process unsupported sport types
@@ -1447,11 +2761,7 @@ class HiJson:
             return None
 
         # Sport type (internal HiActivity sport type)
-        sport = HiActivity.TYPE_UNKNOWN
-        if any(activity_dict['sportType'] in i for i in self._JSON_SPORT_TYPES):
-            sport = \
-                [item[1] for item in self._JSON_SPORT_TYPES if
-                 item[0] == sport_type][0]
+        sport = self._get_sport(sport_type)
 
         # Parse the Huawei activity data
         if sport == HiActivity.TYPE_POOL_SWIM:
@@ -1460,7 +2770,7 @@ class HiJson:
             # hi_activity = None
             if 'mSwimSegments' in activity_detail_dict:
                 hi_activity = HiActivity.from_json_pool_swim_data(activity_id,
-                                                                  activity_start,
+                                                                  _to_timestamp(activity_start),
                                                                   activity_detail_dict['mSwimSegments'])
             else:
                 sport_data_source = activity_dict['sportDataSource']
@@ -1468,7 +2778,7 @@ class HiJson:
                     logging.getLogger(PROGRAM_NAME).info('Swimming activity %s has been manually added, conversion '
                                                          'will only contain basic activity data.', activity_id)
                     hi_activity = HiActivity.from_manual_json_pool_swim_data(activity_id,
-                                                                             activity_start,
+                                                                             _to_timestamp(activity_start),
                                                                              activity_dict['totalTime'],
                                                                              activity_dict['totalDistance'])
                 else:
@@ -1490,7 +2800,9 @@ class HiJson:
                                               month=activity_start.month,
                                               day=activity_start.day)
 
-            hitrack_file = HiTrackFile(hitrack_filename, timestamp_ref=timestamp_ref, start_timestamp_ref=activity_start)
+            hitrack_file = HiTrackFile(hitrack_filename, timestamp_ref=timestamp_ref, start_timestamp_ref=activity_start,
+                                       columnar_store=self.columnar_store, distance_method=self.distance_method,
+                                       hitrack_data=hitrack_data)
             hi_activity = hitrack_file.parse()
             if sport != HiActivity.TYPE_UNKNOWN:
                 hi_activity.set_activity_type(sport)
@@ -1502,19 +2814,14 @@ class HiJson:
                                                         activity_start,
                                                         sport_type)
 
-            # For open water swimming activities, the SWOLF based segment data can not be used.
-            # Replace it by the raw GPS data (done in
-            if hi_activity.get_activity_type() == HiActivity.TYPE_OPEN_WATER_SWIM:
-                hi_activity.get_swim_data()
-
         # Start date and time (in UTC)
-        hi_activity.start = activity_start
+        hi_activity.start = _to_timestamp(activity_start)
 
         # Time zone - Use time zone from JSON activity data
         hi_activity.time_zone = time_zone
 
         # Stop date and time (in UTC) from duration
-        hi_activity.stop = activity_start + dts_delta(milliseconds=activity_dict['totalTime'])
+        hi_activity.stop = hi_activity.start + round(activity_dict['totalTime'] * 1000)
 
         # Total distance
         if 'totalDistance' in activity_detail_dict:
@@ -1540,11 +2847,228 @@ class HiJson:
         except Exception as e:
             logging.getLogger(PROGRAM_NAME).error('Error closing JSON file <%s>\n', self.json_file.name, e)
 
+    def __getstate__(self):
+        # The JSON file can not be passed to the worker processes converting the activities in parallel.
+        state = self.__dict__.copy()
+        state['json_file'] = None
+        state['hi_activity_list'] = []
+        return state
+
     def __del__(self):
         self._close_json()
 
 
-class TcxActivity:
+class _XmlWriter:
+    """ Streaming XML writer. Writes the XML elements to a binary file while they are generated, indented with two
+    spaces per level, the same way ElementTree serializes an indented tree, or without any indentation whitespace
+    (compact). Only a small buffer is held in memory.
+    """
+    _BUFFER_SIZE = 4096
+
+    _TEXT_ESCAPES = (('&', '&amp;'), ('<', '&lt;'), ('>', '&gt;'))
+    _ATTRIBUTE_ESCAPES = _TEXT_ESCAPES + (('"', '&quot;'), ('\r', '&#13;'), ('\n', '&#10;'), ('\t', '&#09;'))
+
+    def __init__(self, xml_file: BinaryIO, encoding: str = 'utf-8', indent: bool = True):
+        self.xml_file = xml_file
+        self.encoding = encoding
+        self.indent = indent
+        # The number of bytes written to the file
+        self.size = 0
+        self._buffer = []
+        self._open_tags = []
+        # The start tag of the last started element is not closed until it is known whether it has child elements
+        self._start_tag_pending = False
+
+    def write_declaration(self):
+        self._buffer.append('<?xml version="1.0" encoding="%s"?>' % self.encoding.upper())
+
+    @staticmethod
+    def _escape(value: str, escapes: tuple) -> str:
+        # Most values (numbers, timestamps) do not contain any character to escape
+        for character, replacement in escapes:
+            if character in value:
+                value = value.replace(character, replacement)
+        return value
+
+    def _attributes(self, attributes: dict) -> str:
+        return ''.join(' %s="%s"' % (name, self._escape(value, self._ATTRIBUTE_ESCAPES))
+                       for name, value in attributes.items())
+
+    def _indent(self):
+        if self._start_tag_pending:
+            self._buffer.append('>')
+            self._start_tag_pending = False
+        if self._open_tags and self.indent:
+            self._buffer.append('\n' + '  ' * len(self._open_tags))
+
+    def start(self, tag: str, attributes: dict|None = None):
+        """ Starts an element with child elements """
+        self._indent()
+        self._buffer.append('<' + tag + (self._attributes(attributes) if attributes else ''))
+        self._open_tags.append(tag)
+        self._start_tag_pending = True
+
+    def end(self):
+        """ Ends the last started element """
+        tag = self._open_tags.pop()
+        if self._start_tag_pending:
+            # Element without child elements
+            self._buffer.append(' />')
+            self._start_tag_pending = False
+        elif self.indent:
+            self._buffer.append('\n' + '  ' * len(self._open_tags) + '</' + tag + '>')
+        else:
+            self._buffer.append('</' + tag + '>')
+        if not self._open_tags:
+            self._buffer.append('\n')
+        if len(self._buffer) >= self._BUFFER_SIZE:
+            self.flush()
+
+    def element(self, tag: str, text: str|None = None, attributes: dict|None = None):
+        """ Writes an element without child elements """
+        self._indent()
+        start_tag = '<' + tag + (self._attributes(attributes) if attributes else '')
+        if text:
+            self._buffer.append(start_tag + '>' + self._escape(text, self._TEXT_ESCAPES) + '</' + tag + '>')
+        else:
+            self._buffer.append(start_tag + ' />')
+
+    def flush(self):
+        """ Writes the buffered XML data to the file """
+        data = ''.join(self._buffer).encode(self.encoding)
+        self.xml_file.write(data)
+        self.size += len(data)
+        self._buffer = []
+
+
+class _OutputFormatter:
+    """ Fast formatting of the timestamps and numbers of an activity for the (text) output files.
+    Timestamps (microseconds since epoch) are formatted arithmetically with the fixed UTC offset of the activity, which
+    is formatted only once. The result equals _get_tz_aware_datetime(timestamp, time_zone).isoformat('T'). Coordinates
+    and distances (and altitudes) are formatted with a fixed number of decimals, or with full precision (str) when the
+    number of decimals is not set. """
+    _SECONDS = tuple('%02d' % second for second in range(60))
+
+    def __init__(self, time_zone: tz|None, coordinate_decimals: int|None = None, distance_decimals: int|None = None):
+        self.offset = (time_zone.utcoffset(None) // _ONE_MICROSECOND) if time_zone else 0
+        # E.g. '+01:00' (equal to the offset in the isoformat of a time zone aware datetime)
+        self.offset_string = _get_tz_aware_datetime(0, time_zone).isoformat('T')[19:]
+        # The formatted local date, hour and minute per minute since epoch, e.g. '2020-01-01T18:00:'
+        self.minutes = {}
+        self.coordinate = str if coordinate_decimals is None else ('%%.%df' % coordinate_decimals).__mod__
+        self.distance = str if distance_decimals is None else ('%%.%df' % distance_decimals).__mod__
+
+    def _format_minute(self, minute: int) -> str:
+        formatted_minute = self.minutes[minute] = (_EPOCH + dts_delta(minutes=minute)).strftime('%Y-%m-%dT%H:%M:')
+        return formatted_minute
+
+    def timestamp(self, timestamp: int) -> str:
+        """ Returns the ISO 8601 representation of the timestamp, with microseconds only if they are not 0 """
+        seconds, microseconds = divmod(timestamp + self.offset, _MICROSECONDS_PER_SECOND)
+        minute, second = divmod(seconds, 60)
+        formatted_minute = self.minutes.get(minute) or self._format_minute(minute)
+        if microseconds:
+            return '%s%02d.%06d%s' % (formatted_minute, second, microseconds, self.offset_string)
+        return formatted_minute + self._SECONDS[second] + self.offset_string
+
+    def timestamp_seconds(self, timestamp: int) -> str:
+        """ Returns the ISO 8601 representation of the timestamp, truncated to seconds """
+        minute, second = divmod((timestamp + self.offset) // _MICROSECONDS_PER_SECOND, 60)
+        formatted_minute = self.minutes.get(minute) or self._format_minute(minute)
+        return formatted_minute + self._SECONDS[second] + self.offset_string
+
+
+class ActivityWriter(abc.ABC):
+    """ Abstract base class of the output writers of a HiActivity (e.g. a TCX or FIT file).
+    The writers are fed by _write_activity(), which passes once over the laps and the detail data of the activity, so
+    multiple output formats of an activity are written in a single pass. For swimming activities a lap is a swim lap
+    (see HiActivity.get_swim_data), for all other activities a lap is a segment (see HiActivity.get_segments).
+    A writer implements at least start, lap_data and end. """
+    FORMAT_NAME = None
+    FILE_EXTENSION = None
+
+    # Activity types with step frequency data (in steps/minute) and with (cycling) cadence data (in rpm)
+    _STEP_FREQUENCY_TYPES = (HiActivity.TYPE_WALK, HiActivity.TYPE_RUN, HiActivity.TYPE_HIKE,
+                             HiActivity.TYPE_MOUNTAIN_HIKE, HiActivity.TYPE_CROSS_COUNTRY_RUN)
+    _CADENCE_TYPES = (HiActivity.TYPE_CYCLE, HiActivity.TYPE_INDOOR_CYCLE)
+    _SWIM_TYPES = (HiActivity.TYPE_POOL_SWIM, HiActivity.TYPE_OPEN_WATER_SWIM)
+
+    def __init__(self, hi_activity: HiActivity, save_dir: str = OUTPUT_DIR, filename_prefix: str|None = None,
+                 filename_suffix: str|None = None, insert_altitude: bool = False, coordinate_decimals: int|None = None,
+                 distance_decimals: int|None = None):
+        if not hi_activity:
+            logging.getLogger(PROGRAM_NAME).error("No valid HiTrack activity specified to construct %s activity.",
+                                                  self.FORMAT_NAME)
+            raise Exception("No valid HiTrack activity specified to construct %s activity." % self.FORMAT_NAME)
+        self.hi_activity = hi_activity
+        self.save_dir = save_dir
+        self.filename_prefix = filename_prefix
+        self.filename = None
+        self.filename_suffix = filename_suffix
+        self.insert_altitude = insert_altitude
+        # Whether the laps are swim laps. Set when the output of the activity starts.
+        self.swim = False
+        # The number of decimals of the coordinates and of the distances and altitudes in text output (None = all)
+        self.coordinate_decimals = coordinate_decimals
+        self.distance_decimals = distance_decimals
+        self.formatter = None
+        self.file_extension = self.FILE_EXTENSION
+        # The size of the output before compression, when the writer compresses its output (None = not compressed)
+        self.uncompressed_size = None
+
+    def get_default_filename(self) -> str:
+        """ Returns the filename in the save directory based on the prefix, activity id and suffix """
+        filename = self.save_dir + '/'
+        if self.filename_prefix:
+            # TODO verify timezone (un)aware display date / time
+            filename += _to_datetime(self.hi_activity.start).strftime(self.filename_prefix)
+        filename += self.hi_activity.activity_id
+        if self.filename_suffix:
+            filename += self.filename_suffix
+        return filename + self.file_extension
+
+    @abc.abstractmethod
+    def start(self, output_file: BinaryIO):
+        """ Starts the output of the activity to the (binary) output file """
+        self.formatter = _OutputFormatter(self.hi_activity.time_zone, self.coordinate_decimals, self.distance_decimals)
+
+    def start_lap(self, n: int, lap: dict):
+        """ Starts the output of lap n of the activity """
+        pass
+
+    @abc.abstractmethod
+    def lap_data(self, data):
+        """ Outputs a detail data record (the data of one timestamp) of the current lap """
+        pass
+
+    def end_lap(self, n: int, lap: dict):
+        """ Ends the output of lap n of the activity """
+        pass
+
+    @abc.abstractmethod
+    def end(self):
+        """ Ends the output of the activity """
+        pass
+
+    def close(self):
+        """ Closes the streams the writer opened on the output file when the output did not end. The output file
+        itself is closed by the caller. """
+        pass
+
+    def save(self, filename: str|None = None) -> Optional[str]:
+        """ Saves the activity in filename (default: see get_default_filename). Returns the filename of the saved file
+        or None if it could not be saved. """
+        return _save_activity(self.hi_activity, [self], [filename])[0]
+
+
+class TcxActivity(ActivityWriter):
+    FORMAT_NAME = 'TCX'
+    FILE_EXTENSION = '.tcx'
+
+    # The default number of decimals of the coordinates (about 0.1 m) and of the distances and altitudes in compact TCX
+    _COMPACT_COORDINATE_DECIMALS = 6
+    _COMPACT_DISTANCE_DECIMALS = 1
+
     # Strava accepts following sports: walking, running, biking, swimming.
     # Note: TCX XSD only accepts Running, Biking, Other
     _SPORT_OTHER = 'Other'
@@ -1581,21 +3105,36 @@ class TcxActivity:
                            (HiActivity.TYPE_CROSS_COUNTRY_RUN, 'running')]
 
     def __init__(self, hi_activity: HiActivity, tcx_xml_schema=None, save_dir: str = OUTPUT_DIR,
-                 filename_prefix: str|None = None, filename_suffix: str|None = None, insert_altitude: bool = False):
-        if not hi_activity:
-            logging.getLogger(PROGRAM_NAME).error("No valid HiTrack activity specified to construct TCX activity.")
-            raise Exception("No valid HiTrack activity specified to construct TCX activity.")
-        self.hi_activity = hi_activity
-        self.training_center_database = None
+                 filename_prefix: str|None = None, filename_suffix: str|None = None, insert_altitude: bool = False,
+                 coordinate_decimals: int|None = None, distance_decimals: int|None = None, compact: bool = False,
+                 compress: bool = False):
+        if compact:
+            if coordinate_decimals is None:
+                coordinate_decimals = self._COMPACT_COORDINATE_DECIMALS
+            if distance_decimals is None:
+                distance_decimals = self._COMPACT_DISTANCE_DECIMALS
+        super().__init__(hi_activity, save_dir, filename_prefix, filename_suffix, insert_altitude,
+                         coordinate_decimals, distance_decimals)
+        # Compact TCX XML has no indentation whitespace
+        self.compact = compact
+        # Write the TCX XML through a gzip compressor to a .tcx.gz file
+        self.compress = compress
+        if compress:
+            self.file_extension += '.gz'
+        self.gzip_file = None
         if tcx_xml_schema:
             self.tcx_xml_schema = tcx_xml_schema
         else:
             self.tcx_xml_schema = None
-        self.save_dir = save_dir
-        self.filename_prefix = filename_prefix
-        self.tcx_filename = None
-        self.filename_suffix = filename_suffix
-        self.insert_altitude = insert_altitude
+        self.xml_writer = None
+        self.tcx_file = None
+        self.last_altitude = -1000
+        self.lap_data_count = 0
+        self.cumulative_distance = 0
+
+    @property
+    def tcx_filename(self) -> Optional[str]:
+        return self.filename
 
     def _get_sport(self):
         sport = ''
@@ -1619,406 +3158,1049 @@ class TcxActivity:
 
         return sport
 
-    def generate_xml(self) -> xml_et.Element:
-        """ Generates the TCX XML content."""
-        logging.getLogger(PROGRAM_NAME).debug('Generating TCX XML data for activity %s', self.hi_activity.activity_id)
+    def generate_xml(self, xml_file: BinaryIO):
+        """ Generates the TCX XML content and writes it to the (binary) XML file while it is generated. """
         try:
-            # * TrainingCenterDatabase
-            training_center_database = xml_et.Element('TrainingCenterDatabase')
-            training_center_database.set('xsi:schemaLocation',
-                                         'http://www.garmin.com/xmlschemas/TrainingCenterDatabase/v2 http://www.garmin.com/xmlschemas/TrainingCenterDatabasev2.xsd')
-            training_center_database.set('xmlns', 'http://www.garmin.com/xmlschemas/TrainingCenterDatabase/v2')
-            training_center_database.set('xmlns:xsd', 'http://www.w3.org/2001/XMLSchema')
-            training_center_database.set('xmlns:xsi', 'http://www.w3.org/2001/XMLSchema-instance')
-            training_center_database.set('xmlns:ns3', 'http://www.garmin.com/xmlschemas/ActivityExtension/v2')
-
-            # ** Activities
-            el_activities = xml_et.SubElement(training_center_database, 'Activities')
-
-            # *** Activity
-            el_activity = xml_et.SubElement(el_activities, 'Activity')
-            sport = self._get_sport()
-            el_activity.set('Sport', sport)
-
-            # Strange enough, according to TCX XSD the Id should be a date.
-            # TODO verify if this is the case for Strava too or if something more meaningful can be passed.
-            el_id = xml_et.SubElement(el_activity, 'Id')
-            el_id.text = _get_tz_aware_datetime(self.hi_activity.start, self.hi_activity.time_zone).isoformat('T')
-            # Generate the activity xml content based on the type of activity
-            if self.hi_activity.get_activity_type() in [HiActivity.TYPE_WALK,
-                                                        HiActivity.TYPE_RUN,
-                                                        HiActivity.TYPE_CYCLE,
-                                                        HiActivity.TYPE_HIKE,
-                                                        HiActivity.TYPE_MOUNTAIN_HIKE,
-                                                        HiActivity.TYPE_INDOOR_RUN,
-                                                        HiActivity.TYPE_INDOOR_CYCLE,
-                                                        HiActivity.TYPE_CROSS_TRAINER,
-                                                        HiActivity.TYPE_OTHER,
-                                                        HiActivity.TYPE_CROSSFIT,
-                                                        HiActivity.TYPE_CROSS_COUNTRY_RUN,
-                                                        HiActivity.TYPE_UNKNOWN]:
-                self._generate_walk_run_cycle_xml_data(el_activity)
-            elif self.hi_activity.get_activity_type() in [HiActivity.TYPE_POOL_SWIM,
-                                                          HiActivity.TYPE_OPEN_WATER_SWIM]:
-                self._generate_swim_xml_data(el_activity)
-            else:
-                logging.getLogger(PROGRAM_NAME).warning('Activity %s of type %s has no explicit XML generation method. '
-                                                        'Will attempt default XML generation method.',
-                                                        self.hi_activity.activity_id,
-                                                        self.hi_activity.get_activity_type())
-                self._generate_walk_run_cycle_xml_data(el_activity)
-
-            # *** Creator
-            # TODO: verify if information is available in JSON file
-            el_creator = xml_et.SubElement(el_activity, 'Creator')
-            el_creator.set('xsi:type', 'Device_t')
-            el_name = xml_et.SubElement(el_creator, 'Name')
-            el_name.text = 'Huawei Fitness Tracking Device'
-            el_unit_id = xml_et.SubElement(el_creator, 'UnitId')
-            el_unit_id.text = '0000000000'
-            el_product_id = xml_et.SubElement(el_creator, 'ProductID')
-            el_product_id.text = '0000'
-            el_version = xml_et.SubElement(el_creator, 'Version')
-            el_version_major = xml_et.SubElement(el_version, 'VersionMajor')
-            el_version_major.text = '0'
-            el_version_minor = xml_et.SubElement(el_version, 'VersionMinor')
-            el_version_minor.text = '0'
-            el_build_major = xml_et.SubElement(el_version, 'BuildMajor')
-            el_build_major.text = '0'
-            el_build_minor = xml_et.SubElement(el_version, 'BuildMinor')
-            el_build_minor.text = '0'
-
-            # * Author
-            el_author = xml_et.SubElement(training_center_database, 'Author')
-            el_author.set('xsi:type', 'Application_t')
-            el_name = xml_et.SubElement(el_author, 'Name')
-            el_build = xml_et.SubElement(el_author, 'Build')
-            el_version = xml_et.SubElement(el_build, 'Version')
-            el_version_major = xml_et.SubElement(el_version, 'VersionMajor')
-            el_version_major.text = PROGRAM_MAJOR_VERSION
-            el_version_minor = xml_et.SubElement(el_version, 'VersionMinor')
-            el_version_minor.text = PROGRAM_MINOR_VERSION
-            el_build_major = xml_et.SubElement(el_version, 'BuildMajor')
-            el_build_major.text = PROGRAM_MAJOR_BUILD
-            el_build_minor = xml_et.SubElement(el_version, 'BuildMinor')
-            el_build_minor.text = PROGRAM_MINOR_BUILD
-            el_lang_id = xml_et.SubElement(el_author, 'LangID')  # TODO verify if required/correct
-            el_lang_id.text = 'en'
-            el_part_number = xml_et.SubElement(el_author, 'PartNumber')  # TODO verify if required/correct
-            el_part_number.text = '000-00000-00'
-            el_name.text = 'H%ctr%cv%c' % \
-                           (chr(105), chr(97), chr(97))
-        except Exception as e:
-            logging.getLogger(PROGRAM_NAME).error('Error generating TCX XML content for activity <%s>\n%s',
-                                                  self.hi_activity.activity_id, e)
-            raise Exception('Error generating TCX XML content for activity <%s>\n%s', self.hi_activity.activity_id, e)
-
-        self.training_center_database = training_center_database
-        return training_center_database
-
-    def _generate_walk_run_cycle_xml_data(self, el_activity):
-        # **** Lap (a lap in the TCX XML corresponds to a segment in the HiActivity)
-        for n, segment in enumerate(self.hi_activity.get_segments()):
-            el_lap = self._generate_lap_header_xml_data(el_activity, segment)
-
-            # ***** Track
-            el_track = xml_et.SubElement(el_lap, 'Track')
-
-            segment_data = self.hi_activity.get_segment_data(segment)
-            if segment_data:
-                last_altitude = -1000
-                if 'altitude start' in self.hi_activity.activity_params:
-                    last_altitude = self.hi_activity.activity_params['altitude start']
-
-                for data in segment_data:
-                    el_trackpoint = xml_et.SubElement(el_track, 'Trackpoint')
-                    el_time = xml_et.SubElement(el_trackpoint, 'Time')
-                    el_time.text = _get_tz_aware_datetime(data['t'], self.hi_activity.time_zone).isoformat('T')
-
-                    if 'lat' in data:
-                        el_position = xml_et.SubElement(el_trackpoint, 'Position')
-                        el_latitude_degrees = xml_et.SubElement(el_position, 'LatitudeDegrees')
-                        el_latitude_degrees.text = str(data['lat'])
-                        el_longitude_degrees = xml_et.SubElement(el_position, 'LongitudeDegrees')
-                        el_longitude_degrees.text = str(data['lon'])
-
-                    if 'alti' in data:
-                        el_altitude_meters = xml_et.SubElement(el_trackpoint, 'AltitudeMeters')
-                        el_altitude_meters.text = str(data['alti'])
-                        last_altitude = data['alti']
-                    elif self.insert_altitude and last_altitude != -1000:
-                        el_altitude_meters = xml_et.SubElement(el_trackpoint, 'AltitudeMeters')
-                        el_altitude_meters.text = str(last_altitude)
-
-                    if 'distance' in data:
-                        el_distance_meters = xml_et.SubElement(el_trackpoint, 'DistanceMeters')
-                        el_distance_meters.text = str(data['distance'])
-
-                    if 'hr' in data:
-                        el_heart_rate_bpm = xml_et.SubElement(el_trackpoint, 'HeartRateBpm')
-                        el_heart_rate_bpm.set('xsi:type', 'HeartRateInBeatsPerMinute_t')
-                        value = xml_et.SubElement(el_heart_rate_bpm, 'Value')
-                        value.text = str(data['hr'])
-
-                    if 'cad' in data:
-                        if self.hi_activity.get_activity_type() in (HiActivity.TYPE_CYCLE, HiActivity.TYPE_INDOOR_CYCLE):
-                            el_cadence = xml_et.SubElement(el_trackpoint, 'Cadence')
-                            el_cadence.text = str(data['cad'])
-
-                    if 's-r' in data:  # Step frequency (for walking and running)
-                        if self.hi_activity.get_activity_type() in (HiActivity.TYPE_WALK, HiActivity.TYPE_RUN,
-                                                                    HiActivity.TYPE_HIKE, HiActivity.TYPE_MOUNTAIN_HIKE,
-                                                                    HiActivity.TYPE_CROSS_COUNTRY_RUN):
-                            el_extensions = xml_et.SubElement(el_trackpoint, 'Extensions')
-                            el_tpx = xml_et.SubElement(el_extensions, 'TPX')
-                            el_tpx.set('xmlns', 'http://www.garmin.com/xmlschemas/ActivityExtension/v2')
-                            el_run_cadence = xml_et.SubElement(el_tpx, 'RunCadence')
-                            # [Verified] Strava / TCX expects strides/minute (Strava displays steps/minute
-                            # in activity overview). The HiTrack information is in steps/minute. Divide by 2 to have
-                            # strides/minute in TCX.
-                            el_run_cadence.text = str(int(data['s-r'] / 2))
-            else:
-                # No detailed segment data. Create two (dummy) trackpoints at start and stop time of segment.
-                el_trackpoint = xml_et.SubElement(el_track, 'Trackpoint')
-                el_time = xml_et.SubElement(el_trackpoint, 'Time')
-                el_time.text = _get_tz_aware_datetime(segment['start'], self.hi_activity.time_zone).isoformat('T')
-                el_distance_meters = xml_et.SubElement(el_trackpoint, 'DistanceMeters')
-                el_distance_meters.text = '0'
-
-                el_trackpoint = xml_et.SubElement(el_track, 'Trackpoint')
-                el_time = xml_et.SubElement(el_trackpoint, 'Time')
-                el_time.text = _get_tz_aware_datetime(segment['stop'], self.hi_activity.time_zone).isoformat('T')
-                el_distance_meters = xml_et.SubElement(el_trackpoint, 'DistanceMeters')
-                el_distance_meters.text = str(segment['distance'])
-
-    def _generate_swim_xml_data(self, el_activity):
-        """ Generates the TCX XML content for swimming activities """
-
-        cumulative_distance = 0
-        for n, lap in enumerate(self.hi_activity.get_swim_data()):
-            el_lap = self._generate_lap_header_xml_data(el_activity, lap)
-            el_track = xml_et.SubElement(el_lap, 'Track')
+            _write_activity(self.hi_activity, [(self, xml_file)])
+        finally:
+            self.close()
 
+    def start(self, output_file: BinaryIO):
+        logging.getLogger(PROGRAM_NAME).debug('Generating TCX XML data for activity %s', self.hi_activity.activity_id)
+        super().start(output_file)
+        if self.compress:
+            # The modification time in the gzip header is the start of the activity and the header has no filename
+            # (files converted in parallel are renamed after saving), so the output is reproducible
+            output_file = self.gzip_file = gzip.GzipFile(filename='', fileobj=output_file, mode='wb',
+                                                         mtime=self.hi_activity.start // _MICROSECONDS_PER_SECOND)
+        # With XML validation, the TCX XML is generated and validated in memory before it is written to the TCX file
+        self.tcx_file = output_file
+        xml_writer = self.xml_writer = _XmlWriter(io.BytesIO() if self.tcx_xml_schema else output_file,
+                                                  indent=not self.compact)
+        xml_writer.write_declaration()
+
+        # * TrainingCenterDatabase
+        xml_writer.start('TrainingCenterDatabase',
+                         {'xsi:schemaLocation': 'http://www.garmin.com/xmlschemas/TrainingCenterDatabase/v2 http://www.garmin.com/xmlschemas/TrainingCenterDatabasev2.xsd',
+                          'xmlns': 'http://www.garmin.com/xmlschemas/TrainingCenterDatabase/v2',
+                          'xmlns:xsd': 'http://www.w3.org/2001/XMLSchema',
+                          'xmlns:xsi': 'http://www.w3.org/2001/XMLSchema-instance',
+                          'xmlns:ns3': 'http://www.garmin.com/xmlschemas/ActivityExtension/v2'})
+
+        # ** Activities
+        xml_writer.start('Activities')
+
+        # *** Activity
+        sport = self._get_sport()
+        xml_writer.start('Activity', {'Sport': sport})
+
+        # Strange enough, according to TCX XSD the Id should be a date.
+        # TODO verify if this is the case for Strava too or if something more meaningful can be passed.
+        xml_writer.element('Id', self.formatter.timestamp(self.hi_activity.start))
+        self.swim = self.hi_activity.get_activity_type() in self._SWIM_TYPES
+        self.cumulative_distance = 0
+
+    def start_lap(self, n: int, lap: dict):
+        # **** Lap (a lap in the TCX XML corresponds to a segment or swim lap in the HiActivity)
+        xml_writer = self.xml_writer
+        self._generate_lap_header_xml_data(xml_writer, lap)
+
+        # ***** Track
+        xml_writer.start('Track')
+        self.lap_data_count = 0
+        if self.swim:
             # Add first TrackPoint for start of lap
-            el_trackpoint = xml_et.SubElement(el_track, 'Trackpoint')
-            el_time = xml_et.SubElement(el_trackpoint, 'Time')
-            el_time.text = _get_tz_aware_datetime(lap['start'], self.hi_activity.time_zone).isoformat('T')
-            el_distance_meters = xml_et.SubElement(el_trackpoint, 'DistanceMeters')
-            el_distance_meters.text = str(cumulative_distance)
-
+            xml_writer.start('Trackpoint')
+            xml_writer.element('Time', self.formatter.timestamp(lap['start']))
+            xml_writer.element('DistanceMeters', self.formatter.distance(self.cumulative_distance))
+            xml_writer.end()  # Trackpoint
+        else:
+            self.last_altitude = -1000
+            if 'altitude start' in self.hi_activity.activity_params:
+                self.last_altitude = self.hi_activity.activity_params['altitude start']
+
+    def lap_data(self, data):
+        self.lap_data_count += 1
+        xml_writer = self.xml_writer
+        formatter = self.formatter
+        if self.swim:
             # Add track points for heart rate, position and distance
-            for i, lap_detail_data in enumerate(self.hi_activity.get_segment_data(self.hi_activity.get_segments()[n])):
-                if 'hr' in lap_detail_data or 'lat' in lap_detail_data or 'distance' in lap_detail_data:
-                    el_trackpoint = xml_et.SubElement(el_track, 'Trackpoint')
-                    el_time = xml_et.SubElement(el_trackpoint, 'Time')
-                    el_time.text = _get_tz_aware_datetime(lap_detail_data['t'],
-                                                          self.hi_activity.time_zone).isoformat('T', 'seconds')
+            if 'hr' in data or 'lat' in data or 'distance' in data:
+                xml_writer.start('Trackpoint')
+                xml_writer.element('Time', formatter.timestamp_seconds(data['t']))
 
                 # Add location records during lap (if any, only for open water swimming)
-                if 'lat' in lap_detail_data:
-                    el_position = xml_et.SubElement(el_trackpoint, 'Position')
-                    el_latitude_degrees = xml_et.SubElement(el_position, 'LatitudeDegrees')
-                    el_latitude_degrees.text = str(lap_detail_data['lat'])
-                    el_longitude_degrees = xml_et.SubElement(el_position, 'LongitudeDegrees')
-                    el_longitude_degrees.text = str(lap_detail_data['lon'])
+                if 'lat' in data:
+                    xml_writer.start('Position')
+                    xml_writer.element('LatitudeDegrees', formatter.coordinate(data['lat']))
+                    xml_writer.element('LongitudeDegrees', formatter.coordinate(data['lon']))
+                    xml_writer.end()  # Position
 
                 # Add heart rate records during lap
-                if 'hr' in lap_detail_data:
-                    el_heart_rate_bpm = xml_et.SubElement(el_trackpoint, 'HeartRateBpm')
-                    el_heart_rate_bpm.set('xsi:type', 'HeartRateInBeatsPerMinute_t')
-                    value = xml_et.SubElement(el_heart_rate_bpm, 'Value')
-                    value.text = str(lap_detail_data['hr'])
+                if 'hr' in data:
+                    xml_writer.start('HeartRateBpm', {'xsi:type': 'HeartRateInBeatsPerMinute_t'})
+                    xml_writer.element('Value', str(data['hr']))
+                    xml_writer.end()  # HeartRateBpm
 
                 # Add distance records during lap (if any, only for open water swimming)
-                if 'distance' in lap_detail_data:
-                    el_distance_meters = xml_et.SubElement(el_trackpoint, 'DistanceMeters')
-                    el_distance_meters.text = str(lap_detail_data['distance'])
+                if 'distance' in data:
+                    xml_writer.element('DistanceMeters', formatter.distance(data['distance']))
+                xml_writer.end()  # Trackpoint
+            return
 
+        xml_writer.start('Trackpoint')
+        xml_writer.element('Time', formatter.timestamp(data['t']))
+
+        if 'lat' in data:
+            xml_writer.start('Position')
+            xml_writer.element('LatitudeDegrees', formatter.coordinate(data['lat']))
+            xml_writer.element('LongitudeDegrees', formatter.coordinate(data['lon']))
+            xml_writer.end()  # Position
+
+        if 'alti' in data:
+            xml_writer.element('AltitudeMeters', formatter.distance(data['alti']))
+            self.last_altitude = data['alti']
+        elif self.insert_altitude and self.last_altitude != -1000:
+            xml_writer.element('AltitudeMeters', formatter.distance(self.last_altitude))
+
+        if 'distance' in data:
+            xml_writer.element('DistanceMeters', formatter.distance(data['distance']))
+
+        if 'hr' in data:
+            xml_writer.start('HeartRateBpm', {'xsi:type': 'HeartRateInBeatsPerMinute_t'})
+            xml_writer.element('Value', str(data['hr']))
+            xml_writer.end()  # HeartRateBpm
+
+        if 'cad' in data:
+            if self.hi_activity.get_activity_type() in self._CADENCE_TYPES:
+                xml_writer.element('Cadence', str(data['cad']))
+
+        if 's-r' in data:  # Step frequency (for walking and running)
+            if self.hi_activity.get_activity_type() in self._STEP_FREQUENCY_TYPES:
+                xml_writer.start('Extensions')
+                xml_writer.start('TPX', {'xmlns': 'http://www.garmin.com/xmlschemas/ActivityExtension/v2'})
+                # [Verified] Strava / TCX expects strides/minute (Strava displays steps/minute
+                # in activity overview). The HiTrack information is in steps/minute. Divide by 2 to have
+                # strides/minute in TCX.
+                xml_writer.element('RunCadence', str(int(data['s-r'] / 2)))
+                xml_writer.end()  # TPX
+                xml_writer.end()  # Extensions
+        xml_writer.end()  # Trackpoint
+
+    def end_lap(self, n: int, lap: dict):
+        xml_writer = self.xml_writer
+        if self.swim:
             # Add second TrackPoint for stop of lap
-            cumulative_distance += lap['distance']
-
-            el_trackpoint = xml_et.SubElement(el_track, 'Trackpoint')
-            el_time = xml_et.SubElement(el_trackpoint, 'Time')
-            el_time.text = _get_tz_aware_datetime(lap['stop'], self.hi_activity.time_zone).isoformat('T')
-            el_distance_meters = xml_et.SubElement(el_trackpoint, 'DistanceMeters')
-            el_distance_meters.text = str(cumulative_distance)
-        return
-
-    def _generate_lap_header_xml_data(self, el_activity, segment) -> xml_et.Element:
-        """ Generates the TCX XML lap header content part """
-        el_lap = xml_et.SubElement(el_activity, 'Lap')
-        el_lap.set('StartTime', _get_tz_aware_datetime(segment['start'], self.hi_activity.time_zone).isoformat('T'))
-        el_total_time_seconds = xml_et.SubElement(el_lap, 'TotalTimeSeconds')
-        el_total_time_seconds.text = str(segment['duration'])
+            self.cumulative_distance += lap['distance']
+
+            xml_writer.start('Trackpoint')
+            xml_writer.element('Time', self.formatter.timestamp(lap['stop']))
+            xml_writer.element('DistanceMeters', self.formatter.distance(self.cumulative_distance))
+            xml_writer.end()  # Trackpoint
+        elif not self.lap_data_count:
+            # No detailed segment data. Create two (dummy) trackpoints at start and stop time of segment.
+            xml_writer.start('Trackpoint')
+            xml_writer.element('Time', self.formatter.timestamp(lap['start']))
+            xml_writer.element('DistanceMeters', '0')
+            xml_writer.end()  # Trackpoint
+
+            xml_writer.start('Trackpoint')
+            xml_writer.element('Time', self.formatter.timestamp(lap['stop']))
+            xml_writer.element('DistanceMeters', self.formatter.distance(lap['distance']))
+            xml_writer.end()  # Trackpoint
+        xml_writer.end()  # Track
+        xml_writer.end()  # Lap
+
+    def end(self):
+        xml_writer = self.xml_writer
+        # *** Creator
+        # TODO: verify if information is available in JSON file
+        xml_writer.start('Creator', {'xsi:type': 'Device_t'})
+        xml_writer.element('Name', 'Huawei Fitness Tracking Device')
+        xml_writer.element('UnitId', '0000000000')
+        xml_writer.element('ProductID', '0000')
+        xml_writer.start('Version')
+        xml_writer.element('VersionMajor', '0')
+        xml_writer.element('VersionMinor', '0')
+        xml_writer.element('BuildMajor', '0')
+        xml_writer.element('BuildMinor', '0')
+        xml_writer.end()  # Version
+        xml_writer.end()  # Creator
+        xml_writer.end()  # Activity
+        xml_writer.end()  # Activities
+
+        # * Author
+        xml_writer.start('Author', {'xsi:type': 'Application_t'})
+        xml_writer.element('Name', 'H%ctr%cv%c' % (chr(105), chr(97), chr(97)))
+        xml_writer.start('Build')
+        xml_writer.start('Version')
+        xml_writer.element('VersionMajor', PROGRAM_MAJOR_VERSION)
+        xml_writer.element('VersionMinor', PROGRAM_MINOR_VERSION)
+        xml_writer.element('BuildMajor', PROGRAM_MAJOR_BUILD)
+        xml_writer.element('BuildMinor', PROGRAM_MINOR_BUILD)
+        xml_writer.end()  # Version
+        xml_writer.end()  # Build
+        xml_writer.element('LangID', 'en')  # TODO verify if required/correct
+        xml_writer.element('PartNumber', '000-00000-00')  # TODO verify if required/correct
+        xml_writer.end()  # Author
+
+        xml_writer.end()  # TrainingCenterDatabase
+        xml_writer.flush()
+
+        # Validate the TCX XML if option enabled before it is written to the TCX file
+        if self.tcx_xml_schema:
+            self._validate_xml(xml_writer.xml_file)
+            self.tcx_file.write(xml_writer.xml_file.getbuffer())
+        if self.gzip_file:
+            # Closes the compressed stream only, the TCX file itself is closed by the caller
+            self.gzip_file.close()
+            self.gzip_file = None
+            self.uncompressed_size = xml_writer.size
+        self.xml_writer = None
+
+    def close(self):
+        if self.gzip_file:
+            self.gzip_file.close()
+            self.gzip_file = None
+
+    def _generate_lap_header_xml_data(self, xml_writer: '_XmlWriter', segment):
+        """ Generates the TCX XML lap header content part. The Lap element is left open for the Track data. """
+        xml_writer.start('Lap', {'StartTime': self.formatter.timestamp(segment['start'])})
+        xml_writer.element('TotalTimeSeconds', str(segment['duration']))
         # Distance per segment. Use calculated distances. Although they may be off from the total distance provided
         # in the Huawei Health data, there is no straightforward way to derive the real distance per segment.
-        el_distance_meters = xml_et.SubElement(el_lap, 'DistanceMeters')
-        el_distance_meters.text = str(segment['distance'])
-        # Calories per segment. Assume even calorie consumption over all segments and distribute calories
-        # per segment based on the ratio segment distance / calculated total distance. For (indoor) activities
-        # without distance information, use a duration based ratio.
-        if self.hi_activity.calories > 0:
-            if self.hi_activity.calculated_distance > 0 and segment['distance'] > 0:
-                segment_calories = round(
-                    self.hi_activity.calories * segment['distance'] / self.hi_activity.calculated_distance)
-            else:
-                total_duration = (self.hi_activity.stop - self.hi_activity.start).seconds
-                segment_calories = round(self.hi_activity.calories * segment['duration'] / total_duration)
-        else:
-            segment_calories = 0
-        el_calories = xml_et.SubElement(el_lap, 'Calories')
-        el_calories.text = str(segment_calories)
-        el_intensity = xml_et.SubElement(el_lap, 'Intensity')  # TODO verify if required/correct
-        el_intensity.text = 'Active'
-        el_trigger_method = xml_et.SubElement(el_lap, 'TriggerMethod')  # TODO verify if required/correct
-        el_trigger_method.text = 'Manual'
-
-        return el_lap
-
-    def save(self, tcx_filename: str|None = None):
-        if not self.training_center_database:
-            # Call generation of TCX XML date if not already done
-            self.generate_xml()
-
-        # Format and save the TCX XML file
-        if not tcx_filename:
-            self.tcx_filename = self.save_dir + '/'
-            if self.filename_prefix:
-                # TODO verify timezone (un)aware display date / time
-                self.tcx_filename += dts.strftime(self.hi_activity.start, self.filename_prefix)
-            self.tcx_filename += self.hi_activity.activity_id
-            if self.filename_suffix:
-                self.tcx_filename += self.filename_suffix
-            self.tcx_filename += '.tcx'
-        else:
-            self.tcx_filename = tcx_filename
-        try:
-            logging.getLogger(PROGRAM_NAME).info('Saving TCX file <%s> for HiTrack activity <%s>', self.tcx_filename,
-                                                 self.hi_activity.activity_id)
-            self._format_xml(self.training_center_database)
-            xml_element_tree = xml_et.ElementTree(self.training_center_database)
-            # If output directory doesn't exist, make it.
-            if not os.path.exists(self.save_dir):
-                os.makedirs(self.save_dir)
-            # Save the TCX file
-            with open(self.tcx_filename, 'wb') as tcx_file:
-                tcx_file.write('<?xml version="1.0" encoding="UTF-8"?>'.encode('utf8'))
-                xml_element_tree.write(tcx_file, 'utf-8')
-        except Exception as e:
-            logging.getLogger(PROGRAM_NAME).error(
-                'Error saving TCX file <%s> for HiTrack activity <%s> to file <%s>\n%s',
-                self.tcx_filename, self.hi_activity.activity_id, e)
-            return
-        finally:
-            try:
-                if tcx_file and not tcx_file.closed:
-                    tcx_file.close()
-                    logging.getLogger(PROGRAM_NAME).debug('TCX file <%s> closed', tcx_file.name)
-            except Exception as e:
-                logging.getLogger(PROGRAM_NAME).error('Error closing TCX file <%s>\n', tcx_file.name, e)
+        xml_writer.element('DistanceMeters', self.formatter.distance(segment['distance']))
+        # Calories per segment
+        xml_writer.element('Calories', str(self.hi_activity.get_segment_calories(segment)))
+        xml_writer.element('Intensity', 'Active')  # TODO verify if required/correct
+        xml_writer.element('TriggerMethod', 'Manual')  # TODO verify if required/correct
 
-        # Validate the TCX XML file if option enabled
-        if self.tcx_xml_schema:
-            self._validate_xml(self.tcx_filename)
-
-    def _format_xml(self, element: xml_et.Element, level: int = 0):
-        """ Formats XML data by separating lines and adding whitespaces related to level for the XML element """
-        indent_prefix = "\n" + level * "  "
-        if len(element):
-            if not element.text or not element.text.strip():
-                element.text = indent_prefix + "  "
-            if not element.tail or not element.tail.strip():
-                element.tail = indent_prefix
-            for element in element:
-                self._format_xml(element, level + 1)
-            if not element.tail or not element.tail.strip():
-                element.tail = indent_prefix
-        else:
-            if level and (not element.tail or not element.tail.strip()):
-                element.tail = indent_prefix
-
-    def _validate_xml(self, tcx_xml_filename: str):
-        """ Validates the generated TCX XML file against the Garmin TrainingCenterDatabase version 2 XSD """
-        logging.getLogger(PROGRAM_NAME).info("Validating generated TCX XML file <%s> for activity <%s>",
-                                             tcx_xml_filename, self.hi_activity.activity_id)
+    def _validate_xml(self, tcx_xml: BinaryIO):
+        """ Validates the generated (in memory) TCX XML against the Garmin TrainingCenterDatabase version 2 XSD """
+        logging.getLogger(PROGRAM_NAME).info("Validating generated TCX XML for activity <%s>",
+                                             self.hi_activity.activity_id)
 
         try:
-            if not self.tcx_xml_schema:
-                logging.getLogger(PROGRAM_NAME).warning('Unable to validate TCX XML file for activity <%s>\n%s.' +
-                                                         'xmlschema library is not available.',self.hi_activity.activity_id)
-            else:
-                self.tcx_xml_schema.validate(tcx_xml_filename)
+            tcx_xml.seek(0)
+            self.tcx_xml_schema.validate(tcx_xml)
         except Exception as e:
-            logging.getLogger(PROGRAM_NAME).error('Error validating TCX XML file for activity <%s>\n%s',
+            logging.getLogger(PROGRAM_NAME).error('Error validating TCX XML for activity <%s>\n%s',
                                                   self.hi_activity.activity_id, e)
             raise Exception('Error validating TCX XML for activity <%s>\n%s', self.hi_activity.activity_id, e)
 
 
-def _init_tcx_xml_schema():
-    """ Retrieves the TCX XML XSD schema for validation of files from the internet """
+class _LxmlXmlSchema:
+    """ XSD schema validating XML with the lxml library, with the same validate() method as an xmlschema schema """
 
-    _TCX_XSD_FILE = 'TrainingCenterDatabasev2.xsd'
+    def __init__(self, xsd: bytes, xsd_filename: str):
+        self.schema = lxml_etree.XMLSchema(lxml_etree.ElementTree(lxml_etree.fromstring(xsd, base_url=xsd_filename)))
 
-    # Hold TCX XML schema in temporary directory
-    with tempfile.TemporaryDirectory(PROGRAM_NAME) as tempdir:
-        # Download and import schema to check against
+    def validate(self, source: BinaryIO):
+        """ Validates the XML in the source and raises an exception when it is invalid """
+        self.schema.assertValid(lxml_etree.parse(source))
+
+
+def _get_tcx_xsd(tcx_xsd_filename: str|None = None, cache_dir: str = CACHE_DIR) -> Optional[tuple]:
+    """ Returns the TCX XSD to validate the generated TCX XML against.
+    Parameters:
+    tcx_xsd_filename: Optional - A local copy of the TCX XSD. When not specified, the TCX XSD is retrieved once from
+        the internet and kept in the cache directory with its SHA-256 hash, so later conversions also validate without
+        internet connection. The cached copy is only used when its content matches the hash.
+    cache_dir: The directory to keep the retrieved TCX XSD in.
+    Returns:
+    A tuple with the filename and the content of the TCX XSD or None when validation can not be performed.
+    """
+    if tcx_xsd_filename:
         try:
-            logging.getLogger(PROGRAM_NAME).info("Retrieving TCX XSD from the internet. Please wait.")
-            url = 'https://www8.garmin.com/xmlschemas/TrainingCenterDatabasev2.xsd'
-            url_req.urlretrieve(url, tempdir + '/' + _TCX_XSD_FILE)
-        except:
-            logging.getLogger(PROGRAM_NAME).warning(
-                'Unable to retrieve TCX XML XSD schema from the web. Validation will not be performed.')
+            with open(tcx_xsd_filename, 'rb') as tcx_xsd_file:
+                return tcx_xsd_filename, tcx_xsd_file.read()
+        except OSError as e:
+            logging.getLogger(PROGRAM_NAME).warning('Unable to read TCX XML XSD schema <%s>. ' +
+                                                    'Validation will not be performed. ' +
+                                                    'The following exception occured: %s', tcx_xsd_filename, e)
             return None
 
+    tcx_xsd_filename = os.path.join(cache_dir, _TCX_XSD_FILE)
+    try:
+        with open(tcx_xsd_filename, 'rb') as tcx_xsd_file:
+            tcx_xsd = tcx_xsd_file.read()
+        with open(tcx_xsd_filename + '.sha256', 'r') as tcx_xsd_hash_file:
+            tcx_xsd_hash = tcx_xsd_hash_file.read().strip()
+        if hmac.compare_digest(hashlib.sha256(tcx_xsd).hexdigest(), tcx_xsd_hash):
+            return tcx_xsd_filename, tcx_xsd
+        logging.getLogger(PROGRAM_NAME).warning('Cached TCX XSD <%s> does not match its hash and is retrieved again',
+                                                tcx_xsd_filename)
+    except OSError:
+        pass
+
+    try:
+        logging.getLogger(PROGRAM_NAME).info("Retrieving TCX XSD from the internet. Please wait.")
+        with url_req.urlopen(_TCX_XSD_URL) as response:
+            tcx_xsd = response.read()
+    except Exception as e:
+        logging.getLogger(PROGRAM_NAME).warning(
+            'Unable to retrieve TCX XML XSD schema from the web and no cached copy is available in <%s>. ' +
+            'Validation will not be performed. Use the --tcx_xsd argument to specify a local copy of the ' +
+            'TCX XSD. The following exception occured: %s', cache_dir, e)
+        return None
+
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        with open(tcx_xsd_filename + '.tmp', 'wb') as tcx_xsd_file:
+            tcx_xsd_file.write(tcx_xsd)
+        with open(tcx_xsd_filename + '.sha256.tmp', 'w') as tcx_xsd_hash_file:
+            tcx_xsd_hash_file.write(hashlib.sha256(tcx_xsd).hexdigest())
+        os.replace(tcx_xsd_filename + '.tmp', tcx_xsd_filename)
+        os.replace(tcx_xsd_filename + '.sha256.tmp', tcx_xsd_filename + '.sha256')
+        logging.getLogger(PROGRAM_NAME).info('TCX XSD cached in <%s>', tcx_xsd_filename)
+    except OSError as e:
+        # Validation still works, the TCX XSD is just retrieved again the next time
+        logging.getLogger(PROGRAM_NAME).warning('Unable to cache TCX XSD in <%s>: %s', tcx_xsd_filename, e)
+    return tcx_xsd_filename, tcx_xsd
+
+
+def _init_tcx_xml_schema(tcx_xsd: tuple|None):
+    """ Initializes (compiles) the TCX XML XSD schema for validation of the generated TCX XML.
+    Parameters:
+    tcx_xsd: The filename and the content of the TCX XSD (see _get_tcx_xsd) or None
+    Returns:
+    The compiled TCX XML schema or None when validation can not be performed.
+    """
+    if not tcx_xsd:
+        return None
+    tcx_xsd_filename, tcx_xsd_content = tcx_xsd
+    try:
+        if lxml_etree:
+            return _LxmlXmlSchema(tcx_xsd_content, tcx_xsd_filename)
+        return xmlschema.XMLSchema(io.BytesIO(tcx_xsd_content),
+                                   base_url=os.path.dirname(os.path.abspath(tcx_xsd_filename)))
+    except NameError:
+        logging.getLogger(PROGRAM_NAME).warning(
+            'Unable to initialize XSD xchema for TCX XML. Validation will not be performed.\n' +
+            'Is library xmlschema or lxml installed?')
+        return None
+    except Exception as e:
+        logging.getLogger(PROGRAM_NAME).warning('TCX XML XSD schema <%s> could not be initialized. ' +
+                                                'Validation will not be performed. ' +
+                                                'The following exception occured: %s', tcx_xsd_filename, e)
+        return None
+
+
+# FIT base types: (base type field, struct format character)
+_FIT_ENUM = (0x00, 'B')
+_FIT_UINT8 = (0x02, 'B')
+_FIT_UINT16 = (0x84, 'H')
+_FIT_SINT32 = (0x85, 'i')
+_FIT_UINT32 = (0x86, 'I')
+
+
+def _get_fit_crc_table() -> tuple:
+    """ Returns the lookup table of the FIT CRC-16 (polynomial 0x8005, reflected) for one byte at a time """
+    crc_table = []
+    for byte in range(256):
+        crc = byte
+        for _ in range(8):
+            crc = (crc >> 1) ^ 0xA001 if crc & 1 else crc >> 1
+        crc_table.append(crc)
+    return tuple(crc_table)
+
+
+_FIT_CRC_TABLE = _get_fit_crc_table()
+
+
+def _fit_crc(data: bytes, crc: int = 0) -> int:
+    """ Returns the FIT CRC-16 of the data, continuing from crc """
+    crc_table = _FIT_CRC_TABLE
+    for byte in data:
+        crc = (crc >> 8) ^ crc_table[(crc ^ byte) & 0xFF]
+    return crc
+
+
+class _FitWriter:
+    """ Minimal FIT (Flexible and Interoperable Data Transfer) activity file writer.
+    Messages are encoded straight into binary data records. A definition message is only written when a message with a
+    new layout (global message number and fields) is written. The FIT file header contains the size of the data
+    records and the FIT file ends with a CRC over the header and all data records, so the data records are kept in
+    memory until the FIT file is finished. """
+    _PROTOCOL_VERSION = 0x20  # 2.0
+    _PROFILE_VERSION = 2100  # 21.00
+    _LOCAL_MESSAGE_TYPES = 16
+
+    def __init__(self, fit_file: BinaryIO):
+        self.fit_file = fit_file
+        self.data = bytearray()
+        # The local message type and struct per message layout (global message number, fields)
+        self.definitions = {}
+        self.local_message_layouts = [None] * self._LOCAL_MESSAGE_TYPES
+        self.next_local_message_type = 0
+
+    def _define(self, global_message_number: int, fields: tuple) -> struct.Struct:
+        """ Writes the definition message for a message layout and returns the struct to encode its data messages """
+        local_message_type = self.next_local_message_type
+        self.next_local_message_type = (local_message_type + 1) % self._LOCAL_MESSAGE_TYPES
+        # Reuse the local message type of the least recently defined message layout
+        previous_layout = self.local_message_layouts[local_message_type]
+        if previous_layout:
+            del self.definitions[previous_layout]
+        self.local_message_layouts[local_message_type] = (global_message_number, fields)
+
+        data_struct = struct.Struct('<B' + ''.join(base_type[1] for _, base_type in fields))
+        self.data += struct.pack('<BBBHB', 0x40 | local_message_type, 0, 0, global_message_number, len(fields))
+        for field_number, base_type in fields:
+            self.data += struct.pack('<BBB', field_number, struct.calcsize('<' + base_type[1]), base_type[0])
+        self.definitions[(global_message_number, fields)] = (local_message_type, data_struct)
+        return self.definitions[(global_message_number, fields)]
+
+    def message(self, global_message_number: int, fields: tuple, values: list|tuple):
+        """ Writes a data message.
+        Parameters:
+        global_message_number: The FIT global message number
+        fields: Tuple of (field definition number, FIT base type) per field of the message
+        values: The (scaled) integer values of the fields
+        """
+        definition = self.definitions.get((global_message_number, fields))
+        if definition is None:
+            definition = self._define(global_message_number, fields)
+        local_message_type, data_struct = definition
+        self.data += data_struct.pack(local_message_type, *values)
+
+    def finish(self):
+        """ Writes the FIT file header, the data records and the CRC to the FIT file """
+        header = struct.pack('<BBHI4s', 14, self._PROTOCOL_VERSION, self._PROFILE_VERSION, len(self.data), b'.FIT')
+        header += struct.pack('<H', _fit_crc(header))
+        self.fit_file.write(header)
+        self.fit_file.write(self.data)
+        self.fit_file.write(struct.pack('<H', _fit_crc(self.data, _fit_crc(header))))
+
+
+class FitActivity(ActivityWriter):
+    """ Converts a HiActivity to a binary FIT activity file with the same laps and track data as a TCX file """
+    FORMAT_NAME = 'FIT'
+    FILE_EXTENSION = '.fit'
+
+    # FIT global message numbers
+    _FILE_ID = 0
+    _SESSION = 18
+    _LAP = 19
+    _RECORD = 20
+    _EVENT = 21
+    _ACTIVITY = 34
+
+    # FIT timestamps are seconds since 1989-12-31 00:00:00 UTC
+    _FIT_EPOCH = 631065600
+
+    # (FIT sport, FIT sub sport) per activity type
+    _FIT_SPORT_TYPES = [(HiActivity.TYPE_WALK, (11, 0)),  # walking
+                        (HiActivity.TYPE_RUN, (1, 0)),  # running
+                        (HiActivity.TYPE_CYCLE, (2, 0)),  # cycling
+                        (HiActivity.TYPE_POOL_SWIM, (5, 17)),  # swimming, lap swimming
+                        (HiActivity.TYPE_OPEN_WATER_SWIM, (5, 18)),  # swimming, open water
+                        (HiActivity.TYPE_HIKE, (17, 0)),  # hiking
+                        (HiActivity.TYPE_MOUNTAIN_HIKE, (16, 0)),  # mountaineering
+                        (HiActivity.TYPE_INDOOR_RUN, (1, 1)),  # running, treadmill
+                        (HiActivity.TYPE_INDOOR_CYCLE, (2, 6)),  # cycling, indoor cycling
+                        (HiActivity.TYPE_CROSS_TRAINER, (4, 15)),  # fitness equipment, elliptical
+                        (HiActivity.TYPE_OTHER, (0, 0)),  # generic
+                        (HiActivity.TYPE_CROSSFIT, (10, 0)),  # training
+                        (HiActivity.TYPE_UNKNOWN, (0, 0)),
+                        (HiActivity.TYPE_CROSS_COUNTRY_RUN, (1, 3))]  # running, trail
+
+    # Record message fields
+    _TIMESTAMP = (253, _FIT_UINT32)
+    _POSITION = ((0, _FIT_SINT32), (1, _FIT_SINT32))  # position_lat, position_long in semicircles
+    _ALTITUDE = ((2, _FIT_UINT16),)  # (altitude + 500) * 5 m
+    _HEART_RATE = ((3, _FIT_UINT8),)  # bpm
+    _CADENCE = ((4, _FIT_UINT8),)  # rpm
+    _DISTANCE = ((5, _FIT_UINT32),)  # 100 * m
+
+    _SEMICIRCLES_PER_DEGREE = 2 ** 31 / 180
+
+    def __init__(self, hi_activity: HiActivity, save_dir: str = OUTPUT_DIR, filename_prefix: str|None = None,
+                 filename_suffix: str|None = None, insert_altitude: bool = False, coordinate_decimals: int|None = None,
+                 distance_decimals: int|None = None):
+        # The FIT file has a fixed binary resolution of the coordinates and distances, the decimals are not used
+        super().__init__(hi_activity, save_dir, filename_prefix, filename_suffix, insert_altitude,
+                         coordinate_decimals, distance_decimals)
+        self.fit_writer = None
+        self.laps = []
+        self.last_altitude = -1000
+        self.lap_data_count = 0
+        self.cumulative_distance = 0
+
+    def _get_sport(self) -> tuple:
+        for activity_type, sport in self._FIT_SPORT_TYPES:
+            if activity_type == self.hi_activity.get_activity_type():
+                return sport
+        logging.getLogger(PROGRAM_NAME).warning('Activity <%s> has an undetermined/unknown sport type.',
+                                                self.hi_activity.activity_id)
+        return 0, 0
+
+    def _fit_timestamp(self, timestamp: int) -> int:
+        return timestamp // _MICROSECONDS_PER_SECOND - self._FIT_EPOCH
+
+    def generate_fit(self, fit_file: BinaryIO):
+        """ Generates the FIT data and writes it to the (binary) FIT file """
+        _write_activity(self.hi_activity, [(self, fit_file)])
+
+    def start(self, output_file: BinaryIO):
+        logging.getLogger(PROGRAM_NAME).debug('Generating FIT data for activity %s', self.hi_activity.activity_id)
+        self.fit_writer = _FitWriter(output_file)
+        self.swim = self.hi_activity.get_activity_type() in self._SWIM_TYPES
+        self.laps = []
+        self.cumulative_distance = 0
+        start = self._fit_timestamp(self.hi_activity.start)
+
+        # File id: activity file, development manufacturer
+        self.fit_writer.message(self._FILE_ID, ((0, _FIT_ENUM), (1, _FIT_UINT16), (2, _FIT_UINT16), (4, _FIT_UINT32)),
+                                (4, 255, 0, start))
+        # Timer start event
+        self.fit_writer.message(self._EVENT, (self._TIMESTAMP, (0, _FIT_ENUM), (1, _FIT_ENUM)), (start, 0, 0))
+
+    def start_lap(self, n: int, lap: dict):
+        self.lap_data_count = 0
+        if self.swim:
+            self._generate_record({'t': lap['start'], 'distance': self.cumulative_distance})
+        else:
+            self.last_altitude = self.hi_activity.activity_params.get('altitude start', -1000)
+
+    def lap_data(self, data):
+        self.lap_data_count += 1
+        if self.swim:
+            # Add records for heart rate, position and distance
+            if 'hr' in data or 'lat' in data or 'distance' in data:
+                self._generate_record(data)
+            return
+
+        altitude = None
+        if 'alti' in data:
+            altitude = self.last_altitude = data['alti']
+        elif self.insert_altitude and self.last_altitude != -1000:
+            altitude = self.last_altitude
+
+        cadence = None
+        activity_type = self.hi_activity.get_activity_type()
+        if 'cad' in data and activity_type in self._CADENCE_TYPES:
+            cadence = data['cad']
+        elif 's-r' in data and activity_type in self._STEP_FREQUENCY_TYPES:
+            cadence = data['s-r'] / 2  # steps/minute to strides/minute
+
+        self._generate_record(data, altitude, cadence)
+
+    def end_lap(self, n: int, lap: dict):
+        if self.swim:
+            self.cumulative_distance += lap['distance']
+            self._generate_record({'t': lap['stop'], 'distance': self.cumulative_distance})
+        elif not self.lap_data_count:
+            # No detailed segment data. Create two (dummy) records at start and stop time of segment.
+            self._generate_record({'t': lap['start'], 'distance': 0})
+            self._generate_record({'t': lap['stop'], 'distance': lap['distance']})
+        self._generate_lap(n, lap)
+        self.laps.append(lap)
+
+    def end(self):
+        fit_writer = self.fit_writer
+        laps = self.laps
+        start = self._fit_timestamp(self.hi_activity.start)
+        stop = self._fit_timestamp(self.hi_activity.stop) if self.hi_activity.stop else \
+            self._fit_timestamp(laps[-1]['stop']) if laps else start
+        # Timer stop all event
+        fit_writer.message(self._EVENT, (self._TIMESTAMP, (0, _FIT_ENUM), (1, _FIT_ENUM)), (stop, 0, 4))
+
+        # Session
+        sport, sub_sport = self._get_sport()
+        total_timer_time = round(sum(lap['duration'] for lap in laps) * 1000)
+        total_distance = self.hi_activity.distance if self.hi_activity.distance >= 0 else \
+            sum(lap['distance'] for lap in laps)
+        session_fields = (self._TIMESTAMP, (0, _FIT_ENUM), (1, _FIT_ENUM), (2, _FIT_UINT32), (5, _FIT_ENUM),
+                          (6, _FIT_ENUM), (7, _FIT_UINT32), (8, _FIT_UINT32), (9, _FIT_UINT32),
+                          (11, _FIT_UINT16), (25, _FIT_UINT16), (26, _FIT_UINT16))
+        session_values = [stop, 8, 1, start, sport, sub_sport, (stop - start) * 1000, total_timer_time,
+                          round(total_distance * 100), max(round(self.hi_activity.calories), 0), 0, len(laps)]
+        if self.hi_activity.get_activity_type() == HiActivity.TYPE_POOL_SWIM and self.hi_activity.pool_length > 0:
+            session_fields += ((44, _FIT_UINT16), (46, _FIT_ENUM))  # pool length (100 * m), metric
+            session_values += [round(self.hi_activity.pool_length * 100), 0]
+        fit_writer.message(self._SESSION, session_fields, session_values)
+
+        # Activity
+        activity_fields = (self._TIMESTAMP, (0, _FIT_UINT32), (1, _FIT_UINT16), (2, _FIT_ENUM), (3, _FIT_ENUM),
+                           (4, _FIT_ENUM))
+        activity_values = [stop, total_timer_time, 1, 0, 26, 1]
+        if self.hi_activity.time_zone:
+            activity_fields += ((5, _FIT_UINT32),)  # local timestamp
+            activity_values.append(stop + int(self.hi_activity.time_zone.utcoffset(None).total_seconds()))
+        fit_writer.message(self._ACTIVITY, activity_fields, activity_values)
+
+        fit_writer.finish()
+        self.fit_writer = None
+
+    def _generate_record(self, data, altitude=None, cadence=None):
+        """ Generates a FIT record message for a track point """
+        fields = (self._TIMESTAMP,)
+        values = [self._fit_timestamp(data['t'])]
+        if 'lat' in data:
+            fields += self._POSITION
+            values.append(max(min(round(data['lat'] * self._SEMICIRCLES_PER_DEGREE), 0x7FFFFFFF), -0x7FFFFFFF))
+            values.append(max(min(round(data['lon'] * self._SEMICIRCLES_PER_DEGREE), 0x7FFFFFFF), -0x7FFFFFFF))
+        if altitude is not None:
+            fields += self._ALTITUDE
+            values.append(max(min(round((altitude + 500) * 5), 0xFFFE), 0))
+        if 'distance' in data:
+            fields += self._DISTANCE
+            values.append(round(data['distance'] * 100))
+        if 'hr' in data:
+            fields += self._HEART_RATE
+            values.append(min(int(data['hr']), 0xFE))
+        if cadence is not None:
+            fields += self._CADENCE
+            values.append(min(int(cadence), 0xFE))
+        self.fit_writer.message(self._RECORD, fields, values)
+
+    def _generate_lap(self, n: int, lap: dict):
+        """ Generates a FIT lap message. It follows the record messages of the lap. """
+        sport, _ = self._get_sport()
+        fields = (self._TIMESTAMP, (254, _FIT_UINT16), (0, _FIT_ENUM), (1, _FIT_ENUM), (2, _FIT_UINT32),
+                  (7, _FIT_UINT32), (8, _FIT_UINT32), (9, _FIT_UINT32), (11, _FIT_UINT16), (23, _FIT_ENUM),
+                  (24, _FIT_ENUM), (25, _FIT_ENUM))
+        values = [self._fit_timestamp(lap['stop'] if lap['stop'] else self.hi_activity.stop), n, 9, 1,
+                  self._fit_timestamp(lap['start']), round(lap['duration'] * 1000), round(lap['duration'] * 1000),
+                  max(round(lap['distance'] * 100), 0),
+                  self.hi_activity.get_segment_calories(lap), 0, 0, sport]
+        if 'strokes' in lap:
+            fields += ((10, _FIT_UINT32),)  # total cycles (strokes)
+            values.append(lap['strokes'])
+        self.fit_writer.message(self._LAP, fields, values)
+
+
+class GpxActivity(ActivityWriter):
+    """ Converts a HiActivity to a GPX 1.1 track. Each lap is a track segment. Only detail data with a location is
+    written, as a track point with the altitude, heart rate and cadence (Garmin TrackPointExtension) of that time. """
+    FORMAT_NAME = 'GPX'
+    FILE_EXTENSION = '.gpx'
+
+    def __init__(self, hi_activity: HiActivity, save_dir: str = OUTPUT_DIR, filename_prefix: str|None = None,
+                 filename_suffix: str|None = None, insert_altitude: bool = False, coordinate_decimals: int|None = None,
+                 distance_decimals: int|None = None):
+        super().__init__(hi_activity, save_dir, filename_prefix, filename_suffix, insert_altitude,
+                         coordinate_decimals, distance_decimals)
+        self.xml_writer = None
+        self.last_altitude = -1000
+
+    def start(self, output_file: BinaryIO):
+        logging.getLogger(PROGRAM_NAME).debug('Generating GPX data for activity %s', self.hi_activity.activity_id)
+        super().start(output_file)
+        xml_writer = self.xml_writer = _XmlWriter(output_file)
+        xml_writer.write_declaration()
+        xml_writer.start('gpx', {'version': '1.1',
+                                 'creator': PROGRAM_NAME,
+                                 'xmlns': 'http://www.topografix.com/GPX/1/1',
+                                 'xmlns:xsi': 'http://www.w3.org/2001/XMLSchema-instance',
+                                 'xmlns:gpxtpx': 'http://www.garmin.com/xmlschemas/TrackPointExtension/v1',
+                                 'xsi:schemaLocation': 'http://www.topografix.com/GPX/1/1 http://www.topografix.com/GPX/1/1/gpx.xsd'})
+        xml_writer.start('metadata')
+        xml_writer.element('time', self.formatter.timestamp(self.hi_activity.start))
+        xml_writer.end()  # metadata
+        xml_writer.start('trk')
+        xml_writer.element('name', self.hi_activity.activity_id)
+        sport = [item[1] for item in TcxActivity._STRAVA_SPORT_TYPES
+                 if item[0] == self.hi_activity.get_activity_type()]
+        xml_writer.element('type', sport[0] if sport else TcxActivity._SPORT_OTHER)
+
+    def start_lap(self, n: int, lap: dict):
+        self.xml_writer.start('trkseg')
+        self.last_altitude = self.hi_activity.activity_params.get('altitude start', -1000)
+
+    def lap_data(self, data):
+        if 'alti' in data:
+            self.last_altitude = data['alti']
+        if 'lat' not in data:
+            return
+
+        xml_writer = self.xml_writer
+        formatter = self.formatter
+        xml_writer.start('trkpt', {'lat': formatter.coordinate(data['lat']), 'lon': formatter.coordinate(data['lon'])})
+        if 'alti' in data or (self.insert_altitude and self.last_altitude != -1000):
+            xml_writer.element('ele', formatter.distance(self.last_altitude))
+        xml_writer.element('time', formatter.timestamp(data['t']))
+
+        cadence = None
+        if 'cad' in data and self.hi_activity.get_activity_type() in self._CADENCE_TYPES:
+            cadence = data['cad']
+        elif 's-r' in data and self.hi_activity.get_activity_type() in self._STEP_FREQUENCY_TYPES:
+            cadence = int(data['s-r'] / 2)  # steps/minute to strides/minute
+        if 'hr' in data or cadence is not None:
+            xml_writer.start('extensions')
+            xml_writer.start('gpxtpx:TrackPointExtension')
+            if 'hr' in data:
+                xml_writer.element('gpxtpx:hr', str(data['hr']))
+            if cadence is not None:
+                xml_writer.element('gpxtpx:cad', str(cadence))
+            xml_writer.end()  # gpxtpx:TrackPointExtension
+            xml_writer.end()  # extensions
+        xml_writer.end()  # trkpt
+
+    def end_lap(self, n: int, lap: dict):
+        self.xml_writer.end()  # trkseg
+
+    def end(self):
+        self.xml_writer.end()  # trk
+        self.xml_writer.end()  # gpx
+        self.xml_writer.flush()
+        self.xml_writer = None
+
+
+class CsvActivity(ActivityWriter):
+    """ Exports all detail data of a HiActivity as a table with one row per timestamp, e.g. for analysis of the data.
+    The last column is the index of the lap (segment or swim lap) of the data. Missing values are empty. """
+    FORMAT_NAME = 'CSV'
+    FILE_EXTENSION = '.csv'
+
+    _COLUMNS = ('lat', 'lon', 'alti', 'distance', 'hr', 'cad', 's-r', 'rs')
+    _BUFFER_SIZE = 4096
+
+    def __init__(self, hi_activity: HiActivity, save_dir: str = OUTPUT_DIR, filename_prefix: str|None = None,
+                 filename_suffix: str|None = None, insert_altitude: bool = False, coordinate_decimals: int|None = None,
+                 distance_decimals: int|None = None):
+        super().__init__(hi_activity, save_dir, filename_prefix, filename_suffix, insert_altitude,
+                         coordinate_decimals, distance_decimals)
+        self.csv_file = None
+        self.rows = []
+        self.column_formatters = ()
+        self.lap_index = ''
+
+    def start(self, output_file: BinaryIO):
+        logging.getLogger(PROGRAM_NAME).debug('Generating CSV data for activity %s', self.hi_activity.activity_id)
+        super().start(output_file)
+        formatter = self.formatter
+        # The formatting function per column
+        self.column_formatters = tuple(formatter.coordinate if column in ('lat', 'lon') else
+                                       formatter.distance if column in ('alti', 'distance') else str
+                                       for column in self._COLUMNS)
+        self.csv_file = output_file
+        self.rows = [','.join(('t',) + self._COLUMNS + ('segment',))]
+
+    def start_lap(self, n: int, lap: dict):
+        self.lap_index = str(n)
+
+    def lap_data(self, data):
+        row = [self.formatter.timestamp(data['t'])]
+        for column, column_formatter in zip(self._COLUMNS, self.column_formatters):
+            value = data.get(column)
+            row.append('' if value is None else column_formatter(value))
+        row.append(self.lap_index)
+        self.rows.append(','.join(row))
+        if len(self.rows) >= self._BUFFER_SIZE:
+            self._flush()
+
+    def _flush(self):
+        self.csv_file.write(''.join(row + '\n' for row in self.rows).encode('utf-8'))
+        self.rows = []
+
+    def end(self):
+        self._flush()
+        self.csv_file = None
+
+
+def _write_activity(hi_activity: HiActivity, writers: list):
+    """ Writes the activity with all output writers in a single pass over the laps and detail data of the activity.
+
+    Parameters:
+    hi_activity (HiActivity): The activity
+    writers (list): The (ActivityWriter, binary output file) tuples
+    """
+    swim = hi_activity.get_activity_type() in ActivityWriter._SWIM_TYPES
+    if not swim and hi_activity.get_activity_type() not in HiActivity._ACTIVITY_TYPE_LIST + (HiActivity.TYPE_UNKNOWN,):
+        logging.getLogger(PROGRAM_NAME).warning('Activity %s of type %s has no explicit output generation method. '
+                                                'Will attempt default output generation method.',
+                                                hi_activity.activity_id, hi_activity.get_activity_type())
+    try:
+        for writer, output_file in writers:
+            writer.start(output_file)
+
+        # For swimming activities, the laps are the swim laps.
+        laps = hi_activity.finalize()
+        segments = hi_activity.get_segments()
+        lap_data_methods = [writer.lap_data for writer, _ in writers]
+        for n, lap in enumerate(laps):
+            for writer, _ in writers:
+                writer.start_lap(n, lap)
+            for data in hi_activity.get_segment_data(segments[n]):
+                for lap_data in lap_data_methods:
+                    lap_data(data)
+            for writer, _ in writers:
+                writer.end_lap(n, lap)
+
+        for writer, _ in writers:
+            writer.end()
+    except Exception as e:
+        logging.getLogger(PROGRAM_NAME).error('Error generating %s content for activity <%s>\n%s',
+                                              '/'.join(writer.FORMAT_NAME for writer, _ in writers),
+                                              hi_activity.activity_id, e)
+        raise Exception('Error generating %s content for activity <%s>\n%s',
+                        '/'.join(writer.FORMAT_NAME for writer, _ in writers), hi_activity.activity_id, e)
+
+
+class _OutputStatistics:
+    """ The number of saved files and bytes written per output format, and the number of bytes before compression, to
+    report the aggregate output size and compression ratio at the end of the conversion. """
+
+    def __init__(self):
+        # Per output format: number of files, number of bytes written and number of bytes before compression
+        self.counters = {}
+
+    def add(self, format_name: str, size: int, uncompressed_size: int):
+        counter = self.counters.setdefault(format_name, [0, 0, 0])
+        counter[0] += 1
+        counter[1] += size
+        counter[2] += uncompressed_size
+
+    def merge(self, counters: dict):
+        """ Adds the counters of another _OutputStatistics (e.g. of a worker process) """
+        for format_name, (count, size, uncompressed_size) in counters.items():
+            counter = self.counters.setdefault(format_name, [0, 0, 0])
+            counter[0] += count
+            counter[1] += size
+            counter[2] += uncompressed_size
+
+    def log(self):
+        for format_name, (count, size, uncompressed_size) in self.counters.items():
+            if uncompressed_size != size:
+                logging.getLogger(PROGRAM_NAME).info(
+                    'Saved %d %s files: %.1f MB (%.1f MB uncompressed, compression ratio %.1f)', count, format_name,
+                    size / 1e6, uncompressed_size / 1e6, uncompressed_size / size if size else 0)
+            else:
+                logging.getLogger(PROGRAM_NAME).info('Saved %d %s files: %.1f MB', count, format_name, size / 1e6)
+
+
+# The output statistics of the activities saved by this process
+_output_statistics = _OutputStatistics()
+
+
+def _save_activity(hi_activity: HiActivity, writers: list, filenames: list) -> list:
+    """ Saves the activity in one file per output writer, in a single pass over the data of the activity.
+
+    Parameters:
+    hi_activity (HiActivity): The activity
+    writers (list): The output writers (ActivityWriter) of the activity
+    filenames (list): The filename per output writer. None for the default filename of the writer.
+
+    Returns:
+    list: The filename of the saved file per output writer or None if the file could not be saved
+    """
+    saved_filenames = [None] * len(writers)
+    with contextlib.ExitStack() as output_files:
+        opened_writers = []
+        for i, (writer, filename) in enumerate(zip(writers, filenames)):
+            writer.filename = filename if filename else writer.get_default_filename()
+            try:
+                logging.getLogger(PROGRAM_NAME).info('Saving %s file <%s> for HiTrack activity <%s>',
+                                                     writer.FORMAT_NAME, writer.filename, hi_activity.activity_id)
+                # If output directory doesn't exist, make it (worker processes converting in parallel can race here).
+                os.makedirs(writer.save_dir, exist_ok=True)
+                output_file = output_files.enter_context(open(writer.filename, 'wb'))
+                # Close the streams of the writer on the output file (e.g. a gzip stream) before the output file
+                output_files.callback(writer.close)
+                opened_writers.append((writer, output_file))
+                saved_filenames[i] = writer.filename
+            except Exception as e:
+                logging.getLogger(PROGRAM_NAME).error('Error saving %s file <%s> for HiTrack activity <%s>\n%s',
+                                                      writer.FORMAT_NAME, writer.filename, hi_activity.activity_id, e)
+        if not opened_writers:
+            return saved_filenames
+
         try:
-            tcx_xml_schema = xmlschema.XMLSchema(tempdir + '/' + _TCX_XSD_FILE)
-            return tcx_xml_schema
-        except NameError:
-            logging.getLogger(PROGRAM_NAME).warning(
-                'Unable to initialize XSD xchema for TCX XML. Validation will not be performed.\n' +
-                'Is library xmlschema installed?')
-            return None
-        except Exception as e:
-            logging.getLogger(PROGRAM_NAME).warning('TCX XML XSD schema was successfully retrieved from the web ' +
-                                                    'but could not be initialized. Validation will not be performed. ' +
-                                                    'The following exception occured: %s', e)
+            _write_activity(hi_activity, opened_writers)
+        except Exception:
+            # Do not leave incomplete files behind
+            output_files.close()
+            for writer, _ in opened_writers:
+                try:
+                    os.remove(writer.filename)
+                except OSError:
+                    pass
+            raise
+
+        for writer, output_file in opened_writers:
+            size = output_file.tell()
+            if writer.uncompressed_size is not None:
+                logging.getLogger(PROGRAM_NAME).info('Saved %s file <%s>: %d bytes (%d bytes uncompressed)',
+                                                     writer.FORMAT_NAME, writer.filename, size,
+                                                     writer.uncompressed_size)
+                _output_statistics.add(writer.FORMAT_NAME, size, writer.uncompressed_size)
+            else:
+                logging.getLogger(PROGRAM_NAME).info('Saved %s file <%s>: %d bytes', writer.FORMAT_NAME,
+                                                     writer.filename, size)
+                _output_statistics.add(writer.FORMAT_NAME, size, size)
+    return saved_filenames
+
+
+def _calc_distances(points1: list, points2: list, method: str = DISTANCE_VINCENTY) -> list:
+    """ Calculates the distances (in m) between the locations in points1 and the locations at the same index in
+    points2 in one batch. Uses vectorized NumPy calculations when NumPy is available, pure Python otherwise.
+
+    Maximum deviation of the methods compared to the pure Python Vincenty reference method (HiActivity._vincenty), for
+    locations up to 0.3 degree apart (see tests/test_distances.py):
+    - vincenty: pure Python is identical, NumPy deviates at most 1e-6 m per distance (rounding of the last decimal)
+    - andoyer_lambert: 0.01 % (relative)
+    - haversine: 0.6 % (relative)
+
+    :param points1:
+    List of (latitude, longitude) tuples
+    :param points2:
+    List of (latitude, longitude) tuples
+    :param method:
+    One of the DISTANCE_METHODS
+    :return:
+    List with the distance between each pair of locations
+    """
+    if method not in DISTANCE_METHODS:
+        logging.getLogger(PROGRAM_NAME).error('Invalid distance calculation method <%s>', method)
+        raise Exception('Invalid distance calculation method <%s>', method)
+    if not points1:
+        return []
+
+    if numpy is not None:
+        lat1, lon1 = numpy.radians(numpy.array(points1, dtype=numpy.float64)).T
+        lat2, lon2 = numpy.radians(numpy.array(points2, dtype=numpy.float64)).T
+        if method == DISTANCE_VINCENTY:
+            distances = _vincenty_numpy(lat1, lon1, lat2, lon2)
+        elif method == DISTANCE_ANDOYER_LAMBERT:
+            distances = _andoyer_lambert(numpy, lat1, lon1, lat2, lon2)
+        else:
+            distances = _haversine(numpy, lat1, lon1, lat2, lon2)
+        return distances.tolist()
+
+    if method == DISTANCE_VINCENTY:
+        return [HiActivity._vincenty(point1, point2) for point1, point2 in zip(points1, points2)]
+    distance_function = _andoyer_lambert if method == DISTANCE_ANDOYER_LAMBERT else _haversine
+    return [distance_function(math, math.radians(point1[0]), math.radians(point1[1]),
+                              math.radians(point2[0]), math.radians(point2[1]))
+            for point1, point2 in zip(points1, points2)]
+
+
+def _vincenty_numpy(lat1, lon1, lat2, lon2):
+    """ Vectorized version of HiActivity._vincenty(). All parameters are NumPy arrays with angles in radians. """
+    MAX_ITERATIONS = 200
+    CONVERGENCE_THRESHOLD = 1e-12
+    f = _WGS84_F
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        U1 = numpy.arctan((1 - f) * numpy.tan(lat1))
+        U2 = numpy.arctan((1 - f) * numpy.tan(lat2))
+        L = lon2 - lon1
+        Lambda = L.copy()
+        sinU1 = numpy.sin(U1)
+        cosU1 = numpy.cos(U1)
+        sinU2 = numpy.sin(U2)
+        cosU2 = numpy.cos(U2)
+        # Identical points have distance 0, calculate only the other pairs until they converge.
+        active = (lat1 != lat2) | (lon1 != lon2)
+        sinSigma = numpy.zeros_like(L)
+        cosSigma = numpy.ones_like(L)
+        sigma = numpy.zeros_like(L)
+        cosSqAlpha = numpy.ones_like(L)
+        cos2SigmaM = numpy.zeros_like(L)
+        for iteration in range(MAX_ITERATIONS):
+            if not active.any():
+                break
+            i = numpy.flatnonzero(active)
+            sinLambda = numpy.sin(Lambda[i])
+            cosLambda = numpy.cos(Lambda[i])
+            sinSigma[i] = numpy.sqrt((cosU2[i] * sinLambda) ** 2 +
+                                     (cosU1[i] * sinU2[i] - sinU1[i] * cosU2[i] * cosLambda) ** 2)
+            cosSigma[i] = sinU1[i] * sinU2[i] + cosU1[i] * cosU2[i] * cosLambda
+            sigma[i] = numpy.arctan2(sinSigma[i], cosSigma[i])
+            sinAlpha = cosU1[i] * cosU2[i] * sinLambda / sinSigma[i]
+            cosSqAlpha[i] = 1 - sinAlpha ** 2
+            cos2SigmaM[i] = numpy.where(cosSqAlpha[i] != 0,
+                                        cosSigma[i] - 2 * sinU1[i] * sinU2[i] / cosSqAlpha[i], 0)
+            C = f / 16 * cosSqAlpha[i] * (4 + f * (4 - 3 * cosSqAlpha[i]))
+            LambdaPrev = Lambda[i]
+            Lambda[i] = L[i] + (1 - C) * f * sinAlpha * (sigma[i] + C * sinSigma[i] *
+                                                         (cos2SigmaM[i] + C * cosSigma[i] *
+                                                          (-1 + 2 * cos2SigmaM[i] ** 2)))
+            # Coincident points (sinSigma = 0) have distance 0 and are done as well.
+            done = (numpy.abs(Lambda[i] - LambdaPrev) < CONVERGENCE_THRESHOLD) | (sinSigma[i] == 0)
+            active[i[done]] = False
+        else:
+            if active.any():
+                n = numpy.flatnonzero(active)[0]
+                point1 = (math.degrees(lat1[n]), math.degrees(lon1[n]))
+                point2 = (math.degrees(lat2[n]), math.degrees(lon2[n]))
+                logging.getLogger(PROGRAM_NAME).error('Failed to calculate distance between %s and %s', point1, point2)
+                raise Exception('Failed to calculate distance between %s and %s', point1, point2)
+
+        uSq = cosSqAlpha * (_WGS84_A ** 2 - _WGS84_B ** 2) / (_WGS84_B ** 2)
+        A = 1 + uSq / 16384 * (4096 + uSq * (-768 + uSq * (320 - 175 * uSq)))
+        B = uSq / 1024 * (256 + uSq * (-128 + uSq * (74 - 47 * uSq)))
+        deltaSigma = B * sinSigma * (cos2SigmaM + B / 4 * (cosSigma *
+                                                           (-1 + 2 * cos2SigmaM ** 2) - B / 6 * cos2SigmaM *
+                                                           (-3 + 4 * sinSigma ** 2) * (-3 + 4 * cos2SigmaM ** 2)))
+        s = _WGS84_B * A * (sigma - deltaSigma)
+    s[sinSigma == 0] = 0.0
+
+    return numpy.round(s, 6)
+
+
+def _haversine(xp, lat1, lon1, lat2, lon2):
+    """ Great circle distance with the WGS 84 mean earth radius. Angles in radians.
+    xp is the math module (scalar values) or the numpy module (arrays). """
+    asin = numpy.arcsin if xp is numpy else math.asin
+    h = xp.sin((lat2 - lat1) / 2) ** 2 + xp.cos(lat1) * xp.cos(lat2) * xp.sin((lon2 - lon1) / 2) ** 2
+    return 2 * _WGS84_MEAN_RADIUS * asin(xp.sqrt(h))
+
+
+def _andoyer_lambert(xp, lat1, lon1, lat2, lon2):
+    """ Andoyer-Lambert distance: spherical distance between the reduced latitudes with a first order flattening
+    correction. Angles in radians. xp is the math module (scalar values) or the numpy module (arrays). """
+    asin, atan = (numpy.arcsin, numpy.arctan) if xp is numpy else (math.asin, math.atan)
+    f = _WGS84_F
+    beta1 = atan((1 - f) * xp.tan(lat1))
+    beta2 = atan((1 - f) * xp.tan(lat2))
+    # Central angle (haversine formula on the reduced latitudes, well-conditioned for short distances)
+    h = xp.sin((beta2 - beta1) / 2) ** 2 + xp.cos(beta1) * xp.cos(beta2) * xp.sin((lon2 - lon1) / 2) ** 2
+    sigma = 2 * asin(xp.sqrt(h))
+    if xp is math and sigma == 0:
+        return 0.0
+    p = (beta1 + beta2) / 2
+    q = (beta2 - beta1) / 2
+    with numpy.errstate(divide='ignore', invalid='ignore') if xp is numpy else contextlib.nullcontext():
+        x = (sigma - xp.sin(sigma)) * (xp.sin(p) * xp.cos(q)) ** 2 / xp.cos(sigma / 2) ** 2
+        y = (sigma + xp.sin(sigma)) * (xp.cos(p) * xp.sin(q)) ** 2 / xp.sin(sigma / 2) ** 2
+        distance = _WGS84_A * (sigma - f / 2 * (x + y))
+    if xp is numpy:
+        distance[sigma == 0] = 0.0
+    return distance
 
 
 def _convert_hitrack_timestamp(hitrack_timestamp: float, timestamp_ref: dts|None = None) -> dts:
-    """ Converts the different timestamp formats appearing in HiTrack files to a Python datetime.
-
-    Known formats are
-    - seconds (e.g. 1516273200 or 1.5162732E9)
-    - milliseconds (e.g. 1516273200000 or 1.5162732E12)
-    - seconds since start of day (e.g. 43200) relative to day of activity start
+    """ Converts a single timestamp in one of the formats appearing in HiTrack files (see _HiTrackTimestampConverter)
+    to a Python datetime (UTC).
     """
-    timestamp_digits = int(math.log10(hitrack_timestamp))
-    if timestamp_ref is not None and hitrack_timestamp < 604800:   # Assume activity not longer than a week.
-        # Relative seconds from timestamp reference
-        return dts.fromtimestamp((timestamp_ref + dts_delta(seconds=hitrack_timestamp)).timestamp(), datetime.UTC)
-    elif timestamp_digits == 9:
-        # Absolute epoch timestamp
-        return dts.fromtimestamp(int(hitrack_timestamp), datetime.UTC)
-
-    divisor = 10 ** (timestamp_digits - 9) if timestamp_digits > 9 else 0.1 ** (9 - timestamp_digits)
-    return dts.fromtimestamp(int(hitrack_timestamp / divisor), datetime.UTC)
-
-
-def _get_tz_aware_datetime(naive_datetime: dts, time_zone: tz):
-    """ All datetimes in the HiActivity are represented as UTC datetimes and are parsed as time zone unaware
-    (naive) datetime objects. This method returns the equivalent time zone aware datetime representation using the
-    time zone information of the HiTrack activity (if any). If the Hitrack activity has no time zone information,
-    UTC (GMT) time zone is assumed.
-
-    :param naive_datetime:
-    :type naive_datetime: datetime.datetime
+    return _to_datetime(_HiTrackTimestampConverter(timestamp_ref).convert(hitrack_timestamp))
+
+
+def _to_timestamp(datetime_value: dts) -> int:
+    """ Returns the timestamp (microseconds since epoch) of a time zone aware datetime """
+    return (datetime_value - _EPOCH) // _ONE_MICROSECOND
+
+
+def _to_datetime(timestamp: int) -> dts:
+    """ Returns the UTC datetime of a timestamp (microseconds since epoch) """
+    return _EPOCH + dts_delta(microseconds=timestamp)
+
+
+def _get_tz_aware_datetime(timestamp: int, time_zone: tz):
+    """ All timestamps in the HiActivity are represented as microseconds since epoch (UTC). This method returns the
+    equivalent time zone aware datetime representation using the time zone information of the HiTrack activity
+    (if any). If the Hitrack activity has no time zone information, UTC (GMT) time zone is assumed.
+
+    :param timestamp:
+    :type timestamp: int
     :param time_zone:
     :type time_zone: datetime.timezone
     :return:
-    The (time zone) aware datetime corresponding to the naive datetime in the naive_datetime parameter
+    The (time zone) aware datetime corresponding to the timestamp in the timestamp parameter
     """
-    utc_datetime = dts.replace(naive_datetime, tzinfo=tz.utc)
+    utc_datetime = _EPOCH + dts_delta(microseconds=timestamp)
     if time_zone:
         aware_datetime = utc_datetime.astimezone(time_zone)
     else:
@@ -2072,6 +4254,14 @@ def _init_argument_parser() -> argparse.ArgumentParser:
                                                    --json argument to e.g. run the conversion again for the JSON \
                                                    activity or for debugging purposes.',
                             action='store_true')
+    json_group.add_argument('--hitrack_export', help='Exports a HiTrack file with the raw HiTrack data of each single \
+                                                     activity that is converted from the JSON file in the --json \
+                                                     argument, the ZIP file in the --zip argument or the tarball in \
+                                                     the --tar argument. The file will be exported to the directory \
+                                                     in the --output_dir argument. The \
+                                                     HiTrack data is always converted in memory, the exported file \
+                                                     can be reused in the --file argument or for debugging purposes.',
+                            action='store_true')
     file_group = parser.add_argument_group('FILE options')
     file_group.add_argument('-f', '--file', help='The filename of a single HiTrack file to convert.')
     file_group.add_argument('-s', '--sport', help='Force sport for the conversion. Sport will be auto-detected when \
@@ -2084,7 +4274,7 @@ def _init_argument_parser() -> argparse.ArgumentParser:
 
     tar_group = parser.add_argument_group('TAR options')
     tar_group.add_argument('-t', '--tar', help='The filename of an (unencrypted) tarball with HiTrack files to \
-                                                convert.')
+                                                convert. The tarball may be compressed with gzip, bzip2 or xz.')
 
     date_group = parser.add_argument_group('DATE options')
 
@@ -2100,6 +4290,24 @@ def _init_argument_parser() -> argparse.ArgumentParser:
                                                  if the activity started on FROM_DATE or later. Format YYYY-MM-DD',
                             type=from_date_type,
                             default='1970-01-01')
+    date_group.add_argument('--to_date', help='Applicable to --json, --zip and --tar options only. Only convert \
+                                               activities that started on TO_DATE or earlier. Format YYYY-MM-DD',
+                            type=from_date_type)
+
+    filter_group = parser.add_argument_group('FILTER options')
+    filter_group.add_argument('--sport_filter', help='Applicable to --json, --zip and --tar options only. Only convert \
+                                                      activities of these sports. The sport is determined from the \
+                                                      JSON data when possible, otherwise it is auto-detected. \
+                                                      Sports: ' + ', '.join(HiActivity._ACTIVITY_TYPE_LIST),
+                              nargs='+', metavar='SPORT',
+                              choices=HiActivity._ACTIVITY_TYPE_LIST)
+    filter_group.add_argument('--activity_id', help='Applicable to --json, --zip and --tar options only. Only convert \
+                                                     the activities with these ids. An id is either the HiTrack \
+                                                     filename of the activity (e.g. \
+                                                     HiTrack_15778980000015778996200012345) or the HiTrack_ name of \
+                                                     its start time (e.g. HiTrack_20200101_180000, in the local time \
+                                                     zone for --tar).',
+                              nargs='+')
 
     swim_group = parser.add_argument_group('SWIM options')
 
@@ -2132,6 +4340,12 @@ def _init_argument_parser() -> argparse.ArgumentParser:
     output_group.add_argument('--output_dir', help='The path to the directory to store the output files. The default \
                                              directory is ' + OUTPUT_DIR + '.',
                               default=OUTPUT_DIR)
+    output_group.add_argument('--output_format',
+                              help='The format(s) of the converted activity files: TCX XML files (default), much \
+                              smaller binary FIT files, GPX tracks and/or CSV tables with all detail data (one row \
+                              per timestamp). Multiple formats are written in a single pass over the data, e.g. \
+                              --output_format tcx csv.',
+                              choices=OUTPUT_FORMATS, nargs='+', default=[OUTPUT_FORMAT_TCX])
     output_group.add_argument('--use_original_filename',
                               help='In single FILE or TAR mode, when using this option the converted TCX files will \
                               have the same filename as the original input file (except from the file extension).',
@@ -2145,15 +4359,701 @@ def _init_argument_parser() -> argparse.ArgumentParser:
                               help='Suppresses the sequence number suffix in the filenames of converted TCX files when \
                               converting activities in ZIP or JSON mode.',
                               action='store_true')
-    output_group.add_argument('--validate_xml', help='Validate generated TCX XML file(s). NOTE: requires xmlschema library \
-                                                and an internet connection to retrieve the TCX XSD.',
+    output_group.add_argument('--incremental',
+                              help='Applicable to --json, --zip and --tar options only. Keeps a manifest of the \
+                              converted activities in the directory in the --output_dir argument and only converts \
+                              activities that are new or changed since the previous conversion with this option, \
+                              that were converted with different options or of which an output file was removed. \
+                              Unchanged activities are skipped.',
+                              action='store_true')
+    def decimals_type(arg):
+        decimals = int(arg)
+        if decimals < 0:
+            raise argparse.ArgumentTypeError("Number of decimals must be a positive integer value or 0.")
+        return decimals
+
+    output_group.add_argument('--coordinate_decimals',
+                              help='The number of decimals of the latitude and longitude in TCX, GPX and CSV files. \
+                              When not specified (default), coordinates are written with full precision.',
+                              type=decimals_type)
+    output_group.add_argument('--distance_decimals',
+                              help='The number of decimals of the distances and altitudes in TCX, GPX and CSV files. \
+                              When not specified (default), distances and altitudes are written with full precision.',
+                              type=decimals_type)
+    output_group.add_argument('--tcx_compact',
+                              help='Writes compact TCX files without indentation whitespace. Unless specified otherwise \
+                              with the --coordinate_decimals and --distance_decimals arguments, the coordinates are \
+                              written with 6 decimals (about 0.1 m) and the distances and altitudes with 1 decimal.',
+                              action='store_true')
+    output_group.add_argument('--tcx_gzip',
+                              help='Writes the TCX files gzip compressed (.tcx.gz files) while they are generated.',
                               action='store_true')
+    output_group.add_argument('--validate_xml', help='Validate generated TCX XML file(s). NOTE: requires xmlschema or \
+                                                (much faster) lxml library. The TCX XSD is retrieved from the internet once and cached in the \
+                                                directory ' + CACHE_DIR + ', unless the --tcx_xsd argument is used.',
+                              action='store_true')
+    output_group.add_argument('--tcx_xsd', help='The path to a local copy of the TCX XSD (TrainingCenterDatabasev2.xsd) \
+                                           to validate against with the --validate_xml argument, e.g. on a computer \
+                                           without internet connection.',
+                              type=str)
+    performance_group = parser.add_argument_group('PERFORMANCE options')
+    performance_group.add_argument('--columnar_store',
+                                   help='Stores the detail data of an activity in typed arrays per data type instead \
+                                   of a dictionary per timestamp. This strongly reduces memory usage when converting \
+                                   long activities or large exports.',
+                                   action='store_true')
+    performance_group.add_argument('--distance_method',
+                                   help='The method to calculate distances from the GPS data. vincenty (default) is \
+                                   the most accurate. andoyer_lambert (max. 0.01%% deviation from vincenty) and \
+                                   haversine (max. 0.6%% deviation from vincenty) are faster. Calculations are \
+                                   vectorized when the NumPy library is installed.',
+                                   type=str, choices=DISTANCE_METHODS, default=DISTANCE_VINCENTY)
+
+    def jobs_type(arg):
+        jobs = int(arg)
+        if jobs < 0:
+            raise argparse.ArgumentTypeError("Number of jobs must be a positive integer value or 0.")
+        return jobs
+
+    performance_group.add_argument('--jobs',
+                                   help='Applicable to --json, --zip and --tar options only. The number of worker \
+                                   processes that parse and convert the activities in parallel. Use 0 to use one \
+                                   worker process per CPU. Default is 1 (no worker processes).',
+                                   type=jobs_type, default=1)
+    performance_group.add_argument('--cache_dir',
+                                   help='Applicable to --json, --zip and --tar options only. Caches the parsed \
+                                   activities in this directory (default ' + os.path.join(CACHE_DIR, 'activities') + ' \
+                                   when no directory is specified), so a reconversion of the same activities with \
+                                   other output options skips the parsing. Not used with the --json_export and \
+                                   --hitrack_export arguments.',
+                                   nargs='?', const=os.path.join(CACHE_DIR, 'activities'), type=str)
+
+    def cache_size_type(arg):
+        cache_size = int(arg)
+        if cache_size < 1:
+            raise argparse.ArgumentTypeError("Cache size must be a positive integer value.")
+        return cache_size
+
+    performance_group.add_argument('--cache_size',
+                                   help='The maximum size in MB of the cache in the --cache_dir argument. The least \
+                                   recently used activities are removed from the cache when it is larger. Default is \
+                                   1024 MB.',
+                                   type=cache_size_type, default=1024)
+
     parser.add_argument('--log_level', help='Set the logging level.', type=str, choices=['INFO', 'DEBUG'],
                         default='INFO')
 
     return parser
 
 
+def _get_output_activities(hi_activity: HiActivity, args: argparse.Namespace, tcx_xml_schema=None,
+                           filename_suffix: str|None = None) -> list:
+    """ Returns the output writers (ActivityWriter) to save the activity in the --output_format(s) """
+    output_activities = []
+    for output_format in dict.fromkeys(args.output_format):
+        if output_format == OUTPUT_FORMAT_TCX:
+            output_activities.append(TcxActivity(hi_activity, tcx_xml_schema, args.output_dir,
+                                                 args.output_file_prefix, filename_suffix,
+                                                 args.tcx_insert_altitude_data, args.coordinate_decimals,
+                                                 args.distance_decimals, args.tcx_compact, args.tcx_gzip))
+        else:
+            writer_class = {OUTPUT_FORMAT_FIT: FitActivity,
+                            OUTPUT_FORMAT_GPX: GpxActivity,
+                            OUTPUT_FORMAT_CSV: CsvActivity}[output_format]
+            output_activities.append(writer_class(hi_activity, args.output_dir, args.output_file_prefix,
+                                                  filename_suffix, args.tcx_insert_altitude_data,
+                                                  args.coordinate_decimals, args.distance_decimals))
+    return output_activities
+
+
+def _get_output_file_suffix(n: int, args: argparse.Namespace) -> str:
+    """ Returns the filename suffix with the sequence number n of an activity from the --json, --zip or --tar options """
+    if not args.suppress_output_file_sequence:
+        output_file_suffix_format = '_%03d'
+    else:
+        output_file_suffix_format = '%.0s'
+    return output_file_suffix_format % (n % 1000)
+
+
+def _convert_activity(hi_activity: HiActivity, n: int, args: argparse.Namespace, tcx_xml_schema=None,
+                      output_file_suffix: str|None = None) -> list:
+    """ Converts a parsed activity from the --json, --zip or --tar options to a file per --output_format.
+
+    Parameters:
+    hi_activity (HiActivity): The parsed activity
+    n (int): The sequence number of the activity, used in the filename suffix
+    args (argparse.Namespace): The program arguments
+    tcx_xml_schema: Optional - The TCX XML schema to validate the TCX file
+    output_file_suffix (str): Optional - The filename suffix to use instead of the suffix with the sequence number
+
+    Returns:
+    list: The filename of the saved file per --output_format or None if the file could not be saved
+    """
+    if output_file_suffix is None:
+        output_file_suffix = _get_output_file_suffix(n, args)
+
+    if args.pool_length:
+        hi_activity.set_pool_length(args.pool_length)
+    if args.tar:
+        output_activities = _get_output_activities(hi_activity, args, tcx_xml_schema)
+        if args.use_original_filename:
+            output_filenames = [None] * len(output_activities)
+        else:
+            output_filenames = ["%s/HiTrack_%s%s%s" %
+                                (args.output_dir,
+                                 _get_tz_aware_datetime(hi_activity.start, hi_activity.time_zone).strftime('%Y%m%d_%H%M%S'),
+                                 output_file_suffix,
+                                 output_activity.file_extension
+                                 ) for output_activity in output_activities]
+    else:
+        if not args.tcx_use_raw_distance_data:
+            hi_activity.normalize_distances()
+        output_activities = _get_output_activities(hi_activity, args, tcx_xml_schema, output_file_suffix)
+        output_filenames = [None] * len(output_activities)
+    output_filenames = _save_activity(hi_activity, output_activities, output_filenames)
+    logging.getLogger(PROGRAM_NAME).info('Converted %s', hi_activity)
+    return [output_filename if output_filename and os.path.isfile(output_filename) else None
+            for output_filename in output_filenames]
+
+
+class _ConversionManifest:
+    """ The conversion manifest in the output directory records for each converted activity of the --json, --zip or
+    --tar options the content hash of its JSON data or HiTrack file, the program options that change the conversion
+    result and the filenames of its output files (one per --output_format). Activities that are unchanged since the
+    conversion recorded in the manifest, and whose output files all still exist, are skipped before parsing in the next
+    (incremental) run. """
+    _FILENAME = 'Hitrava_manifest.json'
+    _VERSION = 3
+
+    def __init__(self, args: argparse.Namespace):
+        self.manifest_filename = os.path.join(args.output_dir, self._FILENAME)
+        # The options changing the output files. The program version is included since the conversion itself changes
+        # between versions.
+        self.options = {'program_version': '%s.%s.%s' % (PROGRAM_MAJOR_VERSION, PROGRAM_MINOR_VERSION,
+                                                         PROGRAM_PATCH_VERSION),
+                        'pool_length': args.pool_length,
+                        'tcx_use_raw_distance_data': args.tcx_use_raw_distance_data,
+                        'tcx_insert_altitude_data': args.tcx_insert_altitude_data,
+                        'output_format': args.output_format,
+                        'coordinate_decimals': args.coordinate_decimals,
+                        'distance_decimals': args.distance_decimals,
+                        'tcx_compact': args.tcx_compact,
+                        'tcx_gzip': args.tcx_gzip,
+                        'distance_method': args.distance_method,
+                        'output_file_prefix': args.output_file_prefix,
+                        'suppress_output_file_sequence': args.suppress_output_file_sequence,
+                        'use_original_filename': args.use_original_filename}
+        self.activities = {}
+        self.converted_count = 0
+        self.changed_count = 0
+        self.skipped_count = 0
+
+        try:
+            with open(self.manifest_filename, 'r') as manifest_file:
+                manifest = json.load(manifest_file)
+            if manifest.get('version') == self._VERSION:
+                self.activities = manifest['activities']
+            else:
+                logging.getLogger(PROGRAM_NAME).warning('Ignored conversion manifest <%s> with unsupported version %s',
+                                                        self.manifest_filename, manifest.get('version'))
+        except FileNotFoundError:
+            logging.getLogger(PROGRAM_NAME).info('No conversion manifest <%s> found, all activities will be converted',
+                                                 self.manifest_filename)
+        except Exception as e:
+            logging.getLogger(PROGRAM_NAME).warning('Ignored invalid conversion manifest <%s>\n%s',
+                                                    self.manifest_filename, e)
+
+    def is_unchanged(self, activity_key: str, content_hash: str) -> bool:
+        """ Returns whether the activity was converted before with the same content and options and all its output
+        files still exist. Unchanged activities are counted as skipped. """
+        entry = self.activities.get(activity_key)
+        if entry and entry['hash'] == content_hash and entry['options'] == self.options and entry['output_files'] \
+                and all(os.path.isfile(output_filename) for output_filename in entry['output_files']):
+            logging.getLogger(PROGRAM_NAME).info('Skipped unchanged activity <%s>, converted before to <%s>',
+                                                 activity_key, '>, <'.join(entry['output_files']))
+            self.skipped_count += 1
+            return True
+        return False
+
+    def add(self, activity_key: str, content_hash: str, output_filenames: list):
+        """ Records the converted activity and its output files in the manifest """
+        if activity_key in self.activities:
+            self.changed_count += 1
+        else:
+            self.converted_count += 1
+        self.activities[activity_key] = {'hash': content_hash, 'options': self.options,
+                                         'output_files': list(output_filenames)}
+
+    def save(self):
+        """ Saves the manifest. The manifest is replaced at once, so an interrupted save keeps the previous one. """
+        try:
+            if not os.path.exists(os.path.dirname(self.manifest_filename)):
+                os.makedirs(os.path.dirname(self.manifest_filename))
+            with open(self.manifest_filename + '.tmp', 'w') as manifest_file:
+                json.dump({'version': self._VERSION, 'activities': self.activities}, manifest_file, indent=1)
+            os.replace(self.manifest_filename + '.tmp', self.manifest_filename)
+        except Exception as e:
+            logging.getLogger(PROGRAM_NAME).error('Error saving conversion manifest <%s>\n%s',
+                                                  self.manifest_filename, e)
+        logging.getLogger(PROGRAM_NAME).info(
+            'Incremental conversion: %d new activities converted, %d changed activities converted, '
+            '%d unchanged activities skipped', self.converted_count, self.changed_count, self.skipped_count)
+
+
+class _ParsedActivityCache:
+    """ Cache of the parsed activities of the --json, --zip and --tar options in the directory in the --cache_dir
+    argument. An activity is stored after parsing, activity type detection and (except for swimming activities, whose
+    swim data depends on the pool length) segment and distance calculation, in the binary format of HiActivity.encode,
+    zlib compressed. The entries are authenticated with an HMAC with a random key of the user in the cache directory,
+    so entries that were not written by the user (or were damaged) are ignored. The cache key is a hash of the activity
+    key and content hash of the activity data (see get_activity_fingerprint), the parser version and the parse
+    options, so a reconversion with other output options skips the parsing. When the cache exceeds its maximum size,
+    the least recently used activities are evicted. """
+    _VERSION = 3
+    _FILE_EXTENSION = '.hiactivity'
+    _KEY_FILENAME = 'Hitrava_cache.key'
+    _DIGEST_SIZE = 32  # HMAC-SHA256
+
+    def __init__(self, cache_dir: str, max_size: int, args: argparse.Namespace):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        # The versions and options that change the parsed activities
+        self.key_prefix = json.dumps([self._VERSION, HiActivity._ENCODING_VERSION, _PARSER_VERSION,
+                                      args.columnar_store, args.distance_method]).encode('utf-8')
+        self.hmac_key = self._get_hmac_key()
+
+    def _get_hmac_key(self) -> Optional[bytes]:
+        """ Returns the key to authenticate the entries, created on first use. None if the key file can not be used. """
+        key_filename = os.path.join(self.cache_dir, self._KEY_FILENAME)
+        try:
+            os.makedirs(self.cache_dir, mode=0o700, exist_ok=True)
+            try:
+                key_fd = os.open(key_filename, os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, 'O_BINARY', 0),
+                                 0o600)
+                with os.fdopen(key_fd, 'wb') as key_file:
+                    key_file.write(os.urandom(32))
+            except FileExistsError:
+                pass
+            key_stat = os.stat(key_filename)
+            if hasattr(os, 'getuid') and (key_stat.st_uid != os.getuid() or key_stat.st_mode & 0o077):
+                logging.getLogger(PROGRAM_NAME).warning('Cache key file <%s> is not private to the user, the cache is '
+                                                        'not used', key_filename)
+                return None
+            with open(key_filename, 'rb') as key_file:
+                key = key_file.read()
+            if len(key) != 32:
+                raise Exception('Invalid cache key file <%s>', key_filename)
+            return key
+        except Exception as e:
+            logging.getLogger(PROGRAM_NAME).warning('Error reading cache key file <%s>, the cache is not used\n%s',
+                                                    key_filename, e)
+            return None
+
+    def _get_filename(self, fingerprint: tuple) -> str:
+        key = hashlib.sha256(self.key_prefix + json.dumps(fingerprint).encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_dir, key + self._FILE_EXTENSION)
+
+    def get(self, fingerprint: tuple) -> Optional[HiActivity]:
+        """ Returns the cached parsed activity with the fingerprint (activity key, content hash) or None """
+        if not self.hmac_key:
+            return None
+        cache_filename = self._get_filename(fingerprint)
+        try:
+            with open(cache_filename, 'rb') as cache_file:
+                entry = cache_file.read()
+            digest, compressed = entry[:self._DIGEST_SIZE], entry[self._DIGEST_SIZE:]
+            if not hmac.compare_digest(digest, hmac.digest(self.hmac_key, compressed, 'sha256')):
+                raise Exception('Cached activity <%s> failed authentication', cache_filename)
+            hi_activity = HiActivity.decode(zlib.decompress(compressed))
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logging.getLogger(PROGRAM_NAME).warning('Error reading cached activity <%s>\n%s', cache_filename, e)
+            return None
+        try:
+            # Mark the activity as recently used
+            os.utime(cache_filename)
+        except OSError:
+            pass
+        return hi_activity
+
+    def put(self, fingerprint: tuple, hi_activity: HiActivity):
+        if not self.hmac_key:
+            return
+        if hi_activity.get_activity_type() not in ActivityWriter._SWIM_TYPES:
+            hi_activity.finalize()
+        cache_filename = self._get_filename(fingerprint)
+        try:
+            compressed = zlib.compress(hi_activity.encode(), 1)
+            # Written under a temporary name, the worker processes may store the same activity concurrently
+            with open('%s.%d.tmp' % (cache_filename, os.getpid()), 'wb') as cache_file:
+                cache_file.write(hmac.digest(self.hmac_key, compressed, 'sha256'))
+                cache_file.write(compressed)
+            os.replace('%s.%d.tmp' % (cache_filename, os.getpid()), cache_filename)
+        except Exception as e:
+            logging.getLogger(PROGRAM_NAME).warning('Error caching activity <%s> in <%s>\n%s',
+                                                    hi_activity.activity_id, cache_filename, e)
+
+    def evict(self):
+        """ Removes the least recently used activities until the size of the cache does not exceed the maximum """
+        try:
+            cache_entries = [(entry.stat().st_mtime, entry.stat().st_size, entry.path)
+                             for entry in os.scandir(self.cache_dir) if entry.name.endswith(self._FILE_EXTENSION)]
+        except FileNotFoundError:
+            return
+        size = sum(entry_size for _, entry_size, _ in cache_entries)
+        evicted_count = 0
+        evicted_size = 0
+        for _, entry_size, path in sorted(cache_entries):
+            if size - evicted_size <= self.max_size:
+                break
+            try:
+                os.remove(path)
+                evicted_count += 1
+                evicted_size += entry_size
+            except OSError as e:
+                logging.getLogger(PROGRAM_NAME).warning('Error removing cached activity <%s>\n%s', path, e)
+        if evicted_count:
+            logging.getLogger(PROGRAM_NAME).info('Evicted %d activities (%.1f MB) from the cache in <%s>',
+                                                 evicted_count, evicted_size / 1e6, self.cache_dir)
+
+
+class _CachedParseFunction:
+    """ Parse function (see _convert_activities) returning the parsed activities from the parsed activity cache, or
+    parsing and caching them when not cached. Picklable, so the worker processes use the cache too. """
+
+    def __init__(self, parse_function, get_fingerprint, cache: _ParsedActivityCache):
+        self.parse_function = parse_function
+        self.get_fingerprint = get_fingerprint
+        self.cache = cache
+
+    def __call__(self, parse_data) -> Optional[HiActivity]:
+        fingerprint = self.get_fingerprint(parse_data)
+        hi_activity = self.cache.get(fingerprint)
+        if hi_activity:
+            logging.getLogger(PROGRAM_NAME).info('Using cached parsed activity <%s>', hi_activity.activity_id)
+            return hi_activity
+        hi_activity = self.parse_function(parse_data)
+        if hi_activity:
+            self.cache.put(fingerprint, hi_activity)
+        return hi_activity
+
+
+def _get_parse_function(parse_function, get_fingerprint, cache: _ParsedActivityCache|None):
+    """ Returns the parse function using the parsed activity cache if the cache is used """
+    return _CachedParseFunction(parse_function, get_fingerprint, cache) if cache else parse_function
+
+
+class _StageCounters:
+    """ Throughput counters of the stages of the conversion of the activities of the --json, --zip or --tar options:
+    reading the activity data, parsing the activities and converting them to TCX files. When converting in parallel,
+    the parse and convert times are summed over the worker processes. """
+
+    def __init__(self):
+        # Per stage: number of items, number of bytes and processing time in seconds
+        self.counters = {}
+
+    def add(self, stage: str, seconds: float, count: int = 1, size: int = 0):
+        counter = self.counters.setdefault(stage, [0, 0, 0.0])
+        counter[0] += count
+        counter[1] += size
+        counter[2] += seconds
+
+    def timed(self, stage: str, iterable, get_size=None) -> Iterator:
+        """ Yields the items of the iterable and adds the time to get each item to the stage """
+        iterator = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.add(stage, time.perf_counter() - start, 0)
+                return
+            self.add(stage, time.perf_counter() - start, 1, get_size(item) if get_size else 0)
+            yield item
+
+    def log(self):
+        for stage, (count, size, seconds) in self.counters.items():
+            items_per_second = count / seconds if seconds else 0
+            if size:
+                logging.getLogger(PROGRAM_NAME).info(
+                    'Stage %s: %d items (%.1f MB) in %.2f s (%.1f items/s, %.1f MB/s)', stage, count, size / 1e6,
+                    seconds, items_per_second, size / 1e6 / seconds if seconds else 0)
+            else:
+                logging.getLogger(PROGRAM_NAME).info('Stage %s: %d items in %.2f s (%.1f items/s)',
+                                                     stage, count, seconds, items_per_second)
+
+
+def _convert_activities(parse_function, parse_data_list, args: argparse.Namespace, tcx_xml_schema=None,
+                        get_fingerprint=None, manifest: _ConversionManifest|None = None,
+                        stage_counters: _StageCounters|None = None,
+                        activity_filter: ActivityFilter|None = None) -> int:
+    """ Parses and converts the activities one at a time, so only one parsed activity is kept in memory.
+    With a manifest, the activities that did not change since the conversion recorded in the manifest are skipped.
+    The sequence number of an activity counts the skipped activities, so the TCX filenames remain the same as in a
+    full conversion.
+
+    Parameters:
+    parse_function: Function returning the parsed HiActivity for an element of parse_data_list
+    parse_data_list: Iterable with the data of each activity to parse
+    args (argparse.Namespace): The program arguments
+    tcx_xml_schema: Optional - The TCX XML schema to validate the TCX files
+    get_fingerprint: Optional - Function returning the activity key and the content hash of an element of
+                     parse_data_list. Required with the manifest.
+    manifest (_ConversionManifest): Optional - The conversion manifest
+    stage_counters (_StageCounters): Optional - The counters to add the parse and convert times to
+    activity_filter (ActivityFilter): Optional - The activity filter to evaluate on the sport of the parsed activities
+
+    Returns:
+    int: The number of converted activities
+    """
+    n = 0
+    converted_count = 0
+    for parse_data in parse_data_list:
+        fingerprint = None
+        if manifest:
+            fingerprint = get_fingerprint(parse_data)
+            if manifest.is_unchanged(*fingerprint):
+                n += 1
+                continue
+        start = time.perf_counter()
+        hi_activity = parse_function(parse_data)
+        parsed = time.perf_counter()
+        if hi_activity and activity_filter and not activity_filter.accepts_activity(hi_activity):
+            hi_activity = None
+        if hi_activity:
+            n += 1
+            output_filenames = _convert_activity(hi_activity, n, args, tcx_xml_schema)
+            if any(output_filenames):
+                converted_count += 1
+                # An activity with an output file that could not be saved is converted again in the next run
+                if manifest and all(output_filenames):
+                    manifest.add(*fingerprint, output_filenames)
+        if stage_counters:
+            stage_counters.add('parse', parsed - start)
+            if hi_activity:
+                stage_counters.add('convert', time.perf_counter() - parsed)
+    return converted_count
+
+
+class _LogRecordCollector(logging.Handler):
+    """ Collects the log records of a worker process. The records are passed to and logged by the main process. """
+    def __init__(self):
+        super().__init__()
+        self.records = []
+
+    def emit(self, record: logging.LogRecord):
+        # Merge the arguments in the message and format the exception info, both are not necessarily picklable.
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        self.records.append(record)
+
+
+_worker_log_record_collector = None
+_worker_tcx_xml_schema = None
+
+
+def _init_conversion_worker(log_level: int, tcx_xsd: tuple|None):
+    """ Initializes a worker process converting activities in parallel """
+    global _worker_log_record_collector, _worker_tcx_xml_schema
+    logger = logging.getLogger(PROGRAM_NAME)
+    # Worker processes can inherit the console handler of the main process. Collect the log records instead.
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+    _worker_log_record_collector = _LogRecordCollector()
+    logger.addHandler(_worker_log_record_collector)
+    logger.setLevel(log_level)
+    logger.propagate = False
+    # The main process already retrieved the TCX XSD (None if that failed or validation is not used)
+    _worker_tcx_xml_schema = _init_tcx_xml_schema(tcx_xsd)
+
+
+def _run_conversion_job(parse_function, parse_data, n: int, args: argparse.Namespace,
+                        activity_filter: ActivityFilter|None = None, output_file_suffix: str|None = None) -> tuple:
+    """ Parses and converts a single activity in a worker process. The sequence number of the activity is only known
+    when the results of the preceding activities are handled, so the files are saved with the (temporary) filename
+    suffix in output_file_suffix and renamed by the main process.
+
+    Returns:
+    tuple: The log records of the activity, the filename of the saved file per --output_format (None if the activity
+           was not parsed or was pruned), the parse and convert times in seconds (convert time is None if the activity
+           was not converted), the output statistics counters of the activity and whether the parsed activity was
+           pruned by the activity filter
+    """
+    _worker_log_record_collector.records = []
+    _output_statistics.counters = {}
+    output_filenames = None
+    parse_seconds = convert_seconds = None
+    pruned = False
+    start = time.perf_counter()
+    try:
+        hi_activity = parse_function(parse_data)
+        parsed = time.perf_counter()
+        parse_seconds = parsed - start
+        if hi_activity and activity_filter and not activity_filter.accepts_activity(hi_activity):
+            hi_activity = None
+            pruned = True
+        if hi_activity:
+            # The activity takes a sequence number, also when its conversion fails
+            output_filenames = []
+            output_filenames = _convert_activity(hi_activity, n, args, _worker_tcx_xml_schema, output_file_suffix)
+            convert_seconds = time.perf_counter() - parsed
+    except Exception as e:
+        logging.getLogger(PROGRAM_NAME).error('Error converting activity %d\n%s', n, e)
+    if parse_seconds is None:
+        parse_seconds = time.perf_counter() - start
+    return (_worker_log_record_collector.records, output_filenames, parse_seconds, convert_seconds,
+            _output_statistics.counters, pruned)
+
+
+def _convert_activities_in_parallel(activity_sources, args: argparse.Namespace,
+                                    manifest: _ConversionManifest|None = None,
+                                    stage_counters: _StageCounters|None = None,
+                                    activity_filter: ActivityFilter|None = None,
+                                    tcx_xsd: tuple|None = None) -> int:
+    """ Parses and converts the activities of one or more sources (e.g. the JSON files of a ZIP file) in worker
+    processes. The main process reads the activity data and submits it to the workers, which parse the activities and
+    convert them to TCX files. The activities of all sources are submitted in input order to the single task queue of
+    one pool of workers, from which an idle worker takes the oldest pending activity, whatever its source. So a large
+    source is spread over all workers and the next source is read while the last activities of the previous one are
+    still being converted. There is no further scheduling (e.g. by activity size). The number of activities in progress is limited to
+    twice the number of worker processes, which bounds the activity data waiting to be parsed. A parsed activity only
+    lives in its worker until it is converted. The results and log records of the activities are handled in the order
+    of the activities, a failing activity does not stop the conversion of the other activities. The sequence numbers of
+    the activities of a source are assigned while handling the results, to the parsed activities only (as in the serial
+    conversion), and the saved files are renamed accordingly.
+
+    Parameters:
+    activity_sources: Iterable with a tuple per source of activities with
+                      - the name of the source
+                      - a picklable function returning the parsed HiActivity for an element of the parse data list
+                      - the parse data list: an iterable with the data of each activity to parse
+                      - a function returning the activity key and the content hash of an element of the parse data
+                        list. Required with the manifest.
+    args (argparse.Namespace): The program arguments
+    manifest (_ConversionManifest): Optional - The conversion manifest to skip unchanged activities and to record the
+                                    converted activities in
+    stage_counters (_StageCounters): Optional - The counters to add the parse and convert times to
+    activity_filter (ActivityFilter): Optional - The activity filter to evaluate on the sport of the parsed activities
+                                      (in the workers) and to count the activities pruned after parsing in
+    tcx_xsd (tuple): Optional - The TCX XSD (see _get_tcx_xsd) to validate the TCX files against in the workers
+
+    Returns:
+    int: The number of converted activities
+    """
+    logger = logging.getLogger(PROGRAM_NAME)
+    jobs = args.jobs if args.jobs else os.cpu_count()
+    converted_count = 0
+    # Per source: number of converted activities, start time, time the last result was handled and the last sequence
+    # number
+    source_summaries = {}
+    # The files are saved with a temporary suffix in place of the sequence number suffix
+    renamed = not args.suppress_output_file_sequence and not (args.tar and args.use_original_filename)
+
+    def handle_result(source: str, job_n: int, future: concurrent.futures.Future|None, fingerprint: tuple|None,
+                      output_file_suffix: str|None):
+        nonlocal converted_count
+        source_summary = source_summaries[source]
+        source_summary[2] = time.perf_counter()
+        if future is None:
+            # Skipped unchanged activity (see _convert_activities)
+            source_summary[3] += 1
+            return
+        try:
+            log_records, output_filenames, parse_seconds, convert_seconds, output_counters, pruned = future.result()
+        except Exception as e:
+            logger.error('Error converting activity %d of <%s>\n%s', job_n, source, e)
+            return
+        for log_record in log_records:
+            logger.handle(log_record)
+        _output_statistics.merge(output_counters)
+        if pruned:
+            activity_filter.pruned[ActivityFilter.STAGE_PARSED] += 1
+        if stage_counters:
+            stage_counters.add('parse', parse_seconds)
+            if convert_seconds is not None:
+                stage_counters.add('convert', convert_seconds)
+        if output_filenames is None:
+            return
+        source_summary[3] += 1
+        if renamed:
+            sequence_suffix = _get_output_file_suffix(source_summary[3], args)
+            for i, output_filename in enumerate(output_filenames):
+                if not output_filename:
+                    continue
+                head, _, tail = output_filename.rpartition(output_file_suffix)
+                try:
+                    os.replace(output_filename, head + sequence_suffix + tail)
+                    output_filenames[i] = head + sequence_suffix + tail
+                    logger.info('Renamed file <%s> to <%s>', output_filename, output_filenames[i])
+                except OSError as e:
+                    logger.error('Error renaming file <%s> to <%s>\n%s', output_filename, head + sequence_suffix + tail,
+                                 e)
+                    output_filenames[i] = None
+        if any(output_filenames):
+            converted_count += 1
+            source_summary[0] += 1
+            # An activity with an output file that could not be saved is converted again in the next run
+            if manifest and all(output_filenames):
+                manifest.add(*fingerprint, output_filenames)
+
+    start = time.perf_counter()
+    activity_count = 0
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs, initializer=_init_conversion_worker,
+                                                initargs=(logger.getEffectiveLevel(), tcx_xsd)) as executor:
+        pending = collections.deque()
+        for source, parse_function, parse_data_list, get_fingerprint in activity_sources:
+            source_start = time.perf_counter()
+            source_summaries[source] = [0, source_start, source_start, 0]
+            for n, parse_data in enumerate(parse_data_list, start=1):
+                activity_count += 1
+                fingerprint = None
+                if manifest:
+                    fingerprint = get_fingerprint(parse_data)
+                    if manifest.is_unchanged(*fingerprint):
+                        pending.append((source, n, None, fingerprint, None))
+                        continue
+                output_file_suffix = '.%d.tmp' % activity_count if renamed else None
+                pending.append((source, n, executor.submit(_run_conversion_job, parse_function, parse_data, n, args,
+                                                           activity_filter, output_file_suffix),
+                                fingerprint, output_file_suffix))
+                if len(pending) >= 2 * jobs:
+                    handle_result(*pending.popleft())
+        while pending:
+            handle_result(*pending.popleft())
+
+    logger.info('Converted %d of %d activities in %.2f s using %d worker processes', converted_count, activity_count,
+                time.perf_counter() - start, jobs)
+    _log_source_summaries([(source, converted, end - source_start)
+                           for source, (converted, source_start, end, _) in source_summaries.items()])
+    return converted_count
+
+
+def _log_source_summaries(source_summaries: list):
+    """ Logs the number of converted activities and the conversion time of each source of activities (e.g. the JSON
+    files of a ZIP file). When converting in parallel, the time of a source runs from reading its first activity to
+    handling the result of its last activity, so the times of the sources overlap. """
+    if len(source_summaries) < 2:
+        return
+    for source, converted_count, seconds in source_summaries:
+        logging.getLogger(PROGRAM_NAME).info('Converted %d activities from <%s> in %.2f s',
+                                             converted_count, source, seconds)
+
+
+def _get_json_activity_sources(json_files, args: argparse.Namespace, activity_filter: ActivityFilter|None = None,
+                               cache: _ParsedActivityCache|None = None) -> Iterator[tuple]:
+    """ Yields the activity source (see _convert_activities_in_parallel) of each JSON file in json_files, an iterable
+    with the filename and the optional binary stream with the data of the JSON files. """
+    for json_filename, json_data in json_files:
+        hi_json = HiJson(json_filename, args.output_dir, args.json_export, args.columnar_store,
+                         args.distance_method, args.hitrack_export, json_data)
+        yield json_filename, _get_parse_function(hi_json.parse_activity, hi_json.get_activity_fingerprint, cache), \
+            hi_json.get_activities(args.from_date, activity_filter), hi_json.get_activity_fingerprint
+
+
 def main():
     parser = _init_argument_parser()
     args = parser.parse_args()
@@ -2181,81 +5081,123 @@ def main():
                                          sys.version_info[1],
                                          sys.version_info[2])
 
-    tcx_xml_schema = None if not args.validate_xml else _init_tcx_xml_schema()
-
-    if not args.suppress_output_file_sequence:
-        output_file_suffix_format = '_%03d'
-    else:
-        output_file_suffix_format = '%.0s'
-
-    if args.file:
-        if args.sport:
-            hi_file = HiTrackFile(args.file, args.sport)
-        else:
-            hi_file = HiTrackFile(args.file)
-        hi_activity = hi_file.parse()
-        if args.pool_length:
-            hi_activity.set_pool_length(args.pool_length)
-        tcx_activity = TcxActivity(hi_activity, tcx_xml_schema, args.output_dir, args.output_file_prefix,
-                                   args.tcx_insert_altitude_data)
-        if args.use_original_filename:
-            tcx_activity.save()
-        else:
-            tcx_filename = "%s/HiTrack_%s.tcx" % \
-                           (args.output_dir,
-                            _get_tz_aware_datetime(hi_activity.start, hi_activity.time_zone).strftime('%Y%m%d_%H%M%S'),
-                            )
-            tcx_activity.save(tcx_filename)
-        logging.getLogger(PROGRAM_NAME).info('Converted %s', hi_activity)
-    elif args.tar:
-        hi_tarball = HiTarBall(args.tar)
-        hi_activity_list = hi_tarball.parse(args.from_date)
-        for n, hi_activity in enumerate(hi_activity_list, start=1):
+    # Retrieved once, also with parallel conversion. The worker processes compile the retrieved TCX XSD, and do not
+    # validate when the main process could not retrieve or compile it.
+    tcx_xsd = None if not args.validate_xml else _get_tcx_xsd(args.tcx_xsd)
+    tcx_xml_schema = _init_tcx_xml_schema(tcx_xsd)
+    if not tcx_xml_schema:
+        # The worker processes do not retry
+        tcx_xsd = None
+
+    # The manifest for incremental conversion of the activities of the --json, --zip and --tar options
+    manifest = _ConversionManifest(args) if args.incremental and not args.file else None
+    # The selection of the activities to convert of the --json, --zip and --tar options
+    activity_filter = ActivityFilter(args.from_date, args.to_date, args.sport_filter, args.activity_id)
+    # The exports of the JSON and HiTrack data are side effects of parsing, so these are not combined with the cache
+    cache = _ParsedActivityCache(args.cache_dir, args.cache_size * 1000000, args) \
+        if args.cache_dir and not args.file and not args.json_export and not args.hitrack_export else None
+
+    try:
+        if args.file:
+            if args.sport:
+                hi_file = HiTrackFile(args.file, args.sport, columnar_store=args.columnar_store,
+                                      distance_method=args.distance_method)
+            else:
+                hi_file = HiTrackFile(args.file, columnar_store=args.columnar_store, distance_method=args.distance_method)
+            hi_activity = hi_file.parse()
             if args.pool_length:
                 hi_activity.set_pool_length(args.pool_length)
-            tcx_activity = TcxActivity(hi_activity, tcx_xml_schema, args.output_dir, args.output_file_prefix,
-                                       args.tcx_insert_altitude_data)
+            output_activities = _get_output_activities(hi_activity, args, tcx_xml_schema)
             if args.use_original_filename:
-                tcx_activity.save()
+                output_filenames = [None] * len(output_activities)
             else:
-                output_file_suffix = output_file_suffix_format % (n % 1000)
-                tcx_filename = "%s/HiTrack_%s%s.tcx" % \
-                               (args.output_dir,
-                                _get_tz_aware_datetime(hi_activity.start, hi_activity.time_zone).strftime('%Y%m%d_%H%M%S'),
-                                output_file_suffix
-                                )
-                tcx_activity.save(tcx_filename)
+                output_filenames = ["%s/HiTrack_%s%s" %
+                                    (args.output_dir,
+                                     _get_tz_aware_datetime(hi_activity.start, hi_activity.time_zone).strftime('%Y%m%d_%H%M%S'),
+                                     output_activity.file_extension
+                                     ) for output_activity in output_activities]
+            _save_activity(hi_activity, output_activities, output_filenames)
             logging.getLogger(PROGRAM_NAME).info('Converted %s', hi_activity)
-    elif args.json or args.zip:
-        json_filename_list = None
-        json_filename = None
-        if args.zip:
-            # New 2024-12 Huawei ZIP file format
-            json_filename_list = HiZip.extract_json_list(args.zip, args.output_dir, args.password)
-            if not json_filename_list:
-                # Old pre 2024-06 Huawei Zip format
-                json_filename = HiZip.extract_json(args.zip, args.output_dir, args.password)
-        elif args.json and zipfile.is_zipfile(args.json):
-            json_filename = HiZip.extract_json(args.json, args.output_dir, args.password)
-        else:
-            json_filename = args.json
-
-        if not json_filename_list and json_filename:
-            json_filename_list = [json_filename]
-
-        for json_filename in json_filename_list:
-            hi_json = HiJson(json_filename, args.output_dir, args.json_export)
-            hi_activity_list = hi_json.parse(args.from_date)
-            for n, hi_activity in enumerate(hi_activity_list, start=1):
-                if args.pool_length:
-                    hi_activity.set_pool_length(args.pool_length)
-                if not args.tcx_use_raw_distance_data:
-                    hi_activity.normalize_distances()
-                output_file_suffix = output_file_suffix_format % (n % 1000)
-                tcx_activity = TcxActivity(hi_activity, tcx_xml_schema, args.output_dir, args.output_file_prefix,
-                                           output_file_suffix, args.tcx_insert_altitude_data)
-                tcx_activity.save()
-                logging.getLogger(PROGRAM_NAME).info('Converted %s', hi_activity)
+        elif args.tar:
+            hi_tarball = HiTarBall(args.tar, args.output_dir, args.columnar_store, args.distance_method,
+                                   args.hitrack_export)
+            # The HiTrack files are read from the tarball, parsed and converted one at a time (or in parallel)
+            stage_counters = _StageCounters()
+            hitrack_files = stage_counters.timed('read', hi_tarball.get_hitrack_files(args.from_date, activity_filter),
+                                                 lambda hitrack_file: len(hitrack_file[1]))
+            parse_function = _get_parse_function(hi_tarball.parse_hitrack_file, hi_tarball.get_activity_fingerprint,
+                                                 cache)
+            if args.jobs != 1:
+                _convert_activities_in_parallel([(args.tar, parse_function, hitrack_files,
+                                                  hi_tarball.get_activity_fingerprint)], args, manifest, stage_counters,
+                                                activity_filter, tcx_xsd)
+            else:
+                _convert_activities(parse_function, hitrack_files, args, tcx_xml_schema,
+                                    hi_tarball.get_activity_fingerprint, manifest, stage_counters, activity_filter)
+            stage_counters.log()
+        elif args.json or args.zip:
+            json_filename_list = None
+            json_filename = None
+            zip_filename = args.zip if args.zip else args.json if zipfile.is_zipfile(args.json) else None
+            json_files = None
+            if zip_filename:
+                try:
+                    # Read (and decrypt) the JSON files straight from the ZIP file, without extracting them
+                    json_files = HiZip.open_json_files(zip_filename, args.password)
+                except ModuleNotFoundError as e:
+                    logging.getLogger(PROGRAM_NAME).info(
+                        '%s. Extracting the JSON files with 7-Zip (7za) or unzip instead of decrypting them with the '
+                        'zipfile module and pycryptodome. Install pycryptodome (pip install pycryptodome) to read the '
+                        'ZIP file without extracting the JSON files.', e)
+            if json_files is None:
+                if args.zip:
+                    # New 2024-12 Huawei ZIP file format
+                    json_filename_list = HiZip.extract_json_list(args.zip, args.output_dir, args.password)
+                    if not json_filename_list:
+                        # Old pre 2024-06 Huawei Zip format
+                        json_filename = HiZip.extract_json(args.zip, args.output_dir, args.password)
+                elif zip_filename:
+                    json_filename = HiZip.extract_json(args.json, args.output_dir, args.password)
+                else:
+                    json_filename = args.json
+
+                if not json_filename_list and json_filename:
+                    json_filename_list = [json_filename]
+                json_files = ((json_filename, None) for json_filename in json_filename_list)
+
+            if args.jobs != 1:
+                # The activities of all JSON files are converted by one pool of worker processes
+                _convert_activities_in_parallel(_get_json_activity_sources(json_files, args, activity_filter, cache),
+                                                args, manifest, activity_filter=activity_filter, tcx_xsd=tcx_xsd)
+            else:
+                source_summaries = []
+                for json_filename, json_data in json_files:
+                    start = time.perf_counter()
+                    hi_json = HiJson(json_filename, args.output_dir, args.json_export, args.columnar_store,
+                                     args.distance_method, args.hitrack_export, json_data)
+                    if manifest or cache:
+                        converted_count = _convert_activities(_get_parse_function(hi_json.parse_activity,
+                                                                                  hi_json.get_activity_fingerprint,
+                                                                                  cache),
+                                                              hi_json.get_activities(args.from_date, activity_filter),
+                                                              args, tcx_xml_schema, hi_json.get_activity_fingerprint,
+                                                              manifest, activity_filter=activity_filter)
+                    else:
+                        # Each activity is converted and released before the next one is parsed
+                        converted_count = 0
+                        for n, hi_activity in enumerate(hi_json.parse_iter(args.from_date, activity_filter), start=1):
+                            if any(_convert_activity(hi_activity, n, args, tcx_xml_schema)):
+                                converted_count += 1
+                            hi_activity = None
+                    source_summaries.append((json_filename, converted_count, time.perf_counter() - start))
+                _log_source_summaries(source_summaries)
+    finally:
+        activity_filter.log()
+        _output_statistics.log()
+        if manifest:
+            manifest.save()
+        if cache:
+            cache.evict()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,283 @@
+""" Benchmark of the conversion of a synthetic HiTrack activity. The results are printed and written to
+bench_output.txt.
+
+Usage: python benchmark.py [--hours HOURS] [--lines LINES] [--baseline HITRAVA_PY] [--parse_only] [--output OUTPUT]
+
+The parse benchmarks only use the HiTrackFile interface that all revisions of Hitrava.py have. To get the figures
+before a change, save the Hitrava.py of the revision before the change and pass it with --baseline. The parse
+benchmarks then run on both revisions, on the same data, and report the speedup:
+
+    git show <revision>:Hitrava.py > /tmp/Hitrava_baseline.py
+    python benchmark.py --baseline /tmp/Hitrava_baseline.py --parse_only
+"""
+import argparse
+import datetime
+import importlib.util
+import io
+import logging
+import os
+import tempfile
+import time
+import tracemalloc
+import types
+
+import Hitrava
+from Hitrava import PROGRAM_NAME, CsvActivity, FitActivity, GpxActivity, HiActivity, HiTrackFile, TcxActivity, \
+    _get_tz_aware_datetime, _OutputFormatter, _write_activity
+from tests.hitrack_data import generate_hitrack_data
+
+# Throughput target of HiTrackFile.parse on the synthetic 1M-line HiTrack file: the lines/s relative to the revision
+# before the table-driven record decoder and the integer timestamps (the baseline), measured on the same host
+PARSE_TARGET_SPEEDUP = 2.0
+
+
+def _best_time(function, repeat: int = 3) -> float:
+    """ Returns the best time in seconds of the repeated calls of the function """
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def _load_hitrava(filename: str) -> types.ModuleType:
+    """ Imports (another revision of) Hitrava.py from the file """
+    spec = importlib.util.spec_from_file_location('Hitrava_baseline', filename)
+    hitrava = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(hitrava)
+    return hitrava
+
+
+def _best_parse_time(hitrava: types.ModuleType, hitrack_data: str, timestamp_ref: datetime.datetime|None = None,
+                     start: int = 1577898000) -> float:
+    """ Returns the best time of HiTrackFile.parse of the HiTrack data, read from a HiTrack file """
+    with tempfile.TemporaryDirectory() as temp_dir:
+        # HiTrack_<12 digit start><12 digit stop><5 digits>
+        hitrack_filename = os.path.join(temp_dir, 'HiTrack_%d00%d0000000' % (start, start))
+        with open(hitrack_filename, 'w') as hitrack_file:
+            hitrack_file.write(hitrack_data)
+        return _best_time(lambda: hitrava.HiTrackFile(hitrack_filename, activity_type=hitrava.HiActivity.TYPE_CYCLE,
+                                                      timestamp_ref=timestamp_ref).parse())
+
+
+def _get_timestamp_converter(hitrava: types.ModuleType, timestamp_ref: datetime.datetime|None):
+    """ Returns the function converting a HiTrack timestamp in the revision of Hitrava.py """
+    if hasattr(hitrava, '_HiTrackTimestampConverter'):
+        return hitrava._HiTrackTimestampConverter(timestamp_ref).convert
+    # Earlier revisions convert every timestamp to a datetime
+    return lambda hitrack_timestamp: hitrava._convert_hitrack_timestamp(hitrack_timestamp, timestamp_ref)
+
+
+def _compare(results: list, rates: list, unit: str):
+    """ Adds the speedup of the current revision (first rate) over the baseline (second rate) to the results """
+    if len(rates) == 2:
+        results.append('  speedup over the baseline: %.2fx (%.0f -> %.0f %s)' % (rates[0] / rates[1], rates[1],
+                                                                                rates[0], unit))
+
+
+def bench_parse(seconds: int, revisions: list) -> list:
+    """ Records per second of HiTrackFile.parse (without finalizing the activity), with absolute location timestamps and
+    with location timestamps relative to the timestamp reference """
+    start = 1577898000
+    results = []
+    for relative_locations in (False, True):
+        hitrack_data = generate_hitrack_data(seconds, start=start, cadence=True,
+                                             relative_locations=relative_locations)
+        timestamp_ref = datetime.datetime.fromtimestamp(start - start % 86400, datetime.UTC) \
+            if relative_locations else None
+        records = hitrack_data.count('\n')
+        rates = []
+        for name, hitrava in revisions:
+            elapsed = _best_parse_time(hitrava, hitrack_data, timestamp_ref, start)
+            rates.append(records / elapsed)
+            results.append('HiTrackFile.parse (%s, %s location timestamps): %d records in %.3f s, %.0f records/s'
+                           % (name, 'relative' if relative_locations else 'absolute', records, elapsed,
+                              records / elapsed))
+        _compare(results, rates, 'records/s')
+    return results
+
+
+def bench_parse_lines(lines: int, revisions: list) -> list:
+    """ Lines per second of HiTrackFile.parse on a synthetic file of (about) the number of lines: a location record
+    every second, heart rate, cadence, altitude, step frequency and speed records every 2 seconds and unsupported p-m
+    and b-p-m records every 10 seconds (37 lines per 10 seconds) """
+    hitrack_data = generate_hitrack_data(lines * 10 // 37, cadence=True, interval=2, unsupported_records=True)
+    lines = hitrack_data.count('\n')
+    results = []
+    rates = []
+    for name, hitrava in revisions:
+        elapsed = _best_parse_time(hitrava, hitrack_data)
+        rates.append(lines / elapsed)
+        results.append('HiTrackFile.parse (%s, %d line file): %.3f s, %.0f lines/s' % (name, lines, elapsed,
+                                                                                      lines / elapsed))
+    _compare(results, rates, 'lines/s')
+    if len(rates) == 2:
+        results.append('  target: %.1fx the baseline, %s' % (PARSE_TARGET_SPEEDUP, 'met' if rates[0] / rates[1] >=
+                                                                PARSE_TARGET_SPEEDUP else 'NOT met'))
+    return results
+
+
+def bench_timestamps(revisions: list) -> list:
+    """ HiTrack timestamp conversions per second, per timestamp format """
+    timestamp_ref = datetime.datetime(2020, 1, 1, tzinfo=datetime.UTC)
+    formats = (('seconds', [1577898000.0 + n for n in range(100000)], None),
+               ('milliseconds', [1577898000000.0 + n * 1000 for n in range(100000)], None),
+               ('relative seconds', [43200.0 + n for n in range(100000)], timestamp_ref))
+    results = []
+    for format_name, hitrack_timestamps, format_timestamp_ref in formats:
+        rates = []
+        for name, hitrava in revisions:
+            convert = _get_timestamp_converter(hitrava, format_timestamp_ref)
+
+            def convert_timestamps():
+                for hitrack_timestamp in hitrack_timestamps:
+                    convert(hitrack_timestamp)
+
+            elapsed = _best_time(convert_timestamps)
+            rates.append(len(hitrack_timestamps) / elapsed)
+            results.append('Timestamp conversion (%s, %s): %.0f conversions/s' % (name, format_name,
+                                                                                 len(hitrack_timestamps) / elapsed))
+        _compare(results, rates, 'conversions/s')
+    return results
+
+
+def _parse(hitrack_data: str, columnar_store: bool = False) -> HiActivity:
+    return HiTrackFile('HiTrack_benchmark', activity_type=HiActivity.TYPE_CYCLE, columnar_store=columnar_store,
+                       hitrack_data=hitrack_data).parse()
+
+
+def bench_memory(hitrack_data: str) -> list:
+    """ Memory of the parsed activity in the dict and in the columnar (--columnar_store) detail data store """
+    results = []
+    retained = {}
+    for columnar_store in (False, True):
+        tracemalloc.start()
+        hi_activity = _parse(hitrack_data, columnar_store)
+        hi_activity.finalize()
+        retained[columnar_store], peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        results.append('Memory (%s store): %d records, %.1f MB retained, %.1f MB peak'
+                       % ('columnar' if columnar_store else 'dict', len(hi_activity.data_dict),
+                          retained[columnar_store] / 1e6, peak / 1e6))
+        del hi_activity
+    results.append('Memory reduction of the columnar store: %.1fx' % (retained[False] / retained[True]))
+    return results
+
+
+def bench_segment_data(hitrack_data: str) -> list:
+    """ Reading the data of all segments of the activity split in an increasing number of laps """
+    hi_activity = _parse(hitrack_data)
+    hi_activity.finalize()
+    timestamps = sorted(hi_activity.data_dict)
+    results = []
+    for lap_count in (10, 100, 1000, 4000):
+        step = len(timestamps) // lap_count
+        segments = [{'start': timestamps[n * step], 'stop': timestamps[min((n + 1) * step, len(timestamps)) - 1]}
+                    for n in range(lap_count)]
+
+        def read_segments():
+            for segment in segments:
+                for _ in hi_activity.get_segment_data(segment):
+                    pass
+
+        elapsed = _best_time(read_segments)
+        results.append('Segment data of %4d laps: %.3f s, %.3f ms per lap' % (lap_count, elapsed,
+                                                                              elapsed / lap_count * 1000))
+    return results
+
+
+def bench_formatting(hitrack_data: str) -> list:
+    """ Formatting of the trackpoint timestamps and coordinates, with datetime and str() as before and with
+    _OutputFormatter """
+    hi_activity = _parse(hitrack_data)
+    records = [data for data in hi_activity.data_dict.values() if 'lat' in data]
+    formatter = _OutputFormatter(hi_activity.time_zone)
+
+    def format_with_datetime():
+        for data in records:
+            _get_tz_aware_datetime(data['t'], hi_activity.time_zone).isoformat('T')
+            str(data['lat'])
+            str(data['lon'])
+
+    def format_with_formatter():
+        for data in records:
+            formatter.timestamp(data['t'])
+            formatter.coordinate(data['lat'])
+            formatter.coordinate(data['lon'])
+
+    datetime_time = _best_time(format_with_datetime)
+    formatter_time = _best_time(format_with_formatter)
+    return ['Trackpoint formatting of %d records: datetime.isoformat and str %.3f s, _OutputFormatter %.3f s '
+            '(%.1fx)' % (len(records), datetime_time, formatter_time, datetime_time / formatter_time)]
+
+
+def bench_output(hitrack_data: str) -> list:
+    """ Size and encode time of the output formats """
+    hi_activity = _parse(hitrack_data)
+    hi_activity.finalize()
+    writers = (('TCX', lambda: TcxActivity(hi_activity)),
+               ('TCX compact', lambda: TcxActivity(hi_activity, compact=True)),
+               ('TCX compact gzip', lambda: TcxActivity(hi_activity, compact=True, compress=True)),
+               ('FIT', lambda: FitActivity(hi_activity)),
+               ('GPX', lambda: GpxActivity(hi_activity)),
+               ('CSV', lambda: CsvActivity(hi_activity)))
+    results = []
+    tcx_size = None
+    for name, create_writer in writers:
+        output_file = io.BytesIO()
+
+        def write():
+            output_file.seek(0)
+            output_file.truncate()
+            _write_activity(hi_activity, [(create_writer(), output_file)])
+
+        elapsed = _best_time(write)
+        size = len(output_file.getvalue())
+        tcx_size = tcx_size or size
+        results.append('%-16s output: %9d bytes (%5.1f%% of TCX), encoded in %.3f s'
+                       % (name, size, size / tcx_size * 100, elapsed))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark of the conversion of a synthetic HiTrack activity')
+    parser.add_argument('--hours', help='The duration of the synthetic activity in hours (1 second sampling)',
+                        type=float, default=10)
+    parser.add_argument('--lines', help='The number of lines of the synthetic HiTrack file of the parse throughput '
+                                        'benchmark', type=int, default=1000000)
+    parser.add_argument('--baseline', help='The Hitrava.py of an earlier revision to compare the parse benchmarks '
+                                           'with')
+    parser.add_argument('--parse_only', help='Only run the parse benchmarks', action='store_true')
+    parser.add_argument('--output', help='The file to write the results to', default='bench_output.txt')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.ERROR)
+    logging.getLogger(PROGRAM_NAME).setLevel(logging.ERROR)
+
+    seconds = round(args.hours * 3600)
+    revisions = [('current', Hitrava)]
+    if args.baseline:
+        revisions.append(('baseline', _load_hitrava(args.baseline)))
+    benchmarks = [lambda: bench_parse(seconds, revisions), lambda: bench_parse_lines(args.lines, revisions),
+                  lambda: bench_timestamps(revisions)]
+    if not args.parse_only:
+        hitrack_data = generate_hitrack_data(seconds, cadence=True)
+        benchmarks += [lambda bench=bench: bench(hitrack_data)
+                       for bench in (bench_memory, bench_segment_data, bench_formatting, bench_output)]
+
+    results = ['Synthetic %.1f hour cycling activity' % args.hours]
+    print(results[0])
+    for bench in benchmarks:
+        bench_results = bench()
+        for result in bench_results:
+            print(result)
+        results += bench_results
+
+    with open(args.output, 'w') as output_file:
+        output_file.write('\n'.join(results) + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,39 @@
+""" Synthetic HiTrack data for the tests and the benchmark """
+import math
+
+
+def generate_hitrack_data(seconds: int, start: int = 1577898000, pauses: int = 2, cadence: bool = False,
+                          relative_locations: bool = False, interval: int = 5,
+                          unsupported_records: bool = False) -> str:
+    """ Returns the HiTrack data of a synthetic activity of (about) the number of seconds, starting at the start
+    timestamp (seconds since epoch). The activity has a location record per second and heart rate, step frequency,
+    altitude, speed (and cadence) records every interval seconds, and is paused for a minute the number of pauses
+    times. With relative_locations, the location timestamps are in seconds since the start of the (UTC) day, to be
+    parsed with that day as timestamp reference. With unsupported_records, it also has p-m and b-p-m records every 10
+    seconds, which are not parsed. The records are ordered by record type, as in the HiTrack files of a tracking
+    device. """
+    records = {'lbs': [], 'h-r': [], 's-r': [], 'alti': [], 'rs': [], 'cad': [], 'p-m': [], 'b-p-m': []}
+    pause_at = {seconds * (n + 1) // (pauses + 1) for n in range(pauses)}
+    location_offset = start - start % 86400 if relative_locations else 0
+    t = start
+    for i in range(seconds):
+        t += 1
+        if i in pause_at:
+            records['lbs'].append('tp=lbs;k=0;lat=90;lon=-80;alt=0;t=%d' % (t - location_offset))
+            t += 60
+            continue
+        lat = 50.85 + 0.002 * math.sin(i / 300) + i * 0.000005
+        lon = 4.35 + 0.002 * math.cos(i / 300)
+        records['lbs'].append('tp=lbs;k=%d;lat=%.8f;lon=%.8f;alt=%.1f;t=%d'
+                              % (i, lat, lon, 10 + i % 7, t - location_offset))
+        if i % interval == 0:
+            records['h-r'].append('tp=h-r;k=%d;v=%d' % (t, 120 + i % 40))
+            records['s-r'].append('tp=s-r;k=%d;v=%d' % (t, 0 if cadence else 150 + i % 9))
+            records['alti'].append('tp=alti;k=%d;v=%.1f' % (t, 30 + math.sin(i / 50) * 10))
+            records['rs'].append('tp=rs;k=%d;v=%d' % (t - start, 25 + i % 11))
+            if cadence:
+                records['cad'].append('tp=cad;k=%d;v=%d' % (t, 80 + i % 10))
+        if unsupported_records and i % 10 == 0:
+            records['p-m'].append('tp=p-m;k=%d;v=300' % (t - start))
+            records['b-p-m'].append('tp=b-p-m;k=%d;v=60' % (t - start))
+    return '\n'.join(line for lines in records.values() for line in lines) + '\n'
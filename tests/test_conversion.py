@@ -0,0 +1,46 @@
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from Hitrava import _ConversionManifest, _init_argument_parser  # noqa: E402
+
+
+class TestConversionManifest(unittest.TestCase):
+
+    def setUp(self):
+        self.output_dir = tempfile.TemporaryDirectory()
+        self.args = _init_argument_parser().parse_args(['--json', 'export.json', '--output_dir', self.output_dir.name,
+                                                        '--incremental', '--output_format', 'tcx', 'gpx'])
+        self.output_filenames = [os.path.join(self.output_dir.name, 'HiTrack_20200101_180000_001' + extension)
+                                 for extension in ('.tcx', '.gpx')]
+        for output_filename in self.output_filenames:
+            with open(output_filename, 'w'):
+                pass
+        manifest = _ConversionManifest(self.args)
+        manifest.add('activity', 'hash', self.output_filenames)
+        manifest.save()
+
+    def tearDown(self):
+        self.output_dir.cleanup()
+
+    def test_unchanged(self):
+        manifest = _ConversionManifest(self.args)
+        self.assertEqual(manifest.activities['activity']['output_files'], self.output_filenames)
+        self.assertTrue(manifest.is_unchanged('activity', 'hash'))
+        self.assertFalse(manifest.is_unchanged('activity', 'other hash'))
+        self.assertFalse(manifest.is_unchanged('other activity', 'hash'))
+
+    def test_removed_output_file(self):
+        os.remove(self.output_filenames[1])
+        self.assertFalse(_ConversionManifest(self.args).is_unchanged('activity', 'hash'))
+
+    def test_other_output_format(self):
+        self.args.output_format = ['fit']
+        self.assertFalse(_ConversionManifest(self.args).is_unchanged('activity', 'hash'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,68 @@
+import math
+import os
+import random
+import sys
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import Hitrava  # noqa: E402
+from Hitrava import DISTANCE_ANDOYER_LAMBERT, DISTANCE_HAVERSINE, DISTANCE_VINCENTY, HiActivity, \
+    _calc_distances  # noqa: E402
+
+# The maximum deviation of the distance methods from HiActivity._vincenty, documented in _calc_distances
+MAX_RELATIVE_DEVIATIONS = {DISTANCE_ANDOYER_LAMBERT: 0.0001, DISTANCE_HAVERSINE: 0.006}
+MAX_VINCENTY_NUMPY_DEVIATION = 1e-6
+
+
+def random_location_pairs(count: int, seed: int = 1) -> tuple[list, list]:
+    """ Returns random pairs of locations between 1e-6 and 0.3 degree apart, as between consecutive location records,
+    and some identical locations """
+    rng = random.Random(seed)
+    points1 = []
+    points2 = []
+    for _ in range(count):
+        lat = rng.uniform(-80, 80)
+        lon = rng.uniform(-180, 180)
+        distance = 10 ** rng.uniform(-6, math.log10(0.3))
+        bearing = rng.uniform(0, 2 * math.pi)
+        points1.append((lat, lon))
+        points2.append((lat + distance * math.cos(bearing), lon + distance * math.sin(bearing)))
+    points1 += [(50.8865, 4.3695), (0.0, 0.0)]
+    points2 += [(50.8865, 4.3695), (0.0, 0.0)]
+    return points1, points2
+
+
+class TestCalcDistances(unittest.TestCase):
+
+    def setUp(self):
+        self.points1, self.points2 = random_location_pairs(5000)
+        self.references = [HiActivity._vincenty(point1, point2) for point1, point2 in zip(self.points1, self.points2)]
+
+    def assert_within_bound(self, distances: list, method: str):
+        self.assertEqual(len(distances), len(self.references))
+        for distance, reference in zip(distances, self.references):
+            self.assertLessEqual(abs(distance - reference), MAX_RELATIVE_DEVIATIONS[method] * reference,
+                                 '%s distance %s, vincenty %s' % (method, distance, reference))
+
+    def test_pure_python(self):
+        with mock.patch.object(Hitrava, 'numpy', None):
+            self.assertEqual(_calc_distances(self.points1, self.points2, DISTANCE_VINCENTY), self.references)
+            for method in MAX_RELATIVE_DEVIATIONS:
+                self.assert_within_bound(_calc_distances(self.points1, self.points2, method), method)
+
+    @unittest.skipIf(Hitrava.numpy is None, 'NumPy is not installed')
+    def test_numpy(self):
+        distances = _calc_distances(self.points1, self.points2, DISTANCE_VINCENTY)
+        for distance, reference in zip(distances, self.references):
+            # Both are rounded to 6 decimals (micrometers): at most one unit in the last decimal apart
+            self.assertLessEqual(abs(round(distance / MAX_VINCENTY_NUMPY_DEVIATION) -
+                                     round(reference / MAX_VINCENTY_NUMPY_DEVIATION)), 1,
+                                 'vincenty distance %s, pure Python %s' % (distance, reference))
+        for method in MAX_RELATIVE_DEVIATIONS:
+            self.assert_within_bound(_calc_distances(self.points1, self.points2, method), method)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,91 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from Hitrava import HiActivity, HiColumnarDataDict, HiTrackFile  # noqa: E402
+from tests.hitrack_data import generate_hitrack_data  # noqa: E402
+
+HITRACK_DATA = '\n'.join(['tp=lbs;k=0;lat=50.88650532;lon=4.36949292;alt=14.0;t=1577898000',
+                          'tp=lbs;k=5;lat=50.88672157;lon=4.36979772;alt=13.0;t=1577898005',
+                          'tp=lbs;k=10;lat=50.88693196;lon=4.37011748;alt=11.0;t=1577898010',
+                          'tp=h-r;k=1577898000;v=120',
+                          'tp=h-r;k=1577898005;v=125'])
+
+
+class TestHiActivityFinalize(unittest.TestCase):
+
+    def _parse(self, columnar_store: bool = False) -> HiActivity:
+        hitrack_file = HiTrackFile('HiTrack_test', activity_type=HiActivity.TYPE_WALK, columnar_store=columnar_store,
+                                   hitrack_data=HITRACK_DATA)
+        return hitrack_file.parse()
+
+    def test_laps_and_segments_are_read_only(self):
+        hi_activity = self._parse()
+        laps = hi_activity.finalize()
+        self.assertIsInstance(laps, tuple)
+        self.assertIsInstance(hi_activity.get_segments(), tuple)
+        with self.assertRaises(TypeError):
+            laps[0]['distance'] = 0
+        with self.assertRaises(TypeError):
+            hi_activity.get_segments()[0]['distance'] = 0
+
+    def test_add_data_after_finalize_raises(self):
+        for columnar_store in (False, True):
+            hi_activity = self._parse(columnar_store)
+            laps = hi_activity.finalize()
+            with self.assertRaisesRegex(Exception, 'after it was finalized'):
+                hi_activity.add_heart_rate_data([['k', '1577898010'], ['v', '130']])
+            self.assertIs(hi_activity.finalize(), laps)
+
+    def test_set_activity_type_refreshes_laps(self):
+        hi_activity = self._parse()
+        laps = hi_activity.finalize()
+        hi_activity.set_activity_type(HiActivity.TYPE_RUN)
+        refreshed_laps = hi_activity.finalize()
+        self.assertIsNot(refreshed_laps, laps)
+        self.assertEqual([dict(lap) for lap in refreshed_laps], [dict(lap) for lap in laps])
+
+
+class TestHiActivityRecordData(unittest.TestCase):
+
+    def test_add_record_data(self):
+        hi_activity = HiActivity('HiTrack_test')
+        hi_activity.add_heart_rate_data([['k', '1577898000'], ['v', '120']])
+        self.assertEqual(list(hi_activity.data_dict.values()), [{'t': 1577898000000000, 'hr': 120}])
+
+    def test_invalid_record_data_error_context(self):
+        hi_activity = HiActivity('HiTrack_test')
+        with self.assertRaises(Exception) as context:
+            hi_activity.add_heart_rate_data([['k', '1577898000']])
+        self.assertIn('heart rate', context.exception.args)
+        hitrack_file = HiTrackFile('HiTrack_test', hitrack_data=HITRACK_DATA + '\ntp=h-r;k=1577898010;v=high')
+        with self.assertRaisesRegex(Exception, r"6, .*\(k, v\) missing or invalid in heart rate data"):
+            hitrack_file.parse()
+
+
+class TestHiColumnarDataDict(unittest.TestCase):
+
+    def test_columnar_store_equals_dict_store(self):
+        for activity_type, cadence in ((HiActivity.TYPE_RUN, False), (HiActivity.TYPE_CYCLE, True)):
+            hitrack_data = generate_hitrack_data(1800, cadence=cadence)
+            hi_activities = [HiTrackFile('HiTrack_test', activity_type=activity_type, columnar_store=columnar_store,
+                                         hitrack_data=hitrack_data).parse() for columnar_store in (False, True)]
+            dict_activity, columnar_activity = hi_activities
+            self.assertIsInstance(columnar_activity.data_dict, HiColumnarDataDict)
+            dict_activity.normalize_distances()
+            columnar_activity.normalize_distances()
+
+            self.assertGreater(len(dict_activity.get_segments()), 1)
+            self.assertEqual(len(columnar_activity.data_dict), len(dict_activity.data_dict))
+            self.assertEqual(columnar_activity.calculated_distance, dict_activity.calculated_distance)
+            self.assertEqual([dict(lap) for lap in columnar_activity.finalize()],
+                             [dict(lap) for lap in dict_activity.finalize()])
+            for dict_segment, columnar_segment in zip(dict_activity.get_segments(), columnar_activity.get_segments()):
+                self.assertEqual([dict(data) for data in columnar_activity.get_segment_data(columnar_segment)],
+                                 [dict(data) for data in dict_activity.get_segment_data(dict_segment)])
+
+
+if __name__ == '__main__':
+    unittest.main()
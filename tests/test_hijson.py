@@ -0,0 +1,73 @@
+import io
+import json
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from Hitrava import HiJsonArrayReader  # noqa: E402
+
+# Small chunk sizes make the escape sequences, strings and brackets in the test data straddle the chunk boundaries
+CHUNK_SIZES = range(1, 9)
+
+
+class TestHiJsonArrayReader(unittest.TestCase):
+
+    def read_elements(self, json_data: bytes, chunk_size: int) -> list:
+        return list(HiJsonArrayReader(io.BytesIO(json_data), chunk_size))
+
+    def assert_elements(self, json_data: bytes, expected_elements: list):
+        for chunk_size in CHUNK_SIZES:
+            with self.subTest(chunk_size=chunk_size):
+                self.assertEqual(self.read_elements(json_data, chunk_size), expected_elements)
+
+    def test_escaped_quotes_and_backslashes(self):
+        elements = [{'a': 'say "hi"', 'b': 'C:\\dir\\'}, 'x\\"y\\\\', {'c': '\\\\"]}', 'd': ['\\']}]
+        self.assert_elements(json.dumps(elements).encode(), elements)
+
+    def test_brackets_in_strings(self):
+        elements = [{'a': '[{', 'b': ['}]', ']]]'], 'c': '{"x": [1, 2]}'}, '],[', {'d': {'e': '}'}}]
+        self.assert_elements(json.dumps(elements).encode(), elements)
+
+    def test_scalars_and_whitespace(self):
+        self.assert_elements(b' \r\n[ 1 ,\t-2.5e3,true , null,\n"s" ,[] ,{} ]\n', [1, -2.5e3, True, None, 's', [], {}])
+
+    def test_empty_array(self):
+        self.assert_elements(b'[]', [])
+        self.assert_elements(b' [ \n ] ', [])
+
+    def test_byte_order_mark(self):
+        elements = [{'id': 1}, {'id': 2}]
+        self.assert_elements(b'\xef\xbb\xbf' + json.dumps(elements).encode(), elements)
+        self.assert_elements(b'\xef\xbb\xbf\n [ ]', [])
+
+    def test_malformed_part_time_map(self):
+        json_data = b'[{"partTimeMap":{1.0:300,2.0:612},"id":"1","partTimeKmMap":{}},' \
+                    b'{"partTimeMap":{},"id":"2"}]'
+        self.assert_elements(json_data, [{'id': '1', 'partTimeKmMap': {}}, {'id': '2'}])
+
+    def test_raw_offsets(self):
+        json_data = b'\xef\xbb\xbf[{"a": 1}, [2], "3"]'
+        for chunk_size in CHUNK_SIZES:
+            with self.subTest(chunk_size=chunk_size):
+                raw_elements = list(HiJsonArrayReader(io.BytesIO(json_data), chunk_size).iter_raw())
+                self.assertEqual(raw_elements, [(4, b'{"a": 1}'), (14, b'[2]'), (19, b'"3"')])
+
+    def test_truncated_input(self):
+        json_data = json.dumps([{'a': 'say "hi"', 'b': ['[', {'c': 1}]}, {'d': 2}]).encode()
+        for length in range(len(json_data)):
+            for chunk_size in (1, 3, 1024):
+                with self.subTest(length=length, chunk_size=chunk_size):
+                    with self.assertRaises(ValueError):
+                        self.read_elements(json_data[:length], chunk_size)
+
+    def test_no_top_level_array(self):
+        for json_data in (b'', b'\xef\xbb\xbf', b'{"a": 1}', b'  "[]"'):
+            with self.subTest(json_data=json_data):
+                with self.assertRaises(ValueError):
+                    self.read_elements(json_data, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,115 @@
+import json
+import os
+import shutil
+import struct
+import sys
+import tempfile
+import unittest
+import zipfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from Hitrava import AES, HiZip, _WinZipAesReader  # noqa: E402
+
+# WinZip AES-256 encrypted ZIP file (password 'hitrava') with
+# - a deflated AE-2 member with the motion path detail data JSON of 2 activities
+# - an empty stored AE-2 member
+# - a stored AE-1 member (with the CRC-32 of the plaintext)
+AES_ZIP_FILENAME = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'winzip_aes256.zip')
+AES_ZIP_PASSWORD = b'hitrava'
+JSON_MEMBER = 'Motion path detail data & description/motion path detail data.json'
+EMPTY_MEMBER = 'Motion path detail data & description/empty.json'
+AE1_MEMBER = 'ae1.txt'
+AE1_PLAINTEXT = b'Stored data of an AE-1 member, with the CRC-32 of the plaintext.'
+
+
+class _SmallChunkWinZipAesReader(_WinZipAesReader):
+    _CHUNK_SIZE = 7
+
+
+@unittest.skipIf(AES is None, 'The pycryptodome library is not installed')
+class TestWinZipAesReader(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    @staticmethod
+    def _open(member: str, password: bytes = AES_ZIP_PASSWORD, zip_filename: str = AES_ZIP_FILENAME,
+              reader_class=_WinZipAesReader) -> _WinZipAesReader:
+        with zipfile.ZipFile(zip_filename) as zip_file:
+            zip_info = zip_file.getinfo(member)
+        return reader_class(zip_filename, zip_info, password)
+
+    def _copy_with_flipped_byte(self, member: str, offset: int) -> str:
+        """ Returns a copy of the ZIP file with a flipped byte at the offset from the start of the (encrypted) data of
+        the member: salt, password verifier, encrypted data and authentication code """
+        zip_filename = shutil.copy(AES_ZIP_FILENAME, self.temp_dir.name)
+        with zipfile.ZipFile(zip_filename) as zip_file:
+            header_offset = zip_file.getinfo(member).header_offset
+        with open(zip_filename, 'r+b') as zip_file:
+            zip_file.seek(header_offset + 26)
+            filename_length, extra_length = struct.unpack('<2H', zip_file.read(4))
+            zip_file.seek(header_offset + 30 + filename_length + extra_length + offset)
+            byte = zip_file.read(1)[0]
+            zip_file.seek(-1, os.SEEK_CUR)
+            zip_file.write(bytes([byte ^ 0x01]))
+        return zip_filename
+
+    def test_decrypt(self):
+        with self._open(JSON_MEMBER) as json_file:
+            activities = json.loads(json_file.read())
+        self.assertEqual([activity['startTime'] for activity in activities], [1577898000000, 1577984400000])
+        with self._open(AE1_MEMBER) as ae1_file:
+            self.assertEqual(ae1_file.read(), AE1_PLAINTEXT)
+
+    def test_decrypt_in_chunks(self):
+        with self._open(JSON_MEMBER) as json_file:
+            plaintext = json_file.read()
+        # The counter and the decompression continue over chunks that are not a multiple of the AES block size
+        for member, expected in ((JSON_MEMBER, plaintext), (AE1_MEMBER, AE1_PLAINTEXT)):
+            with self._open(member, reader_class=_SmallChunkWinZipAesReader) as member_file:
+                data = b''
+                while chunk := member_file.read(5):
+                    data += chunk
+            self.assertEqual(data, expected)
+
+    def test_wrong_password(self):
+        with self.assertRaisesRegex(RuntimeError, 'Bad password'):
+            self._open(JSON_MEMBER, b'wrong password')
+
+    def test_flipped_ciphertext_byte(self):
+        # Stored member: salt (16 bytes) and password verifier (2 bytes), then the encrypted data
+        zip_filename = self._copy_with_flipped_byte(AE1_MEMBER, 18 + 10)
+        with self._open(AE1_MEMBER, zip_filename=zip_filename) as ae1_file:
+            with self.assertRaisesRegex(zipfile.BadZipFile, 'Bad authentication code'):
+                ae1_file.read()
+
+    def test_ae1_crc(self):
+        with zipfile.ZipFile(AES_ZIP_FILENAME) as zip_file:
+            zip_info = zip_file.getinfo(AE1_MEMBER)
+        self.assertEqual(_WinZipAesReader.get_aes_parameters(zip_info)[0], 1)
+        zip_info.CRC ^= 1
+        with _WinZipAesReader(AES_ZIP_FILENAME, zip_info, AES_ZIP_PASSWORD) as ae1_file:
+            with self.assertRaisesRegex(zipfile.BadZipFile, 'Bad CRC-32'):
+                ae1_file.read()
+
+    def test_empty_member(self):
+        with self._open(EMPTY_MEMBER) as empty_file:
+            self.assertEqual(empty_file.read(), b'')
+        # The authentication code of an empty member is verified when it is opened
+        zip_filename = self._copy_with_flipped_byte(EMPTY_MEMBER, 18)
+        with self.assertRaisesRegex(zipfile.BadZipFile, 'Bad authentication code'):
+            self._open(EMPTY_MEMBER, zip_filename=zip_filename)
+
+    def test_open_json_files(self):
+        json_files = {name: json_file.read() for name, json_file in
+                      HiZip.open_json_files(AES_ZIP_FILENAME, AES_ZIP_PASSWORD.decode('utf-8'))}
+        self.assertEqual(sorted(json_files), sorted([JSON_MEMBER, EMPTY_MEMBER]))
+        self.assertEqual(len(json.loads(json_files[JSON_MEMBER])), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
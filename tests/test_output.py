@@ -0,0 +1,109 @@
+import datetime
+import io
+import os
+import random
+import struct
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from Hitrava import FitActivity, HiActivity, HiTrackFile, _get_tz_aware_datetime, _OutputFormatter  # noqa: E402
+from tests.hitrack_data import generate_hitrack_data  # noqa: E402
+
+
+def fit_crc(data: bytes, crc: int = 0) -> int:
+    """ The FIT CRC-16 (polynomial 0xA001), computed bit by bit """
+    for byte in data:
+        crc ^= byte
+        for _ in range(8):
+            crc = (crc >> 1) ^ 0xA001 if crc & 1 else crc >> 1
+    return crc
+
+
+class TestFitActivity(unittest.TestCase):
+
+    def setUp(self):
+        hitrack_file = HiTrackFile('HiTrack_test', activity_type=HiActivity.TYPE_RUN,
+                                   hitrack_data=generate_hitrack_data(900))
+        self.hi_activity = hitrack_file.parse()
+        fit_file = io.BytesIO()
+        FitActivity(self.hi_activity).generate_fit(fit_file)
+        self.fit_data = fit_file.getvalue()
+
+    def test_header(self):
+        header_size, protocol_version, profile_version, data_size, data_type = \
+            struct.unpack('<BBHI4s', self.fit_data[:12])
+        self.assertEqual(header_size, 14)
+        self.assertEqual(data_type, b'.FIT')
+        self.assertEqual(data_size, len(self.fit_data) - 14 - 2)
+        self.assertEqual(struct.unpack('<H', self.fit_data[12:14])[0], fit_crc(self.fit_data[:12]))
+
+    def test_file_crc(self):
+        self.assertEqual(struct.unpack('<H', self.fit_data[-2:])[0], fit_crc(self.fit_data[:-2]))
+        # The CRC over the data including the file CRC is 0
+        self.assertEqual(fit_crc(self.fit_data), 0)
+
+    def test_message_structure(self):
+        data = self.fit_data[14:-2]
+        definitions = {}
+        messages = []
+        pos = 0
+        while pos < len(data):
+            record_header = data[pos]
+            pos += 1
+            self.assertFalse(record_header & 0x80, 'Compressed timestamp headers are not written')
+            local_message_type = record_header & 0x0F
+            if record_header & 0x40:
+                reserved, architecture, global_message_number, field_count = struct.unpack_from('<BBHB', data, pos)
+                self.assertEqual((reserved, architecture), (0, 0))
+                pos += 5
+                fields = [struct.unpack_from('<BBB', data, pos + 3 * n) for n in range(field_count)]
+                pos += 3 * field_count
+                definitions[local_message_type] = (global_message_number, sum(size for _, size, _ in fields))
+            else:
+                self.assertIn(local_message_type, definitions)
+                global_message_number, size = definitions[local_message_type]
+                messages.append(global_message_number)
+                pos += size
+        self.assertEqual(pos, len(data))
+
+        self.assertEqual(messages[0], FitActivity._FILE_ID)
+        self.assertEqual(messages.count(FitActivity._LAP), len(self.hi_activity.finalize()))
+        self.assertEqual(messages.count(FitActivity._SESSION), 1)
+        self.assertEqual(messages.count(FitActivity._ACTIVITY), 1)
+        self.assertGreater(messages.count(FitActivity._RECORD), 0)
+
+
+class TestOutputFormatter(unittest.TestCase):
+
+    TIME_ZONES = (None, datetime.timezone.utc, datetime.timezone(datetime.timedelta(hours=1)),
+                  datetime.timezone(datetime.timedelta(hours=-3, minutes=-30)))
+
+    def test_timestamp(self):
+        timestamps = [1577898000000000, 1577898000123456, 1577898059000001, 951782400000000, 0]
+        for time_zone in self.TIME_ZONES:
+            formatter = _OutputFormatter(time_zone)
+            for timestamp in timestamps:
+                self.assertEqual(formatter.timestamp(timestamp),
+                                 _get_tz_aware_datetime(timestamp, time_zone).isoformat('T'))
+                self.assertEqual(formatter.timestamp_seconds(timestamp),
+                                 _get_tz_aware_datetime(timestamp, time_zone).isoformat('T', 'seconds'))
+
+    def test_numbers(self):
+        random.seed(1)
+        values = [round(random.uniform(-180, 180), 8) for _ in range(1000)] + \
+                 [round(random.uniform(0, 50000), 6) for _ in range(1000)] + [0, 0.0, 12, 1e-07]
+        formatter = _OutputFormatter(None)
+        for value in values:
+            # Without a number of decimals, the numbers are formatted as before (str of the rounded value)
+            self.assertEqual(formatter.coordinate(value), str(value))
+            self.assertEqual(formatter.distance(value), str(value))
+        formatter = _OutputFormatter(None, coordinate_decimals=6, distance_decimals=1)
+        for value in values:
+            self.assertEqual(float(formatter.coordinate(value)), round(value, 6))
+            self.assertEqual(float(formatter.distance(value)), round(value, 1))
+
+
+if __name__ == '__main__':
+    unittest.main()